@@ -0,0 +1,255 @@
+#!/usr/bin/env python3
+''' Shared k-mer distances between templates
+
+Copyright (c) 2014, Ole Lund, Technical University of Denmark
+All rights reserved.
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+
+The number of k-mers two templates share is the product of the template x
+k-mer incidence matrix with its transpose. All k-mers of an equivalence
+class have the same templates, so it is summed over the classes instead,
+each weighted by its number of k-mers: a class of s templates adds its
+weight to the s x s pairs of them.
+
+The matrix is computed in blocks of rows, in a pool of processes, and
+written to a binary matrix file (float64, row by row) that is
+memory-mapped, so it does not have to fit in memory. The text outputs are
+streamed from it a block of rows at a time.
+
+The distance of two templates is 1 - shared / max(k-mers of the two).
+
+With a sketch, only the k-mers hashing below 2^64 / SCALE (as in the
+prescreen index) are counted. The Jaccard index of two templates is
+estimated from their sketch k-mers and turned back into a number of shared
+k-mers with the exact number of k-mers of each template.
+'''
+import multiprocessing
+
+import numpy
+
+from kmerFinder.template.sketch import hash_kmers
+
+# number of template pairs made at a time:
+BLOCKSIZE = 1 << 24
+
+##########################################################################
+# SHARED K-MERS
+##########################################################################
+
+def class_weights(templates, scale=None):
+    ''' Number of k-mers in each class of a TemplateDB, only of those in the
+    sketch of 1 / scale of the k-mers if scale
+    '''
+    if scale is None:
+        return numpy.bincount(templates.classes,
+                              minlength=templates.Nclasses)
+    threshold = numpy.uint64(int(2 ** 64 / scale) - 1)
+    weights = numpy.zeros(templates.Nclasses, dtype=numpy.int64)
+    for start in range(0, len(templates.kmers), BLOCKSIZE):
+        stop = start + BLOCKSIZE
+        sampled = hash_kmers(templates.kmers[start:stop]) <= threshold
+        weights += numpy.bincount(templates.classes[start:stop][sampled],
+                                  minlength=templates.Nclasses)
+    return weights
+
+class SharedKmers(object):
+    ''' Rows of the matrix of the number of k-mers each pair of template
+    IDs of a TemplateDB shares, from the class weights
+    '''
+
+    def __init__(self, templates, weights, blocksize=BLOCKSIZE):
+        self.templates = templates
+        self.weights = weights
+        self.blocksize = blocksize
+        self.Ntemplates = len(templates.names)
+        # the classes of each template, with weights:
+        classes = numpy.flatnonzero(weights)
+        (ids, sizes) = templates.class_postings(classes)
+        ids = numpy.asarray(ids, dtype=numpy.int64)
+        order = numpy.argsort(ids, kind="stable")
+        self.tclasses = numpy.repeat(classes, sizes)[order]
+        self.toffsets = numpy.zeros(self.Ntemplates + 1, dtype=numpy.int64)
+        numpy.cumsum(numpy.bincount(ids, minlength=self.Ntemplates),
+                     out=self.toffsets[1:])
+        # the diagonal:
+        self.sizes = numpy.bincount(
+            ids, weights=numpy.repeat(weights[classes], sizes),
+            minlength=self.Ntemplates)
+
+    def rows(self, start, stop):
+        ''' Rows start to stop of the matrix, as floats '''
+        templates = self.templates
+        N = self.Ntemplates
+        shared = numpy.zeros((stop - start) * N, dtype=numpy.float64)
+        classes = self.tclasses[self.toffsets[start]:self.toffsets[stop]]
+        rows = numpy.repeat(numpy.arange(stop - start, dtype=numpy.int64),
+                            numpy.diff(self.toffsets[start:stop + 1]))
+        sizes = templates.offsets[classes + 1] - templates.offsets[classes]
+        # at most blocksize pairs of a row and a template at a time:
+        ends = numpy.cumsum(sizes)
+        first = 0
+        while first < classes.size:
+            done = ends[first - 1] if first > 0 else 0
+            last = max(first + 1, int(numpy.searchsorted(
+                ends, done + self.blocksize, side="right")))
+            (ids, counts) = templates.class_postings(classes[first:last])
+            shared += numpy.bincount(
+                numpy.repeat(rows[first:last], counts) * N + ids,
+                weights=numpy.repeat(self.weights[classes[first:last]],
+                                     counts), minlength=shared.size)
+            first = last
+        return shared.reshape((stop - start, N))
+
+def estimate_rows(start, sketchshared, sketchsizes, nkmers):
+    ''' Rows of the number of shared k-mers, from start, estimated from
+    the shared sketch k-mers and the exact number of k-mers of each
+    template
+    '''
+    stop = start + sketchshared.shape[0]
+    union = sketchsizes[start:stop, None] + sketchsizes[None, :] \
+        - sketchshared
+    jaccard = sketchshared / numpy.maximum(union, 1.0)
+    nkmers = numpy.asarray(nkmers, dtype=numpy.float64)
+    shared = jaccard / (1.0 + jaccard) * (nkmers[start:stop, None] +
+                                          nkmers[None, :])
+    rows = numpy.arange(stop - start)
+    shared[rows, start + rows] = nkmers[start:stop]
+    return shared
+
+##########################################################################
+# MATRIX FILE
+##########################################################################
+
+_matrix = None
+
+def _write_rows(block):
+    ''' Compute a block of rows in a worker and write it to the matrix
+    file
+    '''
+    (shared, nkmers, sketch, matrixfilename) = _matrix
+    (start, stop) = block
+    rows = shared.rows(start, stop)
+    if sketch:
+        rows = estimate_rows(start, rows, shared.sizes, nkmers)
+    matrix = numpy.memmap(matrixfilename, dtype=numpy.float64, mode="r+",
+                          shape=(shared.Ntemplates, shared.Ntemplates))
+    matrix[start:stop] = rows
+    matrix.flush()
+    del matrix
+    return stop - start
+
+def write_matrix(matrixfilename, templates, scale=None, threads=1,
+                 blocksize=BLOCKSIZE, report=None):
+    ''' Write the matrix of shared k-mers of a TemplateDB (float64, row
+    by row) in blocks of rows, computed in threads processes, and return it
+    memory-mapped. With scale it is estimated from a sketch.
+    report(rows) is called as blocks are done.
+    '''
+    global _matrix
+    nkmers = templates.kmer_counts()
+    shared = SharedKmers(templates, class_weights(templates, scale),
+                         blocksize)
+    N = shared.Ntemplates
+    with open(matrixfilename, "wb") as matrixfile:
+        matrixfile.truncate(N * N * 8)
+    if N == 0:
+        return numpy.zeros((0, 0), dtype=numpy.float64)
+    Nrows = max(1, blocksize // N)
+    blocks = [(start, min(start + Nrows, N))
+              for start in range(0, N, Nrows)]
+    # forked workers share the database:
+    _matrix = (shared, nkmers, scale is not None, matrixfilename)
+    try:
+        if threads > 1:
+            pool = multiprocessing.Pool(threads)
+            try:
+                for done in pool.imap_unordered(_write_rows, blocks):
+                    if report is not None:
+                        report(done)
+            finally:
+                pool.terminate()
+        else:
+            for block in blocks:
+                done = _write_rows(block)
+                if report is not None:
+                    report(done)
+    finally:
+        _matrix = None
+    return numpy.memmap(matrixfilename, dtype=numpy.float64, mode="r",
+                        shape=(N, N))
+
+##########################################################################
+# OUTPUT
+##########################################################################
+
+def _blocks(ids, blocksize):
+    ''' Blocks of the template IDs, with blocksize values of a matrix '''
+    Nrows = max(1, blocksize // max(1, len(ids)))
+    for start in range(0, len(ids), Nrows):
+        yield (start, ids[start:start + Nrows])
+
+def _distance_blocks(matrix, nkmers, ids, blocksize):
+    ''' Distance 1 - shared / max(k-mers of the two) between the template
+    IDs, by blocks of rows
+    '''
+    nkmers = numpy.asarray(nkmers, dtype=numpy.float64)[ids]
+    for (start, block) in _blocks(ids, blocksize):
+        shared = matrix[block][:, ids]
+        lmax = numpy.maximum(nkmers[start:start + len(block), None],
+                             nkmers[None, :])
+        yield (start, 1.0 - shared / numpy.maximum(lmax, 1.0))
+
+def distance_matrix(matrix, nkmers, ids, blocksize=BLOCKSIZE):
+    ''' Distances between the template IDs, in memory '''
+    distances = numpy.empty((len(ids), len(ids)), dtype=numpy.float64)
+    for (start, block) in _distance_blocks(matrix, nkmers, ids, blocksize):
+        distances[start:start + block.shape[0]] = block
+    return distances
+
+def write_phylip(outputfile, names, matrix, nkmers, ids,
+                 blocksize=BLOCKSIZE):
+    ''' Distances between the template IDs as a PHYLIP matrix, six
+    distances per line, names of the IDs
+    '''
+    outputfile.write("%s\n" % (len(ids)))
+    # every row has the same layout:
+    rowformat = "%-10s " + "\n".join(
+        " ".join(["%0.8f"] * min(6, len(ids) - j))
+        for j in range(0, len(ids), 6)) + "\n"
+    for (start, distances) in _distance_blocks(matrix, nkmers, ids,
+                                               blocksize):
+        outputfile.write("".join(
+            rowformat % ((names[start + i][0:10],) + tuple(row))
+            for (i, row) in enumerate(distances.tolist())))
+
+def write_columns(outputfile, names, matrix, nkmers, ids,
+                  blocksize=BLOCKSIZE):
+    ''' One line per pair of the template IDs: names, shared k-mers, k-mers
+    of each and the larger of them
+    '''
+    nkmers = numpy.asarray(nkmers, dtype=numpy.float64)[ids]
+    # the second name of each line is the same in every row:
+    rowformat = "".join("%%s %s %%s %%s %%s %%s\n" % (
+        name[0:11].replace("%", "%%")) for name in names)
+    for (start, block) in _blocks(ids, blocksize):
+        shared = matrix[block][:, ids]
+        for (i, row) in enumerate(shared.tolist()):
+            n = nkmers[start + i]
+            lmax = numpy.maximum(n, nkmers).tolist()
+            name = names[start + i][0:11]
+            n = float(n)
+            values = []
+            for (count, m, l) in zip(row, nkmers.tolist(), lmax):
+                values.extend((name, count, n, m, l))
+            outputfile.write(rowformat % tuple(values))
@@ -24,10 +24,7 @@ from argparse import ArgumentParser
 from operator import itemgetter
 import re
 
-if sys.version_info < (3, 0):
-    import cPickle as pickle
-else:
-    import pickle
+from kmerFinder.template.database import open_database
 
 def readPrintKmerDB():
     ############################################################
@@ -47,20 +44,7 @@ def readPrintKmerDB():
     # open templatefile (already existing databse)
     #################################################################################
 
-    if args.templatefilename != None:
-
-      if args.print_ulengths == True:
-        templatefile_ulengths = open(args.templatefilename+".ulen.p", "rb" )
-
-      if args.print_lengths ==True:
-        templatefile_lengths = open(args.templatefilename+".len.p", "rb" )
-
-      if args.print_inputs == True:
-        templatefile = open(args.templatefilename+".p", "rb" )
-
-      if args.print_descriptions == True:
-        templatefile_descriptions = open(args.templatefilename+".desc.p", "rb" )
-    else:
+    if args.templatefilename == None:
       sys.stderr.write("Please specify database!\n")
       sys.exit(2)
 
@@ -71,18 +55,7 @@ def readPrintKmerDB():
 
     sys.stdout.write("%s\n" % ("# Reading database of templates"))
 
-
-    if args.print_ulengths == True:
-      ulengths = pickle.load(templatefile_ulengths)
-
-    if args.print_lengths ==True:
-      lengths = pickle.load(templatefile_lengths)
-
-    if args.print_inputs == True:
-      inputs = pickle.load(templatefile)
-
-    if args.print_descriptions == True:
-      descriptions = pickle.load(templatefile_descriptions)
+    templates = open_database(args.templatefilename, merge=True)
 
 
     #################################################################################
@@ -93,22 +66,22 @@ def readPrintKmerDB():
 
     if args.print_ulengths == True:
       print("ulengths:")
-      for key, value in ulengths.iteritems():
+      for key, value in templates.ulengths.items():
         print(key + " " + str(value))
 
     if args.print_lengths ==True:
       print("lengths:")
-      for key, value in lengths.iteritems():
+      for key, value in templates.lengths.items():
         print(key + " " + str(value))
 
     if args.print_inputs == True:
       print("hash table:")
-      for key, value in inputs.iteritems():
-        print(key + " " + str(value))
+      for key, value in templates.items():
+        print(key + " " + ",".join(value))
 
     if args.print_descriptions == True:
       print("descriptions:")
-      for key, value in descriptions.iteritems():
+      for key, value in templates.descriptions.items():
         print(key + " " + str(value))
 
 if __name__ == '__main__':
@@ -0,0 +1,173 @@
+#!/usr/bin/env python3
+''' Neighbor joining
+
+Copyright (c) 2014, Ole Lund, Technical University of Denmark
+All rights reserved.
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+
+Each step joins the pair of nodes with the smallest
+
+    Q(i, j) = (r - 2) d(i, j) - R(i) - R(j)
+
+where r is the number of nodes left and R(i) the sum of the distances of
+node i. As in RapidNJ, every row is kept sorted by distance, and no pair
+further along the sorted row of node i is below
+(r - 2) d(i, j) - R(i) - max R. All rows are scanned together, a window of
+columns at a time with one array operation, and only the rows whose bound
+is still below the best pair found go on to a (twice as wide) next window.
+
+The sorted rows are kept as float32 distances, rounded down so the bounds
+stay below the true Q, and int32 columns; the pairs that may be the best
+are then checked with D. With D
+in float64 a tree of N nodes needs 16 N^2 bytes.
+
+The joined node takes the place of the first node of the pair and gets a
+new sorted row. The old rows still have the replaced node in their sorted
+order, so the node of a column counts in a row only if it is not newer
+than the row (the pair is then found in the row of the newer node).
+'''
+import numpy
+
+# rows of the matrix handled at a time:
+BLOCKSIZE = 1 << 24
+
+##########################################################################
+# FUNCTIONS
+##########################################################################
+
+def newick_label(name):
+    ''' Name as a Newick label, quoted if needed '''
+    if any(c in name for c in " \t()[]:;,'"):
+        return "'%s'" % (name.replace("'", "''"))
+    return name
+
+def _sorted_rows(D, rows, columns):
+    ''' Distances of rows to columns, each row sorted, and the column of
+    each distance
+    '''
+    S = numpy.empty((len(rows), len(columns)), dtype=numpy.float32)
+    I = numpy.empty((len(rows), len(columns)), dtype=numpy.int32)
+    Nrows = max(1, BLOCKSIZE // max(1, len(columns)))
+    for start in range(0, len(rows), Nrows):
+        block = D[numpy.ix_(rows[start:start + Nrows], columns)]
+        order = numpy.argsort(block, axis=1, kind="stable")
+        block = numpy.take_along_axis(block, order, axis=1)
+        rounded = block.astype(numpy.float32)
+        up = rounded > block
+        rounded[up] = numpy.nextafter(rounded[up], numpy.float32(-numpy.inf))
+        S[start:start + Nrows] = rounded
+        I[start:start + Nrows] = columns[order]
+    return (S, I)
+
+def neighbor_joining(D, names):
+    ''' Newick tree of the nodes names joined by the distance matrix D,
+    which is overwritten
+    '''
+    n = len(names)
+    labels = [newick_label(name) for name in names]
+    if n == 0:
+        return ";"
+    if n == 1:
+        return "%s;" % (labels[0])
+    numpy.fill_diagonal(D, 0.0)
+    nodes = numpy.arange(n)
+    active = numpy.ones(n, dtype=bool)
+    R = D.sum(axis=1)
+    (S, I) = _sorted_rows(D, nodes, nodes)
+    # step each row was sorted in, and the first column of it to search:
+    born = numpy.zeros(n, dtype=numpy.int64)
+    first = numpy.zeros(n, dtype=numpy.int64)
+    r = n
+    while r > 3:
+        act = numpy.flatnonzero(active)
+        Rmax = R[act].max()
+        # in float64, products with the float32 S must not round up:
+        scale = numpy.float64(r - 2)
+        best = numpy.inf
+        pair = None
+        rows = act
+        offsets = first[act]
+        width = 8
+        while rows.size > 0:
+            positions = offsets[:, None] + numpy.arange(width)[None, :]
+            inside = positions < n
+            positions = numpy.minimum(positions, n - 1)
+            J = I[rows[:, None], positions].astype(numpy.intp)
+            valid = inside & active[J] & (born[J] <= born[rows][:, None]) \
+                & (J != rows[:, None])
+            # Q from the rounded down S is a lower bound, the pairs below
+            # the Q of the lowest bound are checked with D:
+            q = scale * S[rows[:, None], positions] - R[rows][:, None] \
+                - R[J]
+            q[~valid] = numpy.inf
+            (x, y) = divmod(int(numpy.argmin(q)), width)
+            if q[x, y] < best:
+                lowest = (r - 2) * D[rows[x], J[x, y]] - R[rows[x]] \
+                    - R[J[x, y]]
+                (x, y) = numpy.nonzero((q <= lowest) & (q < best))
+                (x, y) = (rows[x], J[x, y])
+                q = (r - 2) * D[x, y] - R[x] - R[y]
+                k = int(numpy.argmin(q))
+                if q[k] < best:
+                    best = q[k]
+                    pair = (x[k], y[k])
+            if width == 8:
+                # skip the columns that no longer count in later steps:
+                skip = numpy.where(valid.any(axis=1),
+                                   numpy.argmax(valid, axis=1), width)
+                first[rows] = numpy.minimum(offsets + skip, n)
+            # rows that may still have a better pair further along:
+            offsets = offsets + width
+            more = offsets < n
+            rows = rows[more]
+            offsets = offsets[more]
+            bounds = scale * S[rows, offsets] - R[rows] - Rmax
+            more = bounds < best
+            (rows, offsets) = (rows[more], offsets[more])
+            width *= 2
+        (a, b) = sorted(pair)
+        dab = D[a, b]
+        la = dab / 2.0 + (R[a] - R[b]) / (2.0 * (r - 2))
+        lb = dab - la
+        labels[a] = "(%s:%0.8f,%s:%0.8f)" % (labels[a], la, labels[b], lb)
+        labels[b] = None
+        # distances of the new node, taking the place of a:
+        du = (D[a, act] + D[b, act] - dab) / 2.0
+        R[act] += du - D[a, act] - D[b, act]
+        active[b] = False
+        D[a, act] = du
+        D[act, a] = du
+        D[a, a] = 0.0
+        others = act[(act != a) & (act != b)]
+        R[a] = D[a, others].sum()
+        (Sa, Ia) = _sorted_rows(D, numpy.array([a]), others)
+        S[a, :others.size] = Sa[0]
+        S[a, others.size:] = numpy.inf
+        I[a, :others.size] = Ia[0]
+        I[a, others.size:] = a
+        born[a] = n - r + 1
+        first[a] = 0
+        r -= 1
+    # the last three (or two) nodes are joined at the root:
+    act = numpy.flatnonzero(active).tolist()
+    if len(act) == 2:
+        (i, j) = act
+        return "(%s:%0.8f,%s:%0.8f);" % (labels[i], D[i, j] / 2.0,
+                                         labels[j], D[i, j] / 2.0)
+    (i, j, k) = act
+    li = (D[i, j] + D[i, k] - D[j, k]) / 2.0
+    lj = (D[i, j] + D[j, k] - D[i, k]) / 2.0
+    lk = (D[i, k] + D[j, k] - D[i, j]) / 2.0
+    return "(%s:%0.8f,%s:%0.8f,%s:%0.8f);" % (labels[i], li, labels[j], lj,
+                                              labels[k], lk)
@@ -1,9 +1,151 @@
 #!/usr/bin/env python3
-'''  '''
+''' Taxonomy of kmerfinder hits
+
+The taxonomy file is compiled once into an index next to it, by accession
+(or by organism with -c):
+
+    TAXFILE.accession.keys      sorted keys (fixed width bytes)
+    TAXFILE.accession.offsets   start of the value of each key (int64)
+    TAXFILE.accession.values    the values, taxonomy columns 3 and on
+    TAXFILE.accession.meta.p    key width, path, size and time of TAXFILE
+
+The index is kept in INDEXDIR instead with --indexdir, and compiled again
+when TAXFILE changes. If it can not be written, for instance next to a
+read-only TAXFILE, the taxonomy is read into memory for the run. Keys are
+found by binary search in the memory-mapped keys, the last lookups are kept
+in an LRU cache.
+'''
 from argparse import ArgumentParser
+from functools import lru_cache
 import subprocess
 import sys
 import os
+import pickle
+
+import numpy
+
+from kmerFinder.template.database import _map_array, _write_array
+
+# number of lookups kept:
+CACHESIZE = 1 << 16
+
+##########################################################################
+# TAXONOMY INDEX
+##########################################################################
+
+def index_filename(taxfilename, organism=False, indexdir=None):
+    ''' Name of the index of the taxonomy file, next to it or in indexdir '''
+    if indexdir is not None:
+        taxfilename = os.path.join(indexdir, os.path.basename(taxfilename))
+    return "%s.%s" % (taxfilename, "organism" if organism else "accession")
+
+def read_taxonomy_file(taxfilename, organism=False):
+    ''' Taxonomy columns 3 and on by accession, or by organism '''
+    tax = {}
+    with open(taxfilename, "r") as taxfile:
+        for l in taxfile:
+            l = l.strip()
+            if l == '': continue
+            if l[0] == '#': continue
+            l = l.split("\t")
+            if organism == True:
+                tax[l[1]] = "\t".join(l[2:])
+            else:
+                tax[l[0]] = "\t".join(l[2:])
+    return tax
+
+def write_taxonomy_index(tax, taxfilename, organism=False, indexdir=None):
+    ''' Write the index of the taxonomy read from taxfilename, the meta
+    file last
+    '''
+    filename = index_filename(taxfilename, organism, indexdir)
+    stat = os.stat(taxfilename)
+    if indexdir is not None and not os.path.isdir(indexdir):
+        os.makedirs(indexdir)
+    keys = sorted(key.encode("utf-8") for key in tax)
+    values = [tax[key.decode("utf-8")].encode("utf-8") for key in keys]
+    width = max([1] + [len(key) for key in keys])
+    offsets = numpy.zeros(len(keys) + 1, dtype=numpy.int64)
+    numpy.cumsum([len(value) for value in values], out=offsets[1:])
+    _write_array(filename + ".keys", numpy.array(keys, dtype="S%s" % (width)),
+                 "S%s" % (width))
+    _write_array(filename + ".offsets", offsets, numpy.int64)
+    _write_array(filename + ".values",
+                 numpy.frombuffer(b"".join(values), dtype=numpy.uint8),
+                 numpy.uint8)
+    meta = {
+        "width": width,
+        "taxfilename": os.path.abspath(taxfilename),
+        "size": stat.st_size,
+        "mtime": stat.st_mtime,
+    }
+    with open(filename + ".meta.p.tmp", "wb") as metafile:
+        pickle.dump(meta, metafile, 2)
+    os.rename(filename + ".meta.p.tmp", filename + ".meta.p")
+
+def compile_taxonomy(taxfilename, organism=False, indexdir=None):
+    ''' Write the index of the taxonomy file by accession, or by organism '''
+    write_taxonomy_index(read_taxonomy_file(taxfilename, organism),
+                         taxfilename, organism, indexdir)
+
+def _index_meta(taxfilename, organism=False, indexdir=None):
+    ''' Meta of the index of the taxonomy file, None if it has none, or
+    the index is of another file or the file has changed since
+    '''
+    filename = index_filename(taxfilename, organism, indexdir) + ".meta.p"
+    if not os.path.exists(filename):
+        return None
+    with open(filename, "rb") as metafile:
+        meta = pickle.load(metafile)
+    stat = os.stat(taxfilename)
+    if meta.get("taxfilename", os.path.abspath(taxfilename)) != \
+            os.path.abspath(taxfilename):
+        return None
+    if (meta["size"], meta["mtime"]) != (stat.st_size, stat.st_mtime):
+        return None
+    return meta
+
+class TaxonomyIndex(object):
+    ''' Taxonomy columns by accession (or organism), from the index of a
+    taxonomy file. If the index can not be written, the taxonomy is kept in
+    memory instead.
+    '''
+
+    def __init__(self, taxfilename, organism=False, cachesize=CACHESIZE,
+                 indexdir=None):
+        meta = _index_meta(taxfilename, organism, indexdir)
+        filename = index_filename(taxfilename, organism, indexdir)
+        if meta is None:
+            tax = read_taxonomy_file(taxfilename, organism)
+            try:
+                write_taxonomy_index(tax, taxfilename, organism, indexdir)
+            except OSError as e:
+                sys.stderr.write("# Can not write the taxonomy index %s: %s, "
+                                 "keeping the taxonomy in memory\n" % (
+                                     filename, e))
+                self.get = tax.get
+                return
+            meta = _index_meta(taxfilename, organism, indexdir)
+        self.keys = _map_array(filename + ".keys", "S%s" % (meta["width"]))
+        self.offsets = _map_array(filename + ".offsets", numpy.int64)
+        self.values = _map_array(filename + ".values", numpy.uint8)
+        self.get = lru_cache(maxsize=cachesize)(self._get)
+
+    def _get(self, key):
+        ''' Taxonomy columns of key, None if not present '''
+        key = key.encode("utf-8")
+        row = int(numpy.searchsorted(self.keys, key))
+        if row == len(self.keys) or self.keys[row] != key:
+            return None
+        return self.values[self.offsets[row]:self.offsets[row + 1]
+                           ].tobytes().decode("utf-8")
+
+    def __contains__(self, key):
+        return self.get(key) is not None
+
+##########################################################################
+# GET TAXONOMY
+##########################################################################
 
 def getTaxonomy():
     '''  '''
@@ -13,6 +155,8 @@ def getTaxonomy():
     parser.add_argument("-b", "--bacteria", dest="bacteria",action="store_true", help="is it a bacteria DB?")
     parser.add_argument("-c", "--organism", dest="organism",action="store_true", help="is it an organism DB?")
     parser.add_argument("-o", "--outfile", dest="outfile", help="outputfile")
+    parser.add_argument("--indexdir", dest="indexdir", help="keep the index of the taxonomy file in INDEXDIR, default next to it", metavar="INDEXDIR")
+    parser.add_argument("--cachesize", dest="cachesize", type=int, default=CACHESIZE, help="keep the last CACHESIZE taxonomy lookups, default %s" % (CACHESIZE), metavar="CACHESIZE")
     args = parser.parse_args()
     # -------------------------------------------------------------
     #     parse commandline options
@@ -26,8 +170,8 @@ def getTaxonomy():
         sys.exit(2)
     
     # get infile:
-    if args.taxfile is not None:
-        taxfile = open(args.taxfile, "r")
+    if args.taxfile is not None and os.path.exists(args.taxfile):
+        taxfile = args.taxfile
     else:
         sys.stderr.write("Please specify path to taxonomy file!\n")
         sys.exit(2)
@@ -39,21 +183,11 @@ def getTaxonomy():
         sys.stderr.write("Please specify outputfile!\n")
         sys.exit(2)
     #------------------------------------------------------------
-    #  store taxonomy
+    #  open taxonomy index
     #------------------------------------------------------------
     
-    tax={}
-    for l in taxfile:
-        l=l.strip()
-        if l == '': continue
-        if l[0] == '#': continue
-        l=l.split("\t")
-        if args.organism == True:
-            tax[l[1]] = "\t".join(l[2:])
-        else:
-            tax[l[0]] = "\t".join(l[2:])
-    
-    taxfile.close()
+    tax = TaxonomyIndex(taxfile, args.organism == True, args.cachesize,
+                        args.indexdir)
     
     #-------------------------------------------------------------
     #  parse kmerfinder output
@@ -73,10 +207,8 @@ def getTaxonomy():
             tmp=tmp.strip(">")
             if tmp[0:3] == "gi|":
                 tmp=tmp.split("|")[1]
-            print(tmp, tax.keys())
-            if tmp in tax:
-                t=tax[tmp]
-            else:
+            t = tax.get(tmp)
+            if t is None:
                 if args.bacteria == True:
                     t="unknown\tunknown\tunknown\tunknown"
                 else:
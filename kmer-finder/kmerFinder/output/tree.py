@@ -6,19 +6,25 @@ import sys
 import time
 import os
 from math import sqrt
-from argsparse import ArgumentParser
+from argparse import ArgumentParser
 from operator import itemgetter
 import re
-#import bsddb3 as bsddb
 import numpy
-#import anydbm
-#import shelve
 
 if sys.version_info < (3, 0):
     import cPickle as pickle
+    from string import maketrans
 else:
     import pickle
     xrange = range
+    maketrans = str.maketrans
+
+from kmerFinder.template.database import (open_database, is_database,
+                                          from_templates)
+from kmerFinder.output.distance import (BLOCKSIZE, write_matrix,
+                                        distance_matrix, write_phylip,
+                                        write_columns)
+from kmerFinder.output.nj import neighbor_joining
 
 #
 # Functions
@@ -68,6 +74,24 @@ def makeTree():
                         action="store_true", help="use database input")
     parser.add_argument("-c", "--columns", dest="columns",
                         action="store_true", help="write output in column format")
+    parser.add_argument("-s", "--sketch", dest="sketchscale", type=int,
+                        help="estimate the shared k-mers from a sketch of "
+                        "about one k-mer in SCALE", metavar="SCALE")
+    parser.add_argument("-n", "--newick", dest="newickfilename",
+                        help="also join the templates by neighbor joining "
+                        "and write the tree to NEWICKFILE, this needs "
+                        "16*N^2 bytes of memory for N templates",
+                        metavar="NEWICKFILE")
+    parser.add_argument("-m", "--matrix", dest="matrixfilename",
+                        help="keep the binary matrix of shared k-mers in "
+                        "MATFILE, default a temporary OUTFILE.matrix",
+                        metavar="MATFILE")
+    parser.add_argument("--threads", dest="threads", type=int, default=1,
+                        help="compute the matrix in THREADS processes, "
+                        "default 1", metavar="THREADS")
+    parser.add_argument("--blocksize", dest="blocksize", type=int,
+                        default=BLOCKSIZE, help="make at most BLOCKSIZE "
+                        "template pairs at a time", metavar="BLOCKSIZE")
     args = parser.parse_args()
     #
     # set up prefix filtering
@@ -82,170 +106,73 @@ def makeTree():
     #
     t0 = time.time()
     #
-    if args.templatefilename != None:
-        if args.pickleinput == True:
-            templatefile = open(args.templatefilename, "rb")
-        # elif args.dbinput == True:
-        #  #templates = anydbm.open(args.templatefilename, 'r')
-        #  templates = bsddb.db.DB()
-        #  templates.set_cachesize(1, 0)  # 1Gb, 0b
-        #  dbtype = bsddb.db.DB_BTREE
-        #  # or
-        #  # dbtype = bsddb.db.DB_HASH
-        #  templates.open(args.templatefilename, None, flags = bsddb.db.DB_RDONLY)
-        else:
-            templatefile = open(args.templatefilename, "r")
-    else:
+    if args.templatefilename == None:
         sys.exit("No template file specified")
     #
     if args.outputfilename != None:
-        outputfile = open(args.outputfilename, "w")
-    else:  # If no output filename choose the same as the input filename
-        outputfilename = os.path.splitext(args.inputfilename)[0]
-        outputfile = open(outputfilename, "w")
-    #
-    # Make database of nmers
-    #
-    if not args.dbinput == True:
-        templates = {}
-    templateentries = {}
-    templatebackground = {}
-    templatebackgroundtot = 0
-    Ntemplates = 0
-    seq = ""
-    name = "None"
-    oligolen = 16
+        outputfilename = args.outputfilename
+    else:  # If no output filename choose the same as the template filename
+        outputfilename = os.path.splitext(args.templatefilename)[0]
+    outputfile = open(outputfilename, "w")
+    if args.matrixfilename != None:
+        matrixfilename = args.matrixfilename
+    else:
+        matrixfilename = outputfilename + ".matrix"
     #
     # Read Template file
     #
-    # outputfile.write("%s\n" % ("# Reading database of templates"))
     if args.pickleinput == True:
-        templates = pickle.load(templatefile)
-        #templates = shelve.open(args.templatefilename, flag='c', protocol=2, writeback=False)
-    elif not args.dbinput == True:
-        for line in templatefile:
-            fields = line.split()
-            templates[fields[1]] = fields[2]
-            #
-            # Find number of Nmers in each template, and in total
-            #
-            matches = fields[2].split(",")
-            for match in matches:
-                if match in templatebackground:
-                    templatebackground[match] += 1
-                else:
-                    templatebackground[match] = 1
-                    Ntemplates += 1
-                templatebackgroundtot += 1
-                # print templatebackgroundtot
-        oligolen = len(fields[1])
-    #
-    # Search for matches
-    #
-    # outputfile.write("%s\n" % ("# making distance matrix"))
-    Nhits = 0
-    numbers = {}
-    names = {}
-    #nkmers = {}
-    nnumbers = 0
-    for submer in templates:
-            # print submer
-        matches = templates[submer].split(",")
-        for match in matches:
-            #      if match in nkmers:
-            #        nkmers[match] +=1
-            #      else:
-            #        nkmers[match] = 1
-            if not match in numbers:
-                numbers[match] = nnumbers
-        names[nnumbers] = match
-        nnumbers += 1
-    #
-    #
-    #
-    # for num in names:
-    #  print num, names[num]
-
-    #mat = [[0]*nnumbers]*nnumbers
-    mat = numpy.zeros((nnumbers, nnumbers))
-    # print mat
-    #nkmers = [0]*nnumbers
-    nkmers = numpy.zeros((nnumbers))
-    # max=0
-    for submer in templates:
-        # print submer
-        matches = templates[submer].split(",")
-        # print submer
-        for match1 in matches:
-            # print match1
-            for match2 in matches:
-                # print match2
-                mat[numbers[match1]][numbers[match2]] += 1
-        if match1 == match2:
-            nkmers[numbers[match1]] += 1
-        # print submer, match1, match2, mat[numbers[match1]][numbers[match2]], mat[numbers[match2]][numbers[match1]], nkmers[numbers[match1]], nkmers[numbers[match2]]
-            #mat[numbers[match2]][numbers[match1]] +=1
-        # if mat[numbers[match2]][numbers[match1]] > max:
-        #  max = mat[numbers[match2]][numbers[match1]]
-    #
-    #
-    #
-
-    # print mat
-
-    # print nkmers
-    #
-    # for nam in numbers:
-    #  print nam, numbers[nam], nkmers[numbers[nam]]
-        # print nam, numbers[nam]
+        # dict of k-mer -> comma separated template names:
+        with open(args.templatefilename, "rb") as templatefile:
+            templates = from_templates(pickle.load(templatefile), {}, {}, {})
+    elif (args.dbinput == True or is_database(args.templatefilename)
+          or os.path.exists(args.templatefilename + ".len.p")):
+        templates = open_database(args.templatefilename, merge=True)
+    else:
+        # lines of: number k-mer comma separated template names
+        kmers = {}
+        with open(args.templatefilename, "r") as templatefile:
+            for line in templatefile:
+                fields = line.split()
+                kmers[fields[1]] = fields[2]
+        templates = from_templates(kmers, {}, {}, {})
+    #
+    # Count shared k-mers of each pair of templates
+    #
+    nkmers = templates.kmer_counts()
+    mat = write_matrix(matrixfilename, templates, args.sketchscale,
+                       args.threads, args.blocksize)
+    # only templates with k-mers, in the order of their IDs:
+    keep = numpy.flatnonzero(nkmers > 0)
+    names = [templates.names[i] for i in keep.tolist()]
     #
     # write in column format
     #
     if args.columns == True:
-        for i in xrange(0, nnumbers):
-            mynamei = names[i][0:11]
-            for j in xrange(0, nnumbers):
-                mynamej = names[j][0:11]
-                #lmax = max(nkmers[names[i]],nkmers[names[j]])
-                #lmax = nkmers[names[i]]
-                if nkmers[i] > nkmers[j]:
-                    lmax = nkmers[i]
-                else:
-                    lmax = nkmers[j]
-                outputfile.write("%s %s %s %s %s %s\n" % (
-                    mynamei, mynamej, mat[i][j], nkmers[i], nkmers[j], lmax))
+        write_columns(outputfile, names, mat, nkmers, keep, args.blocksize)
     #
     # Write in neighbor format
     #
     else:
-        outputfile.write("%s\n" % (nnumbers))
-        for i in xrange(0, nnumbers):
-            mynamei = names[i][0:10]
-            outputfile.write("%-10s " % (mynamei))
-            for j in xrange(0, nnumbers):
-                mynamej = names[i][0:10]
-                #lmax = max(nkmers[names[i]],nkmers[names[j]])
-                #lmax = nkmers[names[i]]
-                if nkmers[i] > nkmers[j]:
-                    lmax = nkmers[i]
-                else:
-                    lmax = nkmers[j]
-                outputfile.write("%0.8f" % (1.0 - mat[i][j] / lmax))
-                if ((j + 1) % 6 == 0) or (j == nnumbers - 1):
-                    outputfile.write("\n")
-                else:
-                    outputfile.write(" ")
+        write_phylip(outputfile, names, mat, nkmers, keep, args.blocksize)
+    #
+    # Neighbor joining tree
+    #
+    if args.newickfilename != None:
+        tree = neighbor_joining(
+            distance_matrix(mat, nkmers, keep, args.blocksize), names)
+        with open(args.newickfilename, "w") as newickfile:
+            newickfile.write("%s\n" % (tree))
     #
     # Close files
     #
-    #t1 = time.time()
-    # sys.stdout.write("\r# %s entries (%s entries / s). Total time used %s seq" % ("{:,}".format(nnumbers), "{:,}".format(nnumbers / (t1-t0)),int(t1-t0)))
-    # sys.stdout.flush()
-    # sys.stdout.write("\n")
-    # print "# Closing files"
-    # inputfile.close()
-    # templatefile.close()
-    # outputfile.close()
+    outputfile.close()
+    del mat
+    if args.matrixfilename == None:
+        os.remove(matrixfilename)
+    t1 = time.time()
+    sys.stdout.write("# %s templates. Total time used %s sec\n" % (
+        "{:,}".format(len(names)), int(t1 - t0)))
 
 if __name__ == '__main__':
     makeTree()
@@ -0,0 +1,138 @@
+#!/usr/bin/env python3
+''' Find Template for a batch of samples
+
+Copyright (c) 2014, Ole Lund, Technical University of Denmark
+All rights reserved.
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+
+The sample sheet has one tab separated line per sample:
+
+    SAMPLE_ID   INFILE[,INFILE...]   OUTFILE
+
+Empty lines and lines starting with "#" are skipped. The template database
+is read once and every sample is written to its own OUTFILE in the format
+of findTemplate.
+'''
+import sys
+import os
+import time
+from argparse import ArgumentParser
+
+from kmerFinder.template.find import read_templates, read_query, write_matches
+
+##########################################################################
+# FUNCTIONS
+##########################################################################
+
+#--------------------------------------
+# read sample sheet:
+#--------------------------------------
+def read_samplesheet(samplesheetfilename):
+    ''' List of (sample ID, input files, output file) '''
+    samples = []
+    with open(samplesheetfilename, "r") as samplesheet:
+        for (lineno, line) in enumerate(samplesheet, 1):
+            if not line.strip() or line.startswith("#"):
+                continue
+            fields = line.rstrip("\r\n").split("\t")
+            if len(fields) != 3:
+                sys.exit("Line %s of %s should have 3 tab separated fields"
+                         % (lineno, samplesheetfilename))
+            samples.append((fields[0].strip(),
+                            [f.strip() for f in fields[1].split(",")],
+                            fields[2].strip()))
+    return samples
+
+##########################################################################
+#	DEFINE GLOBAL VARIABLES
+##########################################################################
+def findTemplateBatch():
+    ##########################################################################
+    # PARSE COMMAND LINE OPTIONS
+    ##########################################################################
+    parser = ArgumentParser()
+    parser.add_argument("-s", "--samplesheet", dest="samplesheetfilename", help="read samples from SHEET", metavar="SHEET")
+    parser.add_argument("-t", "--templatefile", dest="templatefilename", help="read from TEMFILE", metavar="TEMFILE")
+    parser.add_argument("-k", "--kmersize", dest="kmersize", help="Size of k-mer, default 16", metavar="KMERSIZE")
+    parser.add_argument("-x", "--prefix", dest="prefix", help="prefix, e.g. ATGAC, default none", metavar="_id")
+    parser.add_argument("-w", "--winnertakesitall", dest="wta", action="store_true", help="kmer hits are only assigned to most similar template")
+    parser.add_argument("-e", "--evalue", dest="evalue", help="Maximum E-value", metavar="EVALUE")
+    parser.add_argument("--threads", dest="threads", type=int, default=1, help="Count k-mers in THREADS processes, default 1", metavar="THREADS")
+    parser.add_argument("-q", "--minquality", dest="minquality", type=int, help="skip the k-mers covering FASTQ bases of Phred quality below MINQUALITY, default none", metavar="MINQUALITY")
+    parser.add_argument("--ambiguous", dest="ambiguous", action="store_true", help="count the k-mers covering N or masked bases as query k-mers in no template, as before packed k-mers, instead of skipping them; this lowers the coverage of reads with N")
+    parser.add_argument("--cache", dest="cachedir", help="keep the k-mer spectra of the samples in CACHEDIR and reuse them in later runs", metavar="CACHEDIR")
+    args = parser.parse_args()
+
+    if args.samplesheetfilename is None:
+        sys.exit("No sample sheet specified")
+    if args.templatefilename is None:
+        sys.exit("No template file specified")
+
+    # set up prefix filtering:
+    if args.prefix is not None:
+        prefix = args.prefix
+    else:
+        prefix = ''
+
+    # get e-value:
+    if args.evalue is not None:
+        evalue = float(args.evalue)
+    else:
+        evalue = float(0.05)
+
+    if args.kmersize is not None:
+        kmersize = int(args.kmersize)
+    else:
+        kmersize = None
+
+    samples = read_samplesheet(args.samplesheetfilename)
+    for (sample, inputfilenames, outputfilename) in samples:
+        for inputfilename in inputfilenames:
+            if not os.path.exists(inputfilename):
+                sys.exit("Input file %s of sample %s not found" % (
+                    inputfilename, sample))
+
+    ##########################################################################
+    # READ DATABASE OF TEMPLATES ONCE
+    ##########################################################################
+    t0 = time.time()
+    templates = read_templates(args.templatefilename, kmersize)
+    t1 = time.time()
+    sys.stdout.write("# Database read in %.2f sec\n" % (t1 - t0))
+
+    ##########################################################################
+    # SEARCH EACH SAMPLE
+    ##########################################################################
+    totalmers = 0
+    for (sample, inputfilenames, outputfilename) in samples:
+        sys.stdout.write("# Sample %s\n" % (sample))
+        ts = time.time()
+        query = read_query(templates, args.templatefilename, inputfilenames,
+                           prefix, args.threads, args.cachedir,
+                           args.minquality, args.ambiguous)
+        with open(outputfilename, "w") as outputfile:
+            write_matches(templates, query, outputfile, args.wta, evalue)
+        te = time.time()
+        totalmers += query.querymers
+        sys.stdout.write("# Sample %s: %s kmers in %.2f sec\n" % (
+            sample, "{:,}".format(query.querymers), te - ts))
+
+    t2 = time.time()
+    sys.stdout.write(("# %s samples, %s kmers. Database %.2f sec, samples "
+                      "%.2f sec (%.2f sec / sample), total %.2f sec\n") % (
+        len(samples), "{:,}".format(totalmers), t1 - t0, t2 - t1,
+        (t2 - t1) / max(len(samples), 1), t2 - t0))
+
+if __name__ == "__main__":
+    findTemplateBatch()
@@ -0,0 +1,617 @@
+#!/usr/bin/env python3
+''' Parallel database build
+
+Copyright (c) 2014, Ole Lund, Technical University of Denmark
+All rights reserved.
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+
+The build runs in two rounds of worker processes. First each entry
+(template) is given to a worker, which packs its k-mers and counts them.
+The worker keeps the distinct k-mers of many entries with their template
+IDs and writes them as one run, ordered by shard, the shard being chosen
+by a hash of the k-mer. Then each shard is merged by a worker into sorted
+k-mers with their template IDs, and the shards are merged into the
+database. Template IDs are given in input order, so the database does not
+depend on the number of jobs or on which worker finishes first.
+
+The external build keeps memory bounded instead: the distinct k-mers of
+the entries are collected as (k-mer, template ID) pairs until the memory
+budget is reached, then sorted and written as a run to a temporary file.
+The runs are merged block by block straight into the database files.
+Compaction merges the delta segments of a database the same way into a new
+generation of it, which replaces the old one when it is complete.
+'''
+import sys
+import os
+import shutil
+import tempfile
+import multiprocessing
+from collections import deque
+
+if sys.version_info < (3, 0):
+    from string import maketrans
+else:
+    maketrans = str.maketrans
+
+import numpy
+
+from kmerFinder.template.encoding import kmer_array, prefix_filter
+from kmerFinder.template.database import (KMER_DTYPE, CLASS_DTYPE,
+                                          OFFSET_DTYPE, TEMPLATE_DTYPE,
+                                          TemplateDB, kmer_postings,
+                                          equivalence_classes, write_meta,
+                                          database_meta, dump_meta, read_meta,
+                                          open_database, open_segment,
+                                          generation_filename, lock_database)
+from kmerFinder.template.prescreen import (prescreen_scale, remove_prescreen,
+                                           write_prescreen)
+from kmerFinder.template.lca import (stored_lineages, template_lineages,
+                                     remove_lca, write_lca)
+
+# multiplier of the k-mer hash (2^64 / golden ratio):
+_HASH = numpy.uint64(0x9E3779B97F4A7C15)
+
+# bytes of memory used per (k-mer, template ID) pair while sorting a run:
+PAIRSIZE = 32
+
+# (k-mer, template ID) pairs a worker keeps before it writes a run:
+RUNPAIRS = 1 << 24
+
+# keys of template sets with more than one template start here:
+_MULTIKEY = 1 << 32
+
+##########################################################################
+# FUNCTIONS
+##########################################################################
+
+def reversecomplement(seq):
+    ''' Reverse complement '''
+    return seq.translate(maketrans("ATGC", "TACG"))[::-1]
+
+def shard_of(kmers, Nshards):
+    ''' Shard of each packed k-mer '''
+    with numpy.errstate(over="ignore"):
+        hashes = kmers * _HASH
+    return (hashes >> numpy.uint64(32)) % numpy.uint64(Nshards)
+
+def entry_kmers(segments, kmersize, prefix='', stepsize=1, filters=None):
+    ''' Packed k-mers of both strands of each segment, starting every
+    stepsize bases, with prefix and not in the filter set filters
+    '''
+    return _entry_kmers(segments, kmersize, prefix, stepsize, filters)[0]
+
+def _entry_kmers(segments, kmersize, prefix='', stepsize=1, filters=None):
+    ''' Packed k-mers as entry_kmers, and the k-mers with ambiguous bases
+    (starting every stepsize bases, with prefix) as strings. Those can not
+    be packed, but are counted in the lengths of the templates as in
+    update_database of make.
+    '''
+    (prefixshift, prefixcode) = prefix_filter(prefix, kmersize)
+    stored = []
+    ambiguous = []
+    for s in segments:
+        for seq in [s, reversecomplement(s)]:
+            (kmers, valid) = kmer_array(seq, kmersize)
+            for start in (numpy.flatnonzero(~valid[::stepsize])
+                          * stepsize).tolist():
+                if seq.startswith(prefix, start):
+                    ambiguous.append(seq[start:start + kmersize])
+            kmers = kmers[::stepsize][valid[::stepsize]]
+            if prefixcode < 0:
+                # a prefix with ambiguous bases can never match:
+                kmers = kmers[:0]
+            elif prefix:
+                kmers = kmers[(kmers >> numpy.uint64(prefixshift))
+                              == numpy.uint64(prefixcode)]
+            if filters is not None:
+                kmers = kmers[~filters.contains(kmers)]
+            stored.append(kmers)
+    if not stored:
+        return (numpy.zeros(0, dtype=KMER_DTYPE), ambiguous)
+    return (numpy.concatenate(stored), ambiguous)
+
+#--------------------------------------
+# workers:
+#--------------------------------------
+_options = None
+_barrier = None
+_runs = None
+
+def _init_worker(options, barrier=None):
+    global _options, _barrier
+    _options = options
+    _barrier = barrier
+
+class _ShardRuns(object):
+    ''' Distinct k-mers of the entries of a worker with their template IDs,
+    written as runs ordered by shard, with the start of each shard
+    '''
+
+    def __init__(self, tmpdir, Nshards, maxpairs):
+        self.tmpdir = tmpdir
+        self.Nshards = Nshards
+        self.maxpairs = maxpairs
+        self.Nruns = 0
+        self.kmers = []
+        self.ids = []
+        self.Npairs = 0
+
+    def add(self, kmers, templateid):
+        ''' Add the k-mers of a template, writing a run when the memory
+        budget is reached
+        '''
+        self.kmers.append(kmers)
+        self.ids.append(numpy.full(kmers.size, templateid,
+                                   dtype=TEMPLATE_DTYPE))
+        self.Npairs += kmers.size
+        if self.Npairs >= self.maxpairs:
+            self.spill()
+
+    def spill(self):
+        ''' Write the pairs in memory as a run '''
+        if self.Npairs == 0:
+            return
+        kmers = numpy.concatenate(self.kmers)
+        ids = numpy.concatenate(self.ids)
+        self.kmers = []
+        self.ids = []
+        self.Npairs = 0
+        shards = shard_of(kmers, self.Nshards)
+        order = numpy.argsort(shards, kind="stable")
+        offsets = numpy.zeros(self.Nshards + 1, dtype=numpy.int64)
+        numpy.cumsum(numpy.bincount(shards.astype(numpy.int64),
+                                    minlength=self.Nshards),
+                     out=offsets[1:])
+        filename = os.path.join(self.tmpdir, "run.%s.%s" % (os.getpid(),
+                                                            self.Nruns))
+        numpy.save(filename + ".kmers.npy", kmers[order])
+        numpy.save(filename + ".ids.npy", ids[order])
+        numpy.save(filename + ".offsets.npy", offsets)
+        self.Nruns += 1
+
+def _entry_ukmers(args):
+    ''' Number of stored and of distinct k-mers of an entry, and its
+    distinct k-mers
+    '''
+    (entry, templateid, segments) = args
+    (tmpdir, Nshards, kmersize, prefix, stepsize, filters) = _options
+    (kmers, ambiguous) = _entry_kmers(segments, kmersize, prefix, stepsize,
+                                      filters)
+    ukmers = numpy.unique(kmers)
+    return (kmers.size + len(ambiguous), ukmers.size + len(set(ambiguous)),
+            ukmers)
+
+def _split_entry(args):
+    ''' Add the distinct k-mers of an entry to the runs of the worker and
+    return the number of stored and of distinct k-mers
+    '''
+    global _runs
+    (entry, templateid, segments) = args
+    (tmpdir, Nshards, kmersize, prefix, stepsize, filters) = _options
+    (Nkmers, Nukmers, ukmers) = _entry_ukmers(args)
+    if _runs is None:
+        _runs = _ShardRuns(tmpdir, Nshards, RUNPAIRS)
+    _runs.add(ukmers, templateid)
+    return (Nkmers, Nukmers, None)
+
+def _flush_runs(worker):
+    ''' Write the last run of a worker. Every worker waits for the others,
+    so each takes exactly one of these tasks.
+    '''
+    _barrier.wait()
+    if _runs is not None:
+        _runs.spill()
+    return worker
+
+def _merge_shard(args):
+    ''' Sorted k-mers of a shard with the number and IDs of their templates '''
+    (shard, runs) = args
+    tmpdir = _options[0]
+    kmers = [numpy.zeros(0, dtype=KMER_DTYPE)]
+    ids = [numpy.zeros(0, dtype=TEMPLATE_DTYPE)]
+    base = os.path.join(tmpdir, "%s.base.npz" % (shard))
+    if os.path.exists(base):
+        arrays = numpy.load(base)
+        kmers.append(arrays["kmers"])
+        ids.append(arrays["ids"])
+    for filename in runs:
+        offsets = numpy.load(filename + ".offsets.npy")
+        (start, stop) = (offsets[shard], offsets[shard + 1])
+        kmers.append(numpy.array(numpy.load(filename + ".kmers.npy",
+                                            mmap_mode="r")[start:stop]))
+        ids.append(numpy.array(numpy.load(filename + ".ids.npy",
+                                          mmap_mode="r")[start:stop]))
+    (ukmers, offsets, postings) = kmer_postings(numpy.concatenate(kmers),
+                                                numpy.concatenate(ids))
+    return (ukmers, numpy.diff(offsets), postings)
+
+##########################################################################
+# BUILD
+##########################################################################
+
+class _Templates(object):
+    ''' Names, lengths, unique lengths and descriptions of the templates
+    being built, starting from those of the TemplateDB templates if given.
+    New templates are numbered from firstid.
+    '''
+
+    def __init__(self, templates=None, firstid=0):
+        self.firstid = firstid
+        self.names = []
+        self.lengths = {}
+        self.ulengths = {}
+        self.descriptions = {}
+        if templates is not None:
+            self.names = list(templates.names)
+            self.lengths = dict(templates.lengths)
+            self.ulengths = dict(templates.ulengths)
+            self.descriptions = dict(templates.descriptions)
+        self.ids = dict((name, firstid + i)
+                        for i, name in enumerate(self.names))
+
+    def name(self, templateid):
+        return self.names[templateid - self.firstid]
+
+    def add(self, name, desc):
+        ''' Template ID of an entry, new names are numbered in input order '''
+        if name not in self.ids:
+            self.ids[name] = self.firstid + len(self.names)
+            self.names.append(name)
+        self.descriptions[name] = desc
+        return self.ids[name]
+
+def _run_entries(pool, worker, entries, found, jobs, report=None):
+    ''' Run worker((entry number, template ID, segments)) for every entry in
+    the pool
+    and yield (entry number, template ID, result) in input order. The
+    result starts with the number of stored and of distinct k-mers.
+    '''
+    pending = deque()
+
+    def collect():
+        (entry, templateid, result) = pending.popleft()
+        result = result.get()
+        name = found.name(templateid)
+        found.lengths[name] = result[0]
+        found.ulengths[name] = result[1]
+        if report is not None:
+            report(name, found.lengths[name], found.ulengths[name])
+        return (entry, templateid, result)
+
+    for (entry, (name, desc, segments)) in enumerate(entries):
+        templateid = found.add(name, desc)
+        pending.append((entry, templateid,
+                        pool.apply_async(worker,
+                                         ((entry, templateid, segments),))))
+        # keep a bounded number of entries in memory:
+        while len(pending) > 2 * jobs:
+            yield collect()
+    while pending:
+        yield collect()
+
+def build_database(entries, kmersize, prefix='', stepsize=1, filters=None,
+                   jobs=1, templates=None, report=None, firstid=0):
+    ''' Build a TemplateDB from (name, description, segments) entries in
+    jobs worker processes, adding to the TemplateDB templates if given.
+    report(name, lengths, ulengths) is called for each entry in input order.
+    New templates are numbered from firstid, for a delta segment.
+    Returns the database and the number of stored k-mers.
+    '''
+    found = _Templates(templates, firstid)
+    Nshards = jobs
+    tmpdir = tempfile.mkdtemp(prefix="kmerfinder.")
+    options = (tmpdir, Nshards, kmersize, prefix, stepsize, filters)
+    pool = multiprocessing.Pool(jobs, _init_worker,
+                                (options, multiprocessing.Barrier(jobs)))
+    Nstored = 0
+    try:
+        if templates is not None:
+            (basekmers, baseids) = templates.pairs()
+            shards = shard_of(basekmers, Nshards)
+            for shard in range(Nshards):
+                numpy.savez(os.path.join(tmpdir, "%s.base.npz" % (shard)),
+                            kmers=basekmers[shards == shard],
+                            ids=baseids[shards == shard])
+            del basekmers, baseids, shards
+
+        # extract the k-mers of each entry, in input order:
+        for (entry, templateid, result) in _run_entries(
+                pool, _split_entry, entries, found, jobs, report):
+            Nstored += result[0]
+        pool.map(_flush_runs, range(jobs), chunksize=1)
+        runs = sorted(os.path.join(tmpdir, name[:-len(".offsets.npy")])
+                      for name in os.listdir(tmpdir)
+                      if name.endswith(".offsets.npy"))
+
+        # merge each shard, then the shards:
+        shards = pool.map(_merge_shard,
+                          [(shard, runs) for shard in range(Nshards)])
+    finally:
+        pool.terminate()
+        shutil.rmtree(tmpdir, ignore_errors=True)
+
+    # the shards hold disjoint k-mers, sort them with their postings:
+    kmers = numpy.concatenate([shard[0] for shard in shards])
+    sizes = numpy.concatenate([shard[1] for shard in shards])
+    postings = numpy.concatenate([shard[2] for shard in shards])
+    starts = numpy.cumsum(sizes) - sizes
+    order = numpy.argsort(kmers, kind="stable")
+    (starts, sizes) = (starts[order], sizes[order])
+    index = numpy.repeat(starts - (numpy.cumsum(sizes) - sizes), sizes)
+    index += numpy.arange(index.size, dtype=index.dtype)
+    offsets = numpy.zeros(sizes.size + 1, dtype=numpy.int64)
+    numpy.cumsum(sizes, out=offsets[1:])
+    (classes, classoffsets, classpostings) = equivalence_classes(
+        offsets, postings[index])
+    names = found.names
+    db = TemplateDB(kmers[order], classes, classoffsets, classpostings, names,
+                    [found.lengths.get(name, 0) for name in names],
+                    [found.ulengths.get(name, 0) for name in names],
+                    [found.descriptions.get(name, '') for name in names],
+                    kmersize, prefix, firstid)
+    return (db, Nstored)
+
+##########################################################################
+# EXTERNAL BUILD
+##########################################################################
+
+class _Runs(object):
+    ''' Sorted (k-mer, template ID) runs in temporary files '''
+
+    def __init__(self, tmpdir, maxpairs):
+        self.tmpdir = tmpdir
+        self.maxpairs = maxpairs
+        self.files = []
+        self.kmers = []
+        self.ids = []
+        self.Npairs = 0
+
+    def add(self, kmers, ids):
+        ''' Add pairs, writing a run when the memory budget is reached '''
+        self.kmers.append(numpy.asarray(kmers, dtype=KMER_DTYPE))
+        self.ids.append(numpy.asarray(ids, dtype=TEMPLATE_DTYPE))
+        self.Npairs += len(kmers)
+        if self.Npairs >= self.maxpairs:
+            self.spill()
+
+    def spill(self):
+        ''' Sort the pairs in memory and write them as a run '''
+        if self.Npairs == 0:
+            return
+        kmers = numpy.concatenate(self.kmers)
+        ids = numpy.concatenate(self.ids)
+        self.kmers = []
+        self.ids = []
+        self.Npairs = 0
+        order = numpy.lexsort((ids, kmers))
+        filename = os.path.join(self.tmpdir, "run%s" % (len(self.files)))
+        numpy.save(filename + ".kmers.npy", kmers[order])
+        numpy.save(filename + ".ids.npy", ids[order])
+        self.files.append(filename)
+
+    def merged(self, blocksize):
+        ''' Iterate blocks of (k-mers, template IDs) of all runs in sorted
+        order. A k-mer is never split between blocks.
+        '''
+        self.spill()
+        runs = [(numpy.load(filename + ".kmers.npy", mmap_mode="r"),
+                 numpy.load(filename + ".ids.npy", mmap_mode="r"))
+                for filename in self.files]
+        positions = [0] * len(runs)
+        while True:
+            # the smallest last k-mer of the next block of any run bounds
+            # the k-mers that can be merged now:
+            bound = None
+            for (run, (kmers, ids)) in enumerate(runs):
+                end = positions[run] + blocksize
+                if end < len(kmers) and (bound is None or kmers[end] < bound):
+                    bound = kmers[end]
+            blockkmers = []
+            blockids = []
+            for (run, (kmers, ids)) in enumerate(runs):
+                start = positions[run]
+                if bound is None:
+                    end = len(kmers)
+                else:
+                    end = start + int(numpy.searchsorted(kmers[start:], bound,
+                                                         side="right"))
+                blockkmers.append(kmers[start:end])
+                blockids.append(ids[start:end])
+                positions[run] = end
+            kmers = numpy.concatenate(blockkmers)
+            if kmers.size > 0:
+                yield (kmers, numpy.concatenate(blockids))
+            if bound is None:
+                break
+
+class _ClassWriter(object):
+    ''' Write k-mers with their classes to database files, numbering the
+    classes in the order of the first k-mer having them
+    '''
+
+    def __init__(self, templatefilename):
+        self.templatefilename = templatefilename
+        self.files = {}
+        for suffix in [".kmers", ".classes", ".offsets", ".postings"]:
+            self.files[suffix] = open(templatefilename + suffix + ".tmp", "wb")
+        self.sets = {}
+        self.classids = {}
+        self.Npostings = 0
+        numpy.zeros(1, dtype=OFFSET_DTYPE).tofile(self.files[".offsets"])
+
+    def write(self, kmers, offsets, postings):
+        ''' Write sorted k-mers with the CSR offsets and postings of their
+        template sets
+        '''
+        sizes = numpy.diff(offsets)
+        # key of each template set, as in equivalence_classes:
+        keys = numpy.zeros(sizes.size, dtype=numpy.int64)
+        single = sizes == 1
+        keys[single] = postings[offsets[:-1][single]]
+        for row in numpy.flatnonzero(~single).tolist():
+            key = postings[offsets[row]:offsets[row + 1]].tobytes()
+            if key not in self.sets:
+                self.sets[key] = _MULTIKEY + len(self.sets)
+            keys[row] = self.sets[key]
+        # class of each key, new classes in the order they are first used:
+        (ukeys, first, inverse) = numpy.unique(keys, return_index=True,
+                                               return_inverse=True)
+        uclasses = numpy.empty(ukeys.size, dtype=CLASS_DTYPE)
+        newrows = []
+        for i in numpy.argsort(first, kind="stable").tolist():
+            key = int(ukeys[i])
+            if key not in self.classids:
+                self.classids[key] = len(self.classids)
+                newrows.append(first[i])
+            uclasses[i] = self.classids[key]
+        classes = uclasses[inverse.ravel()]
+        newrows = numpy.array(newrows, dtype=numpy.int64)
+        newsizes = sizes[newrows]
+        index = numpy.repeat(offsets[newrows] - (numpy.cumsum(newsizes)
+                                                 - newsizes), newsizes)
+        index += numpy.arange(index.size, dtype=index.dtype)
+        numpy.asarray(kmers, dtype=KMER_DTYPE).tofile(self.files[".kmers"])
+        classes.tofile(self.files[".classes"])
+        if newsizes.size > 0:
+            ends = self.Npostings + numpy.cumsum(newsizes)
+            ends.astype(OFFSET_DTYPE).tofile(self.files[".offsets"])
+            self.Npostings = int(ends[-1])
+            postings[index].astype(TEMPLATE_DTYPE).tofile(
+                self.files[".postings"])
+
+    def close(self):
+        ''' Move the files in place, the meta file is written after this '''
+        for suffix in self.files:
+            self.files[suffix].close()
+            os.rename(self.templatefilename + suffix + ".tmp",
+                      self.templatefilename + suffix)
+
+def build_database_external(templatefilename, entries, kmersize, prefix='',
+                            stepsize=1, filters=None, jobs=1, templates=None,
+                            report=None, memory=1024, firstid=0):
+    ''' Build and write the database templatefilename like build_database,
+    keeping about memory MB of (k-mer, template ID) pairs in memory.
+    Returns the number of stored k-mers.
+    '''
+    found = _Templates(templates, firstid)
+    maxpairs = max(1, memory * 1024 * 1024 // PAIRSIZE)
+    tmpdir = tempfile.mkdtemp(prefix="kmerfinder.")
+    options = (tmpdir, 1, kmersize, prefix, stepsize, filters)
+    pool = multiprocessing.Pool(jobs, _init_worker, (options,))
+    runs = _Runs(tmpdir, maxpairs)
+    Nstored = 0
+    try:
+        if templates is not None:
+            # the existing database, a block of k-mers at a time:
+            for start in range(0, len(templates), maxpairs):
+                runs.add(*templates.pairs(start, start + maxpairs))
+
+        for (entry, templateid, result) in _run_entries(
+                pool, _entry_ukmers, entries, found, jobs, report):
+            (Nkmers, Nukmers, ukmers) = result
+            runs.add(ukmers, numpy.full(ukmers.size, templateid,
+                                        dtype=TEMPLATE_DTYPE))
+            Nstored += Nkmers
+        pool.close()
+
+        # merge the runs, a block of each run at a time:
+        runs.spill()
+        blocksize = max(1, maxpairs // max(1, len(runs.files)))
+        writer = _ClassWriter(templatefilename)
+        for (kmers, ids) in runs.merged(blocksize):
+            writer.write(*kmer_postings(kmers, ids))
+        writer.close()
+    finally:
+        pool.terminate()
+        shutil.rmtree(tmpdir, ignore_errors=True)
+
+    write_meta(templatefilename, found.names, found.lengths, found.ulengths,
+               found.descriptions, kmersize, prefix, firstid)
+    return Nstored
+
+##########################################################################
+# COMPACTION
+##########################################################################
+
+def compact_database(templatefilename, memory=1024):
+    ''' Merge the delta segments of templatefilename into a new generation
+    of it, keeping about memory MB of (k-mer, template ID) pairs in memory.
+    The database is searched as before until its meta file is replaced by
+    the one of the new generation. Returns the number of segments merged.
+    '''
+    lockfile = lock_database(templatefilename)
+    try:
+        meta = read_meta(templatefilename)
+        templates = open_database(templatefilename)
+        segments = templates.segments
+        if len(segments) == 1:
+            return 0
+        generation = meta.get("generation", 0) + 1
+        filename = generation_filename(templatefilename, generation)
+        # files left by a compaction that did not finish:
+        remove_prescreen(filename)
+        remove_lca(filename)
+        maxpairs = max(1, memory * 1024 * 1024 // PAIRSIZE)
+        tmpdir = tempfile.mkdtemp(prefix="kmerfinder.")
+        try:
+            runs = _Runs(tmpdir, maxpairs)
+            for segment in segments:
+                for start in range(0, len(segment), maxpairs):
+                    runs.add(*segment.pairs(start, start + maxpairs))
+            runs.spill()
+            blocksize = max(1, maxpairs // max(1, len(runs.files)))
+            writer = _ClassWriter(filename)
+            for (kmers, ids) in runs.merged(blocksize):
+                writer.write(*kmer_postings(kmers, ids))
+            writer.close()
+        finally:
+            shutil.rmtree(tmpdir, ignore_errors=True)
+
+        newmeta = database_meta(templates.names, templates.lengths,
+                                templates.ulengths, templates.descriptions,
+                                templates.kmersize, templates.prefix,
+                                generation=generation,
+                                firstdelta=meta.get("firstdelta", 1)
+                                + len(segments) - 1)
+        # the prescreen and LCA indexes of the new generation are written
+        # before it is used:
+        base = segments[0].filename
+        segment = open_segment(templatefilename, newmeta)
+        scale = prescreen_scale(base)
+        if scale is not None:
+            write_prescreen(filename, segment, scale)
+        lineages = stored_lineages(templates)
+        if lineages:
+            write_lca(filename, segment,
+                      template_lineages(lineages, templates.names))
+        dump_meta(templatefilename, newmeta)
+
+        # the old generation and the merged segments are no longer read,
+        # searches that have them open keep them until they are done:
+        for suffix in [".kmers", ".classes", ".offsets", ".postings"]:
+            if os.path.exists(base + suffix):
+                os.remove(base + suffix)
+        remove_prescreen(base)
+        remove_lca(base)
+        # the newest segment first, each without its meta file is ignored:
+        for delta in reversed(segments[1:]):
+            for suffix in [".meta.p", ".kmers", ".classes", ".offsets",
+                           ".postings"]:
+                if os.path.exists(delta.filename + suffix):
+                    os.remove(delta.filename + suffix)
+            remove_prescreen(delta.filename)
+            remove_lca(delta.filename)
+        return len(segments) - 1
+    finally:
+        lockfile.close()
@@ -0,0 +1,58 @@
+#!/usr/bin/env python3
+''' Compact a template database
+
+Copyright (c) 2014, Ole Lund, Technical University of Denmark
+All rights reserved.
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+
+Templates added with "maketemplatedb -a TEMFILE --delta" are kept in delta
+segments next to TEMFILE, which findTemplate searches together with it.
+Compaction merges TEMFILE and the segments into a new generation of it,
+with its prescreen and LCA indexes, and then switches to it by replacing
+TEMFILE.meta.p and removes the old files. Searches started before the
+switch keep the old generation they have open. New delta segments wait
+until the compaction is done.
+'''
+import sys
+import time
+from argparse import ArgumentParser
+
+from kmerFinder.template.database import is_database
+from kmerFinder.template.build import compact_database
+
+##########################################################################
+#	DEFINE GLOBAL VARIABLES
+##########################################################################
+def compactTemplateDB():
+    ##########################################################################
+    # PARSE COMMAND LINE OPTIONS
+    ##########################################################################
+    parser = ArgumentParser()
+    parser.add_argument("-t", "--templatefile", dest="templatefilename", help="compact TEMFILE", metavar="TEMFILE")
+    parser.add_argument("-m", "--memory", dest="memory", type=int, default=1024, help="merge with about MEMORY MB of k-mers in memory, default 1024", metavar="MEMORY")
+    args = parser.parse_args()
+
+    if args.templatefilename is None:
+        sys.exit("No template file specified")
+    if not is_database(args.templatefilename):
+        sys.exit("%s is not a database in the memory-mapped format" % (
+            args.templatefilename))
+
+    t0 = time.time()
+    Nsegments = compact_database(args.templatefilename, args.memory)
+    sys.stdout.write("# %s delta segments merged in %.2f sec\n" % (
+        Nsegments, time.time() - t0))
+
+if __name__ == "__main__":
+    compactTemplateDB()
@@ -0,0 +1,624 @@
+#!/usr/bin/env python3
+''' Template database
+
+Copyright (c) 2014, Ole Lund, Technical University of Denmark
+All rights reserved.
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+
+A database TEMFILE is stored in five files:
+
+    TEMFILE.kmers     sorted packed k-mers (uint64)
+    TEMFILE.classes   equivalence class of each k-mer (uint32)
+    TEMFILE.offsets   start of the postings of each class, CSR style (int64)
+    TEMFILE.postings  template IDs of each class (uint32)
+    TEMFILE.meta.p    k-mer size, prefix and the names, lengths, unique
+                      lengths and descriptions of the templates by ID
+
+An equivalence class is a distinct set of templates; most k-mers share
+their set with many others, so each set is stored once and numbered in the
+order of the first k-mer having it. Databases of version 1 have no classes
+file, there every k-mer is its own class.
+
+New templates can be added as delta segments TEMFILE.delta.1,
+TEMFILE.delta.2, ... in the same format, without rewriting TEMFILE. The
+templates of a segment are numbered after those of the segments before it
+and a k-mer may be in several segments; open_database reads them all as one
+SegmentedDB and compact_database in build merges them.
+
+Compaction writes the merged arrays as a new generation G, in files
+TEMFILE.gen.G.kmers, ... with their indexes, while the old ones are still
+searched. TEMFILE.meta.p then names the generation and the first delta
+segment not merged into it, so replacing it switches to the new generation
+and drops the merged segments at once. A delta segment is written under
+another name and moved in place with its indexes, its meta file last.
+Writers of delta segments and compaction hold the lock TEMFILE.lock.
+
+The arrays are memory-mapped read-only, so opening a database is
+independent of its size and the pages are shared between processes
+searching the same database. Databases in the old format (TEMFILE.p,
+TEMFILE.len.p, TEMFILE.ulen.p and TEMFILE.desc.p) are still read, but have
+to be converted in memory.
+'''
+import sys
+import os
+import fcntl
+from array import array
+
+import numpy
+
+from kmerFinder.template.encoding import encode_kmer, encode_kmers, decode_kmer
+
+if sys.version_info < (3, 0):
+    import cPickle as pickle
+else:
+    import pickle
+
+FORMAT_VERSION = 2
+
+KMER_DTYPE = numpy.uint64
+CLASS_DTYPE = numpy.uint32
+OFFSET_DTYPE = numpy.int64
+TEMPLATE_DTYPE = numpy.uint32
+
+##########################################################################
+# TEMPLATE DATABASE
+##########################################################################
+
+class TemplateDB(object):
+    ''' Sorted k-mer array with the equivalence class of each k-mer and the
+    IDs of the templates in each class. Template statistics are kept as dicts
+    keyed by template name, as in the pickled databases.
+    '''
+
+    def __init__(self, kmers, classes, offsets, postings, names, lengths,
+                 ulengths, descriptions, kmersize, prefix='', firstid=0):
+        self.kmers = kmers
+        self.classes = classes
+        self.offsets = offsets
+        self.postings = postings
+        self.names = list(names)
+        # ID of the first template, above 0 in delta segments:
+        self.firstid = firstid
+        self.ids = dict((name, firstid + i)
+                        for i, name in enumerate(self.names))
+        # file the segment was opened from, None if built in memory:
+        self.filename = None
+        self.lengths = dict(zip(self.names, lengths))
+        self.ulengths = dict(zip(self.names, ulengths))
+        self.descriptions = dict(zip(self.names, descriptions))
+        self.kmersize = kmersize
+        self.prefix = prefix
+
+    def __len__(self):
+        return len(self.kmers)
+
+    def __contains__(self, kmer):
+        return self.lookup([kmer])[0] >= 0
+
+    def lookup(self, kmers):
+        ''' Row of each packed k-mer in the database, -1 if not present '''
+        kmers = numpy.asarray(kmers, dtype=KMER_DTYPE)
+        rows = numpy.searchsorted(self.kmers, kmers)
+        rows[rows == len(self.kmers)] = 0
+        found = len(self.kmers) > 0
+        if found:
+            found = self.kmers[rows] == kmers
+        return numpy.where(found, rows, -1)
+
+    @property
+    def Nclasses(self):
+        return len(self.offsets) - 1
+
+    @property
+    def segments(self):
+        return [self]
+
+    def found(self, kmers):
+        ''' True for each packed k-mer in the database '''
+        return self.lookup(kmers) >= 0
+
+    def postings_of_kmers(self, kmers):
+        ''' Template IDs of several packed k-mers, concatenated, and the
+        number of IDs of each k-mer, 0 if not present
+        '''
+        rows = self.lookup(kmers)
+        found = rows >= 0
+        sizes = numpy.zeros(rows.size, dtype=numpy.int64)
+        (ids, sizes[found]) = self.postings_of(rows[found])
+        return (ids, sizes)
+
+    def kmer_sizes(self, kmers):
+        ''' Number of templates of several packed k-mers, 0 if not present '''
+        rows = self.lookup(kmers)
+        found = rows >= 0
+        sizes = numpy.zeros(rows.size, dtype=numpy.int64)
+        classes = self.classes[rows[found]]
+        sizes[found] = self.offsets[classes + 1] - self.offsets[classes]
+        return sizes
+
+    def matches(self, row):
+        ''' Template IDs of a single k-mer row '''
+        cls = self.classes[row]
+        return self.postings[self.offsets[cls]:self.offsets[cls + 1]]
+
+    def postings_of(self, rows):
+        ''' Template IDs of several k-mer rows, concatenated, and the number
+        of IDs contributed by each row
+        '''
+        return self.class_postings(self.classes[rows])
+
+    def class_postings(self, classes):
+        ''' Template IDs of several classes, concatenated, and the number
+        of IDs contributed by each class
+        '''
+        classes = numpy.asarray(classes, dtype=numpy.int64)
+        starts = self.offsets[classes]
+        sizes = self.offsets[classes + 1] - starts
+        # position of every posting: start of its class + rank within it
+        index = numpy.repeat(starts - (numpy.cumsum(sizes) - sizes), sizes)
+        index += numpy.arange(index.size, dtype=index.dtype)
+        return (self.postings[index], sizes)
+
+    def pairs(self, start=0, stop=None):
+        ''' (k-mer, template ID) pairs of the k-mer rows start to stop as two
+        arrays, sorted by k-mer and template ID
+        '''
+        if stop is None or stop > len(self.kmers):
+            stop = len(self.kmers)
+        (ids, sizes) = self.postings_of(numpy.arange(start, stop))
+        return (numpy.repeat(self.kmers[start:stop], sizes), ids)
+
+    def kmer_counts(self):
+        ''' Number of distinct k-mers of each template ID '''
+        classsizes = numpy.bincount(self.classes, minlength=self.Nclasses)
+        return numpy.bincount(
+            self.postings, minlength=self.firstid + len(self.names),
+            weights=numpy.repeat(classsizes, numpy.diff(self.offsets))
+            )[self.firstid:].astype(numpy.int64)
+
+    def items(self):
+        ''' Iterate (k-mer, template names) like the old dict database '''
+        for row in range(len(self.kmers)):
+            yield (decode_kmer(int(self.kmers[row]), self.kmersize),
+                   [self.names[i - self.firstid] for i in self.matches(row)])
+
+    def merged(self):
+        return self
+
+class SegmentedDB(object):
+    ''' A database with delta segments, searched like one TemplateDB.
+    Segments have disjoint templates, so the template IDs of a k-mer are the
+    IDs it has in each segment.
+    '''
+
+    def __init__(self, segments):
+        self.segments = segments
+        self.names = []
+        self.ids = {}
+        self.lengths = {}
+        self.ulengths = {}
+        self.descriptions = {}
+        for segment in segments:
+            self.names.extend(segment.names)
+            self.ids.update(segment.ids)
+            self.lengths.update(segment.lengths)
+            self.ulengths.update(segment.ulengths)
+            self.descriptions.update(segment.descriptions)
+        self.kmersize = segments[0].kmersize
+        self.prefix = segments[0].prefix
+
+    def __contains__(self, kmer):
+        return self.found([kmer])[0]
+
+    def found(self, kmers):
+        ''' True for each packed k-mer in any segment '''
+        found = self.segments[0].found(kmers)
+        for segment in self.segments[1:]:
+            found |= segment.found(kmers)
+        return found
+
+    def postings_of_kmers(self, kmers):
+        ''' Template IDs of several packed k-mers, concatenated, and the
+        number of IDs of each k-mer, 0 if not present
+        '''
+        kmers = numpy.asarray(kmers, dtype=KMER_DTYPE)
+        ids = []
+        owners = []
+        sizes = numpy.zeros(kmers.size, dtype=numpy.int64)
+        for segment in self.segments:
+            (segmentids, segmentsizes) = segment.postings_of_kmers(kmers)
+            ids.append(segmentids)
+            owners.append(numpy.repeat(numpy.arange(kmers.size),
+                                       segmentsizes))
+            sizes += segmentsizes
+        # the IDs of each k-mer together, segment by segment:
+        order = numpy.argsort(numpy.concatenate(owners), kind="stable")
+        return (numpy.concatenate(ids)[order], sizes)
+
+    def kmer_sizes(self, kmers):
+        ''' Number of templates of several packed k-mers, 0 if not present '''
+        sizes = self.segments[0].kmer_sizes(kmers)
+        for segment in self.segments[1:]:
+            sizes += segment.kmer_sizes(kmers)
+        return sizes
+
+    def pairs(self):
+        ''' All (k-mer, template ID) pairs as two arrays, unsorted '''
+        pairs = [segment.pairs() for segment in self.segments]
+        return (numpy.concatenate([pair[0] for pair in pairs]),
+                numpy.concatenate([pair[1] for pair in pairs]))
+
+    def merged(self):
+        ''' The segments merged into one in-memory TemplateDB '''
+        (kmers, classes, offsets, postings) = postings_from_pairs(
+            *self.pairs())
+        return TemplateDB(kmers, classes, offsets, postings, self.names,
+                          [self.lengths[name] for name in self.names],
+                          [self.ulengths[name] for name in self.names],
+                          [self.descriptions[name] for name in self.names],
+                          self.kmersize, self.prefix)
+
+#-------------------------------------
+# build arrays from (k-mer, template) pairs:
+#-------------------------------------
+def postings_from_pairs(kmers, templateids):
+    ''' Sort (k-mer, template ID) pairs and return the unique k-mers, their
+    classes and the CSR offsets and postings of the classes
+    '''
+    (ukmers, offsets, postings) = kmer_postings(kmers, templateids)
+    return (ukmers,) + equivalence_classes(offsets, postings)
+
+def kmer_postings(kmers, templateids):
+    ''' Sort (k-mer, template ID) pairs and return the unique k-mers, the
+    CSR offsets and the postings of each k-mer without repeated template IDs
+    '''
+    kmers = numpy.asarray(kmers, dtype=KMER_DTYPE)
+    templateids = numpy.asarray(templateids, dtype=TEMPLATE_DTYPE)
+    order = numpy.lexsort((templateids, kmers))
+    kmers = kmers[order]
+    templateids = templateids[order]
+    if kmers.size > 0:
+        keep = numpy.empty(kmers.size, dtype=bool)
+        keep[0] = True
+        keep[1:] = ((kmers[1:] != kmers[:-1])
+                    | (templateids[1:] != templateids[:-1]))
+        kmers = kmers[keep]
+        templateids = templateids[keep]
+    (ukmers, starts) = numpy.unique(kmers, return_index=True)
+    offsets = numpy.empty(ukmers.size + 1, dtype=OFFSET_DTYPE)
+    offsets[:-1] = starts
+    offsets[-1] = kmers.size
+    return (ukmers, offsets, templateids)
+
+def equivalence_classes(offsets, postings):
+    ''' Replace the postings of each k-mer (CSR offsets and postings) by the
+    class of its template set and return the classes, and the offsets and
+    postings of the classes
+    '''
+    sizes = numpy.diff(offsets)
+    # key of each template set: the template ID of single sets, new numbers
+    # above all template IDs for the others
+    keys = numpy.zeros(sizes.size, dtype=numpy.int64)
+    single = sizes == 1
+    keys[single] = postings[offsets[:-1][single]]
+    sets = {}
+    base = int(postings.max()) + 1 if postings.size > 0 else 0
+    # slice the bytes of the postings, numpy slices are slow one at a time:
+    data = memoryview(numpy.ascontiguousarray(postings)).cast("B")
+    bounds = (offsets.astype(numpy.int64) * postings.itemsize).tolist()
+    rows = numpy.flatnonzero(~single)
+    rowkeys = []
+    for row in rows.tolist():
+        key = data[bounds[row]:bounds[row + 1]].tobytes()
+        if key not in sets:
+            sets[key] = base + len(sets)
+        rowkeys.append(sets[key])
+    keys[rows] = rowkeys
+    # number the classes in the order they are first used:
+    (ukeys, first, inverse) = numpy.unique(keys, return_index=True,
+                                           return_inverse=True)
+    order = numpy.argsort(first, kind="stable")
+    rank = numpy.empty(order.size, dtype=CLASS_DTYPE)
+    rank[order] = numpy.arange(order.size, dtype=CLASS_DTYPE)
+    classes = rank[inverse.ravel()]
+    # the postings of each class are those of its first k-mer:
+    rows = first[order]
+    classoffsets = numpy.zeros(rows.size + 1, dtype=OFFSET_DTYPE)
+    numpy.cumsum(sizes[rows], out=classoffsets[1:])
+    index = numpy.repeat(offsets[rows] - classoffsets[:-1], sizes[rows])
+    index += numpy.arange(index.size, dtype=index.dtype)
+    return (classes, classoffsets, postings[index])
+
+def from_templates(templates, lengths, ulengths, descriptions, kmersize=None,
+                   prefix=''):
+    ''' Build an in-memory TemplateDB from the old dict layout: k-mer string
+    -> comma separated template names. K-mers with ambiguous bases are
+    dropped, they can not be packed.
+    '''
+    names = list(lengths)
+    ids = dict((name, i) for i, name in enumerate(names))
+    pairkmers = []
+    pairids = []
+    for submer in templates:
+        if kmersize is None:
+            kmersize = len(submer)
+        try:
+            code = encode_kmer(submer)
+        except ValueError:
+            continue
+        for match in set(templates[submer].split(",")):
+            if match not in ids:
+                ids[match] = len(names)
+                names.append(match)
+            pairkmers.append(code)
+            pairids.append(ids[match])
+    (kmers, classes, offsets, postings) = postings_from_pairs(pairkmers,
+                                                              pairids)
+    if kmersize is None:
+        kmersize = 16
+    return TemplateDB(kmers, classes, offsets, postings, names,
+                      [lengths.get(name, 0) for name in names],
+                      [ulengths.get(name, 0) for name in names],
+                      [descriptions.get(name, '') for name in names],
+                      kmersize, prefix)
+
+def from_template_ids(templates, names, lengths, ulengths, descriptions,
+                      kmersize, prefix='', firstid=0):
+    ''' Build an in-memory TemplateDB from a dict of k-mer string ->
+    template ID, or an array of template IDs for shared k-mers. K-mers with
+    ambiguous bases are dropped. The IDs of names start at firstid.
+    '''
+    (codes, valid) = encode_kmers(list(templates), kmersize)
+    pairids = array("I")
+    sizes = array("I")
+    for matches in templates.values():
+        if isinstance(matches, array):
+            pairids.extend(matches)
+            sizes.append(len(matches))
+        else:
+            pairids.append(matches)
+            sizes.append(1)
+    sizes = numpy.frombuffer(sizes, dtype=numpy.uint32)
+    keep = numpy.repeat(valid, sizes)
+    pairkmers = numpy.repeat(codes, sizes)[keep]
+    pairids = numpy.frombuffer(pairids, dtype=numpy.uint32)[keep]
+    (kmers, classes, offsets, postings) = postings_from_pairs(pairkmers,
+                                                              pairids)
+    return TemplateDB(kmers, classes, offsets, postings, names,
+                      [lengths.get(name, 0) for name in names],
+                      [ulengths.get(name, 0) for name in names],
+                      [descriptions.get(name, '') for name in names],
+                      kmersize, prefix, firstid)
+
+#-------------------------------------
+# read database:
+#-------------------------------------
+def _map_array(filename, dtype):
+    ''' Memory-map a flat binary array read-only '''
+    if os.path.getsize(filename) == 0:
+        return numpy.zeros(0, dtype=dtype)
+    return numpy.memmap(filename, dtype=dtype, mode="r")
+
+def is_database(templatefilename):
+    ''' True if templatefilename is a database in the memory-mapped format '''
+    return os.path.exists(templatefilename + ".meta.p")
+
+def read_meta(templatefilename):
+    ''' Read the meta file of a database or delta segment '''
+    with open(templatefilename + ".meta.p", "rb") as metafile:
+        return pickle.load(metafile)
+
+def generation_filename(templatefilename, generation):
+    ''' Name of the arrays of a generation of a database, generation 0 is
+    the database as first written
+    '''
+    if generation == 0:
+        return templatefilename
+    return "%s.gen.%s" % (templatefilename, generation)
+
+def base_filename(templatefilename):
+    ''' Name of the arrays and indexes of the current generation '''
+    if not is_database(templatefilename):
+        return templatefilename
+    return generation_filename(templatefilename,
+                               read_meta(templatefilename).get("generation",
+                                                               0))
+
+def delta_filename(templatefilename, number):
+    ''' Name of delta segment number of a database '''
+    return "%s.delta.%s" % (templatefilename, number)
+
+def delta_filenames(templatefilename, first=None):
+    ''' Names of the complete delta segments of a database from number
+    first, by default the first not merged into the database, in order
+    '''
+    if first is None:
+        first = read_meta(templatefilename).get("firstdelta", 1)
+    filenames = []
+    while is_database(delta_filename(templatefilename,
+                                     first + len(filenames))):
+        filenames.append(delta_filename(templatefilename,
+                                        first + len(filenames)))
+    return filenames
+
+def new_delta_filename(templatefilename):
+    ''' Name of the next delta segment of a database '''
+    first = read_meta(templatefilename).get("firstdelta", 1)
+    return delta_filename(templatefilename, first + len(
+        delta_filenames(templatefilename, first)))
+
+def move_segment(filename, templatefilename):
+    ''' Move the files of the segment filename and its indexes to
+    templatefilename, the meta file of the segment last
+    '''
+    directory = os.path.dirname(filename)
+    prefix = os.path.basename(filename) + "."
+    suffixes = [name[len(prefix):] for name in os.listdir(directory or ".")
+                if name.startswith(prefix)]
+    for suffix in sorted(suffixes, key=lambda suffix: suffix == "meta.p"):
+        os.rename(os.path.join(directory, prefix + suffix),
+                  templatefilename + "." + suffix)
+
+def lock_database(templatefilename):
+    ''' Wait for the lock of a database and return the open lock file,
+    the lock is released when it is closed
+    '''
+    lockfile = open(templatefilename + ".lock", "a")
+    try:
+        fcntl.flock(lockfile, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except (IOError, OSError):
+        sys.stdout.write("# Waiting for the lock of %s\n" % (
+            templatefilename))
+        sys.stdout.flush()
+        fcntl.flock(lockfile, fcntl.LOCK_EX)
+    return lockfile
+
+def _generation(meta):
+    return (meta.get("generation", 0), meta.get("firstdelta", 1))
+
+def open_database(templatefilename, merge=False):
+    ''' Open a template database in either format, with its delta segments
+    as a SegmentedDB, or merged into one TemplateDB in memory if merge
+    '''
+    if not is_database(templatefilename):
+        return load_pickled_database(templatefilename)
+    while True:
+        meta = read_meta(templatefilename)
+        error = None
+        try:
+            segments = [open_segment(templatefilename, meta)]
+            for filename in delta_filenames(templatefilename,
+                                            meta.get("firstdelta", 1)):
+                segments.append(open_segment(filename))
+        except (IOError, OSError) as e:
+            error = e
+        # a compaction may have switched to a new generation meanwhile and
+        # removed the files of this one, the new one is opened then:
+        if _generation(read_meta(templatefilename)) == _generation(meta):
+            break
+    if error is not None:
+        raise error
+    if len(segments) == 1:
+        return segments[0]
+    if merge:
+        return SegmentedDB(segments).merged()
+    return SegmentedDB(segments)
+
+def open_segment(templatefilename, meta=None):
+    ''' Open one segment of a database, with the meta given or read from
+    its meta file
+    '''
+    if meta is None:
+        meta = read_meta(templatefilename)
+    if meta["version"] > FORMAT_VERSION:
+        sys.exit("Database %s was written by a newer version" % (
+            templatefilename))
+    filename = generation_filename(templatefilename,
+                                   meta.get("generation", 0))
+    kmers = _map_array(filename + ".kmers", KMER_DTYPE)
+    if meta["version"] >= 2:
+        classes = _map_array(filename + ".classes", CLASS_DTYPE)
+    else:
+        classes = numpy.arange(len(kmers), dtype=CLASS_DTYPE)
+    db = TemplateDB(
+        kmers, classes,
+        _map_array(filename + ".offsets", OFFSET_DTYPE),
+        _map_array(filename + ".postings", TEMPLATE_DTYPE),
+        meta["names"], meta["lengths"], meta["ulengths"],
+        meta["descriptions"], meta["kmersize"], meta["prefix"],
+        meta.get("firstid", 0))
+    # the indexes of the segment are named after its arrays:
+    db.filename = filename
+    return db
+
+def load_pickled_database(templatefilename):
+    ''' Read the four pickles of the old database format '''
+    with open(templatefilename + ".p", "rb") as templatefile:
+        templates = pickle.load(templatefile)
+    with open(templatefilename + ".len.p", "rb") as templatefile_lengths:
+        lengths = pickle.load(templatefile_lengths)
+    try:
+        with open(templatefilename + ".ulen.p", "rb") as templatefile_ulengths:
+            ulengths = pickle.load(templatefile_ulengths)
+    except IOError:
+        sys.stderr.write('No ulen.p file found for database\n')
+        ulengths = lengths
+    with open(templatefilename + ".desc.p", "rb") as templatefile_descriptions:
+        descriptions = pickle.load(templatefile_descriptions)
+    return from_templates(templates, lengths, ulengths, descriptions)
+
+#-------------------------------------
+# write database:
+#-------------------------------------
+def _write_array(filename, array, dtype):
+    ''' Write a flat binary array next to its final name and move it in
+    place, so readers never see a partial file
+    '''
+    numpy.ascontiguousarray(array, dtype=dtype).tofile(filename + ".tmp")
+    os.rename(filename + ".tmp", filename)
+
+def write_database(templatefilename, db):
+    ''' Write a TemplateDB in the memory-mapped format. The meta file is
+    written last and marks the database as complete.
+    '''
+    _write_array(templatefilename + ".kmers", db.kmers, KMER_DTYPE)
+    _write_array(templatefilename + ".classes", db.classes, CLASS_DTYPE)
+    _write_array(templatefilename + ".offsets", db.offsets, OFFSET_DTYPE)
+    _write_array(templatefilename + ".postings", db.postings, TEMPLATE_DTYPE)
+    write_meta(templatefilename, db.names, db.lengths, db.ulengths,
+               db.descriptions, db.kmersize, db.prefix, db.firstid)
+
+def database_meta(names, lengths, ulengths, descriptions, kmersize, prefix,
+                  firstid=0, generation=0, firstdelta=1):
+    ''' Meta of a database, with the generation of its arrays and the first
+    delta segment not merged into them
+    '''
+    meta = {
+        "version": FORMAT_VERSION,
+        "kmersize": kmersize,
+        "prefix": prefix,
+        "names": names,
+        "lengths": [lengths[name] for name in names],
+        "ulengths": [ulengths[name] for name in names],
+        "descriptions": [descriptions[name] for name in names],
+    }
+    if firstid:
+        meta["firstid"] = firstid
+    if generation:
+        meta["generation"] = generation
+    if firstdelta != 1:
+        meta["firstdelta"] = firstdelta
+    return meta
+
+def dump_meta(templatefilename, meta):
+    ''' Replace the meta file of a database in one rename '''
+    with open(templatefilename + ".meta.p.tmp", "wb") as metafile:
+        pickle.dump(meta, metafile, 2)
+    os.rename(templatefilename + ".meta.p.tmp", templatefilename + ".meta.p")
+
+def write_meta(templatefilename, names, lengths, ulengths, descriptions,
+               kmersize, prefix, firstid=0):
+    ''' Write the meta file of a database, the other files must be in place
+    '''
+    dump_meta(templatefilename, database_meta(names, lengths, ulengths,
+                                              descriptions, kmersize, prefix,
+                                              firstid))
+
+def write_pickled_database(templatefilename, templates, lengths, ulengths,
+                           descriptions):
+    ''' Write the four pickles of the old database format '''
+    for suffix, obj in [(".p", templates), (".len.p", lengths),
+                        (".ulen.p", ulengths), (".desc.p", descriptions)]:
+        with open(templatefilename + suffix, "wb") as outputfile:
+            pickle.dump(obj, outputfile, 2)
@@ -0,0 +1,187 @@
+#!/usr/bin/env python3
+''' K-mer encoding
+
+Copyright (c) 2014, Ole Lund, Technical University of Denmark
+All rights reserved.
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+
+K-mers are packed two bits per base (A=0, C=1, G=2, T=3) with the first base
+in the most significant bits, so k-mers up to 32 bases fit in 64 bits and the
+complement of a base is 3 - code.
+'''
+import sys
+import re
+
+import numpy
+
+if sys.version_info < (3, 0):
+    from string import maketrans
+else:
+    maketrans = str.maketrans
+
+MAXKMERSIZE = 32
+
+# base -> 2-bit code, every other byte (N, IUPAC codes, ...) -> 4:
+_CODES = bytearray([4] * 256)
+for _i, _base in enumerate("ACGT"):
+    _CODES[ord(_base)] = _i
+    _CODES[ord(_base.lower())] = _i
+_CODES = bytes(_CODES)
+
+_DIGITS = maketrans("ACGTacgt", "01230123")
+
+_COMPLEMENT = maketrans("ACGTacgt", "TGCAtgca")
+
+# stretches of ACGT long enough to hold a k-mer, by k-mer size:
+_STRETCHES = {}
+
+##########################################################################
+# FUNCTIONS
+##########################################################################
+
+#--------------------------------------
+# pack / unpack a single k-mer:
+#--------------------------------------
+def encode_kmer(kmer):
+    ''' Pack a k-mer string, raises ValueError on non-ACGT characters '''
+    if kmer == "":
+        return 0
+    return int(kmer.translate(_DIGITS), 4)
+
+def decode_kmer(code, kmersize):
+    ''' Unpack a k-mer to its string '''
+    bases = []
+    for i in range(kmersize):
+        bases.append("ACGT"[code & 3])
+        code >>= 2
+    return ''.join(reversed(bases))
+
+def encode_kmers(kmers, kmersize):
+    ''' Pack a list of k-mer strings of kmersize bases into an array, and
+    return whether each is made of ACGT only
+    '''
+    codes = numpy.frombuffer(
+        "".join(kmers).encode("ascii", "replace").translate(_CODES),
+        dtype=numpy.uint8).reshape((len(kmers), kmersize))
+    valid = (codes <= 3).all(axis=1)
+    packed = numpy.zeros(len(kmers), dtype=numpy.uint64)
+    two = numpy.uint64(2)
+    for j in range(kmersize):
+        packed <<= two
+        packed |= (codes[:, j] & 3).astype(numpy.uint64)
+    return (packed, valid)
+
+#--------------------------------------
+# prefix filtering:
+#--------------------------------------
+def prefix_filter(prefix, kmersize):
+    ''' Return (shift, code) so that a packed k-mer starts with prefix
+    exactly when kmer >> shift == code
+    '''
+    shift = 2 * (kmersize - len(prefix))
+    try:
+        code = encode_kmer(prefix)
+    except ValueError:
+        # a prefix with ambiguous bases can never match:
+        code = -1
+    return (shift, code)
+
+#--------------------------------------
+# packed k-mers of a sequence:
+#--------------------------------------
+def packed_kmers(seq, kmersize, prefix=''):
+    ''' Return the packed k-mers of seq and of its reverse complement, both
+    in reading order and both restricted to k-mers starting with prefix.
+
+    Each k-mer is updated from the previous one with a shift and a mask on
+    both strands. The sequence is split at non-ACGT characters (N and bases
+    masked for low quality) and only stretches of at least kmersize bases
+    are read.
+    '''
+    mask = (1 << (2 * kmersize)) - 1
+    shift = 2 * (kmersize - 1)
+    (prefixshift, prefixcode) = prefix_filter(prefix, kmersize)
+    if kmersize not in _STRETCHES:
+        _STRETCHES[kmersize] = re.compile("[ACGTacgt]{%d,}" % (kmersize))
+    forward = []
+    reverse = []
+    for stretch in _STRETCHES[kmersize].findall(seq):
+        codes = bytearray(stretch.encode("ascii").translate(_CODES))
+        fwd = 0
+        rev = 0
+        for code in codes[:kmersize - 1]:
+            fwd = (fwd << 2) | code
+            rev = (rev >> 2) | ((3 - code) << shift)
+        for code in codes[kmersize - 1:]:
+            fwd = ((fwd << 2) | code) & mask
+            rev = (rev >> 2) | ((3 - code) << shift)
+            if fwd >> prefixshift == prefixcode:
+                forward.append(fwd)
+            if rev >> prefixshift == prefixcode:
+                reverse.append(rev)
+    # k-mers of the reverse complement were collected from its 3' end:
+    reverse.reverse()
+    return (forward, reverse)
+
+#--------------------------------------
+# k-mers with ambiguous bases:
+#--------------------------------------
+def ambiguous_kmers(seq, kmersize, prefix=''):
+    ''' Return the number of k-mers of seq and of its reverse complement
+    that start with prefix and hold a non-ACGT character, the k-mers
+    packed_kmers skips
+    '''
+    codes = numpy.frombuffer(seq.encode("ascii", "replace").translate(_CODES),
+                             dtype=numpy.uint8)
+    n = codes.size - kmersize + 1
+    if n <= 0:
+        return 0
+    ambiguous = numpy.zeros(codes.size + 1, dtype=numpy.int64)
+    numpy.cumsum(codes > 3, out=ambiguous[1:])
+    starts = numpy.flatnonzero(ambiguous[kmersize:] != ambiguous[:n])
+    if prefix == '':
+        return 2 * int(starts.size)
+    revseq = seq.translate(_COMPLEMENT)[::-1]
+    count = 0
+    for start in starts.tolist():
+        if seq.startswith(prefix, start):
+            count += 1
+        if revseq.startswith(prefix, n - 1 - start):
+            count += 1
+    return count
+
+#--------------------------------------
+# all k-mers of a sequence as an array:
+#--------------------------------------
+def kmer_array(seq, kmersize):
+    ''' Return the packed k-mer starting at each position of seq and whether
+    it is made of ACGT only, as two arrays. Computed with one array operation
+    per base of the k-mer instead of one Python step per position.
+    '''
+    codes = numpy.frombuffer(seq.encode("ascii", "replace").translate(_CODES),
+                             dtype=numpy.uint8)
+    n = codes.size - kmersize + 1
+    if n <= 0:
+        return (numpy.zeros(0, dtype=numpy.uint64), numpy.zeros(0, dtype=bool))
+    # number of ambiguous bases before each position:
+    ambiguous = numpy.zeros(codes.size + 1, dtype=numpy.int64)
+    numpy.cumsum(codes > 3, out=ambiguous[1:])
+    valid = ambiguous[kmersize:] == ambiguous[:n]
+    bases = (codes & 3).astype(numpy.uint64)
+    kmers = numpy.zeros(n, dtype=numpy.uint64)
+    two = numpy.uint64(2)
+    for j in range(kmersize):
+        kmers <<= two
+        kmers |= bases[j:j + n]
+    return (kmers, valid)
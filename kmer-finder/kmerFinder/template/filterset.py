@@ -0,0 +1,207 @@
+#!/usr/bin/env python3
+''' K-mer filter sets
+
+Copyright (c) 2014, Ole Lund, Technical University of Denmark
+All rights reserved.
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+
+The k-mers of a filter file (-f) are not stored in the template database.
+They are kept as a set of packed k-mers, either exact as a sorted array (8
+bytes per k-mer) or as a Bloom filter, which takes about 1.44 log2(1/FPR)
+bits per k-mer and also filters a fraction FPR of the other k-mers.
+
+A filter set FILTERDB is saved in two files, so it is built once and
+memory-mapped by later builds:
+
+    FILTERDB.kmers or FILTERDB.bits   sorted k-mers or Bloom filter bits
+    FILTERDB.meta.p                   type, k-mer size, prefix and size
+'''
+import os
+import pickle
+from math import ceil, log
+
+import numpy
+
+from kmerFinder.template.reader import read_sequence_file
+from kmerFinder.template.sketch import hash_kmers
+from kmerFinder.template.database import KMER_DTYPE, _map_array, _write_array
+from kmerFinder.template.build import entry_kmers
+
+# default false positive rate of Bloom filters:
+FPRATE = 0.001
+
+# number of new k-mers collected before they are merged:
+MERGESIZE = 1 << 24
+
+# mixed into the k-mers for the second hash of Bloom filters:
+_SEED = numpy.uint64(0x5851F42D4C957F2D)
+
+##########################################################################
+# FILTER SETS
+##########################################################################
+
+class SortedFilter(object):
+    ''' Exact set of packed k-mers as a sorted array '''
+
+    kind = "sorted"
+
+    def __init__(self, kmers, kmersize, prefix=''):
+        self.kmers = kmers
+        self.kmersize = kmersize
+        self.prefix = prefix
+
+    def __len__(self):
+        return len(self.kmers)
+
+    def contains(self, kmers):
+        ''' True for each packed k-mer in the set '''
+        kmers = numpy.asarray(kmers, dtype=KMER_DTYPE)
+        if self.kmers.size == 0:
+            return numpy.zeros(kmers.size, dtype=bool)
+        rows = numpy.searchsorted(self.kmers, kmers)
+        rows[rows == self.kmers.size] = 0
+        return self.kmers[rows] == kmers
+
+class BloomFilter(object):
+    ''' Set of packed k-mers as Bloom filter bits, with Nhashes bit
+    positions per k-mer by double hashing
+    '''
+
+    kind = "bloom"
+
+    def __init__(self, bits, Nbits, Nhashes, kmersize, prefix='', Nkmers=0):
+        self.bits = bits
+        self.Nbits = Nbits
+        self.Nhashes = Nhashes
+        self.kmersize = kmersize
+        self.prefix = prefix
+        self.Nkmers = Nkmers
+
+    def __len__(self):
+        return self.Nkmers
+
+    @classmethod
+    def empty(cls, capacity, fprate, kmersize, prefix=''):
+        ''' Bloom filter for capacity k-mers at false positive rate fprate '''
+        capacity = max(1, capacity)
+        Nbits = int(ceil(-capacity * log(fprate) / log(2) ** 2))
+        Nbits = max(64, (Nbits + 63) // 64 * 64)
+        Nhashes = max(1, int(round(float(Nbits) / capacity * log(2))))
+        return cls(numpy.zeros(Nbits // 8, dtype=numpy.uint8), Nbits,
+                   Nhashes, kmersize, prefix)
+
+    def _positions(self, kmers):
+        ''' Bit positions of the k-mers, one row per hash '''
+        kmers = numpy.asarray(kmers, dtype=KMER_DTYPE)
+        first = hash_kmers(kmers)
+        second = hash_kmers(kmers ^ _SEED) | numpy.uint64(1)
+        positions = numpy.empty((self.Nhashes, kmers.size), dtype=numpy.uint64)
+        with numpy.errstate(over="ignore"):
+            for i in range(self.Nhashes):
+                positions[i] = (first + numpy.uint64(i) * second) \
+                    % numpy.uint64(self.Nbits)
+        return positions
+
+    def add(self, kmers):
+        ''' Add distinct packed k-mers '''
+        positions = self._positions(kmers).ravel()
+        numpy.bitwise_or.at(self.bits, positions >> numpy.uint64(3),
+                            (1 << (positions & numpy.uint64(7))).astype(
+                                numpy.uint8))
+        self.Nkmers += len(kmers)
+
+    def contains(self, kmers):
+        ''' True for each packed k-mer in the set, or falsely for a fraction
+        fprate of the others
+        '''
+        found = numpy.ones(len(kmers), dtype=bool)
+        for positions in self._positions(kmers):
+            bits = self.bits[positions >> numpy.uint64(3)]
+            bits >>= (positions & numpy.uint64(7)).astype(numpy.uint8)
+            found &= (bits & 1) == 1
+        return found
+
+##########################################################################
+# READ AND WRITE
+##########################################################################
+
+def is_filterset(filterfilename):
+    ''' True if filterfilename is a saved filter set '''
+    return os.path.exists(filterfilename + ".meta.p")
+
+def write_filterset(filterfilename, filterset):
+    ''' Write a filter set, the meta file last '''
+    meta = {
+        "type": filterset.kind,
+        "kmersize": filterset.kmersize,
+        "prefix": filterset.prefix,
+        "Nkmers": len(filterset),
+    }
+    if filterset.kind == "bloom":
+        _write_array(filterfilename + ".bits", filterset.bits, numpy.uint8)
+        meta["Nbits"] = filterset.Nbits
+        meta["Nhashes"] = filterset.Nhashes
+    else:
+        _write_array(filterfilename + ".kmers", filterset.kmers, KMER_DTYPE)
+    with open(filterfilename + ".meta.p.tmp", "wb") as metafile:
+        pickle.dump(meta, metafile, 2)
+    os.rename(filterfilename + ".meta.p.tmp", filterfilename + ".meta.p")
+
+def open_filterset(filterfilename):
+    ''' Memory-map a saved filter set '''
+    with open(filterfilename + ".meta.p", "rb") as metafile:
+        meta = pickle.load(metafile)
+    if meta["type"] == "bloom":
+        return BloomFilter(_map_array(filterfilename + ".bits", numpy.uint8),
+                           meta["Nbits"], meta["Nhashes"], meta["kmersize"],
+                           meta["prefix"], meta["Nkmers"])
+    return SortedFilter(_map_array(filterfilename + ".kmers", KMER_DTYPE),
+                        meta["kmersize"], meta["prefix"])
+
+##########################################################################
+# BUILD
+##########################################################################
+
+def build_filterset(filterfilename, kmersize, prefix='', kind="sorted",
+                    fprate=FPRATE, report=None):
+    ''' Filter set of the k-mers on both strands of the sequences in the
+    file filterfilename. report(name, Nkmers) is called for each sequence.
+    '''
+    if kind == "bloom":
+        # at most one distinct k-mer per base and strand:
+        capacity = 0
+        for (name, desc, seq) in read_sequence_file(filterfilename):
+            capacity += 2 * max(0, len(seq) - kmersize + 1)
+        filterset = BloomFilter.empty(capacity, fprate, kmersize, prefix)
+    parts = []
+    Nparts = 0
+    kmers = numpy.zeros(0, dtype=KMER_DTYPE)
+    for (name, desc, seq) in read_sequence_file(filterfilename):
+        ukmers = numpy.unique(entry_kmers([seq], kmersize, prefix))
+        if report is not None:
+            report(name, ukmers.size)
+        if kind == "bloom":
+            filterset.add(ukmers)
+            continue
+        parts.append(ukmers)
+        Nparts += ukmers.size
+        # merge the k-mers before they take more than twice the memory:
+        if Nparts > max(MERGESIZE, kmers.size):
+            kmers = numpy.unique(numpy.concatenate([kmers] + parts))
+            parts = []
+            Nparts = 0
+    if kind == "bloom":
+        return filterset
+    kmers = numpy.unique(numpy.concatenate([kmers] + parts))
+    return SortedFilter(kmers, kmersize, prefix)
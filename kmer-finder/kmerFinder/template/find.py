@@ -22,15 +22,27 @@ import time
 import re
 from math import sqrt, pow
 from argparse import ArgumentParser
-from operator import itemgetter
+from bisect import bisect_left
 
 if sys.version_info < (3, 0):
-    import cPickle as pickle
     from string import maketrans
 else:
-    import pickle
     maketrans = str.maketrans
 
+import numpy
+
+from kmerFinder.template.encoding import MAXKMERSIZE
+from kmerFinder.template.database import open_database
+from kmerFinder.template.query import (QueryIndex, count_parallel,
+                                       input_digest, spectrum_key,
+                                       read_spectrum, write_spectrum,
+                                       select_templates)
+from kmerFinder.template.reader import read_sequence_file
+from kmerFinder.template.wta import WinnerTakesAll
+from kmerFinder.template.prescreen import (open_prescreen, candidate_templates,
+                                           candidate_postings)
+from kmerFinder.template.lca import RANKS, open_lca, write_abundance
+
 ##########################################################################
 # FUNCTIONS
 ##########################################################################
@@ -42,61 +54,92 @@ def reversecomplement(seq):
     ''' Reverse complement '''
     return seq.translate(maketrans("ATGC", "TACG"))[::-1]
 
-#--------------------------------------
-# save kmers of querysequence:
-#--------------------------------------
-def save_kmers(queryseq):
-    '''  '''
-    global qtotlen, prefix, queryindex, querymers, uquerymers, kmersize, prefixlen
-
-    seqlen = len(queryseq)
-    qtotlen += seqlen
-    # store kmers in original and reverse complement sequence:
-    for qseq in[queryseq, reversecomplement(queryseq)]:
-        for j in range(0, seqlen - kmersize + 1):
-            submer = qseq[j:j + kmersize]
-            if prefix == qseq[j:j + prefixlen]:
-                if submer in queryindex:
-                    if submer in templates:
-                        queryindex[submer] += 1
-                    querymers += 1
-                else:
-                    if submer in templates:
-                        queryindex[submer] = 1
-                    querymers += 1
-                    uquerymers += 1
-
 #-------------------------------------
 # search for matches:
 #-------------------------------------
-def find_matches():
-    '''  '''
-    global queryindex, mincoverage, templates
-    
+def find_matches(templates, queryindex, mincoverage):
+    ''' Number of query k-mers (unique and total) found in each template '''
+    (hit, scores, totals, Nhits) = match_arrays(templates, queryindex,
+                                                mincoverage)
     templateentries = {}
     templateentries_tot = {}
-    Nhits = 0
-    for submer in queryindex:
-        if queryindex[submer] >= mincoverage:
-            matches = templates[submer].split(",")
-            # get list of unique matches:
-            umatches = list(set(matches))
-            # Nhits = sum of scores over all templates:
-            Nhits = Nhits + len(umatches)
-            for match in umatches:
-                # get unique scores:
-                if match in templateentries:
-                    templateentries[match] += 1
-                else:
-                    templateentries[match] = 1
-                # get total amount of kmers found in template (total score):
-                if match in templateentries_tot:
-                    templateentries_tot[match] += queryindex[submer]
-                else:
-                    templateentries_tot[match] = queryindex[submer]
-    
+    for i in hit.tolist():
+        templateentries[templates.names[i]] = int(scores[i])
+        templateentries_tot[templates.names[i]] = int(totals[i])
+
     return(templateentries, templateentries_tot, Nhits)
 
+def match_arrays(templates, queryindex, mincoverage):
+    ''' Template IDs hit in the order they are first hit, unique and total
+    scores by template ID and the sum of unique scores
+    '''
+    kmers = numpy.fromiter(queryindex, dtype=numpy.uint64,
+                           count=len(queryindex))
+    counts = numpy.fromiter(queryindex.values(), dtype=numpy.int64,
+                            count=len(queryindex))
+    keep = counts >= mincoverage
+    kmers = kmers[keep]
+    counts = counts[keep]
+    scores = numpy.zeros(len(templates.names), dtype=numpy.int64)
+    totals = numpy.zeros(len(templates.names), dtype=numpy.int64)
+    Nhits = 0
+    hits = []
+    firsthits = []
+    for segment in templates.segments:
+        rows = segment.lookup(kmers)
+        found = numpy.flatnonzero(rows >= 0)
+        # number of k-mers and sum of their counts per equivalence class,
+        # with the classes in the order they are first hit:
+        classes = segment.classes[rows[found]]
+        (uclasses, firsthit, inverse) = numpy.unique(
+            classes, return_index=True, return_inverse=True)
+        order = numpy.argsort(firsthit, kind="stable")
+        inverse = numpy.argsort(order)[inverse.ravel()]
+        uclasses = uclasses[order]
+        firsthit = found[firsthit[order]]
+        classkmers = numpy.bincount(inverse, minlength=uclasses.size)
+        classcounts = numpy.bincount(inverse, weights=counts[found],
+                                     minlength=uclasses.size)
+        # expand each class hit to its templates:
+        (ids, sizes) = segment.class_postings(uclasses)
+        # Nhits = sum of scores over all templates:
+        Nhits += int(numpy.dot(classkmers, sizes))
+        # get unique scores:
+        scores += numpy.bincount(
+            ids, weights=numpy.repeat(classkmers, sizes),
+            minlength=scores.size).astype(numpy.int64)
+        # get total amount of kmers found in template (total score):
+        totals += numpy.bincount(
+            ids, weights=numpy.repeat(classcounts, sizes),
+            minlength=totals.size).astype(numpy.int64)
+        (hit, first) = numpy.unique(ids, return_index=True)
+        order = numpy.argsort(first, kind="stable")
+        hits.append(hit[order])
+        firsthits.append(numpy.repeat(firsthit, sizes)[first[order]])
+    # report templates in the order they are first hit:
+    order = numpy.argsort(numpy.concatenate(firsthits), kind="stable")
+    return (numpy.concatenate(hits)[order], scores, totals, Nhits)
+
+def match_candidates(templates, queryindex, mincoverage, candidates):
+    ''' match_arrays for the candidate template IDs only, with Nhits still
+    summed over all templates
+    '''
+    kmers = numpy.fromiter(queryindex, dtype=numpy.uint64,
+                           count=len(queryindex))
+    counts = numpy.fromiter(queryindex.values(), dtype=numpy.int64,
+                            count=len(queryindex))
+    keep = counts >= mincoverage
+    (kmers, counts) = (kmers[keep], counts[keep])
+    Nhits = int(templates.kmer_sizes(kmers).sum())
+    (ids, sizes) = candidate_postings(templates, kmers, candidates)
+    scores = numpy.bincount(ids, minlength=len(templates.names)).astype(
+        numpy.int64)
+    totals = numpy.bincount(ids, weights=numpy.repeat(counts, sizes),
+                            minlength=len(templates.names)).astype(numpy.int64)
+    # ids are by k-mer, so the first occurrences are in the order hit:
+    (hit, first) = numpy.unique(ids, return_index=True)
+    return (hit[numpy.argsort(first, kind="stable")], scores, totals, Nhits)
+
 #------------------------------------------------
 # Conservative two sided p-value from z-score:
 #------------------------------------------------
@@ -120,240 +163,224 @@ def z_from_two_samples(r1, n1, r2, n2, etta):
 #-------------------------------------------------
 # Conservative two sided p-value from z-score:
 #-------------------------------------------------
+# fastp(z) is the p-value of the first limit below z:
+_ZLIMITS = [1.64485, 1.95996, 2.57583, 3.29053, 3.89059, 4.41717, 4.89164,
+            5.32672, 5.73073, 6.10941, 6.46695, 6.8065, 7.13051, 7.4409,
+            7.73926, 8.02686, 8.30479, 8.57394, 8.83511, 9.08895, 9.33604,
+            9.5769, 9.81197, 10.0416, 10.2663, 10.4862, 10.7016]
+_PVALUES = [1.0, 0.1, 0.05, 0.01, 1e-3, 1e-4, 1e-5, 1e-6, 1e-7, 1e-8, 1e-9,
+            1e-10, 1e-11, 1e-12, 1e-13, 1e-14, 1e-15, 1e-16, 1e-17, 1e-18,
+            1e-19, 1e-20, 1e-21, 1e-22, 1e-23, 1e-24, 1e-25, 1e-26]
+
 def fastp(z):
     '''Conservative two sided p-value from z-score'''
-    if z > 10.7016:
-        p = 1e-26
-    elif z > 10.4862:
-        p = 1e-25
-    elif z > 10.2663:
-        p = 1e-24
-    elif z > 10.0416:
-        p = 1e-23
-    elif z > 9.81197:
-        p = 1e-22
-    elif z > 9.5769:
-        p = 1e-21
-    elif z > 9.33604:
-        p = 1e-20
-    elif z > 9.08895:
-        p = 1e-19
-    elif z > 8.83511:
-        p = 1e-18
-    elif z > 8.57394:
-        p = 1e-17
-    elif z > 8.30479:
-        p = 1e-16
-    elif z > 8.02686:
-        p = 1e-15
-    elif z > 7.73926:
-        p = 1e-14
-    elif z > 7.4409:
-        p = 1e-13
-    elif z > 7.13051:
-        p = 1e-12
-    elif z > 6.8065:
-        p = 1e-11
-    elif z > 6.46695:
-        p = 1e-10
-    elif z > 6.10941:
-        p = 1e-9
-    elif z > 5.73073:
-        p = 1e-8
-    elif z > 5.32672:
-        p = 1e-7
-    elif z > 4.89164:
-        p = 1e-6
-    elif z > 4.41717:
-        p = 1e-5
-    elif z > 3.89059:
-        p = 1e-4
-    elif z > 3.29053:
-        p = 1e-3
-    elif z > 2.57583:
-        p = 0.01
-    elif z > 1.95996:
-        p = 0.05
-    elif z > 1.64485:
-        p = 0.1
-    else:
-        p = 1.0
-    return p
+    return _PVALUES[bisect_left(_ZLIMITS, z)]
 
-##########################################################################
-#	DEFINE GLOBAL VARIABLES
-##########################################################################
-def findTemplate():
-    global templates, queryindex, prefix, qtotlen, mincoverage, querymers, uquerymers, kmersize, prefixlen
-    ##########################################################################
-    # PARSE COMMAND LINE OPTIONS
-    ##########################################################################
-    parser = ArgumentParser()
-    parser.add_argument("-i", "--inputfile", dest="inputfilename",help="read from INFILE", metavar="INFILE")
-    parser.add_argument("-t", "--templatefile", dest="templatefilename",help="read from TEMFILE", metavar="TEMFILE")
-    parser.add_argument("-o", "--outputfile", dest="outputfilename",help="write to OUTFILE", metavar="OUTFILE")
-    parser.add_argument("-k", "--kmersize", dest="kmersize",help="Size of k-mer, default 16", metavar="KMERSIZE")
-    parser.add_argument("-x", "--prefix", dest="prefix",help="prefix, e.g. ATGAC, default none", metavar="_id")
-    parser.add_argument("-a", "--printall", dest="printall", action="store_true",help="Print matches to all templates in templatefile unsorted")
-    parser.add_argument("-w", "--winnertakesitall", dest="wta", action="store_true",help="kmer hits are only assigned to most similar template")
-    parser.add_argument("-e", "--evalue", dest="evalue", help="Maximum E-value", metavar="EVALUE")
-    args = parser.parse_args()
-    
-    # set up prefix filtering:
-    if args.prefix != None:
-        prefix = args.prefix
-    else:
-        prefix = ''
-    prefixlen = len(prefix)
-    
-    # get e-value:
-    if args.evalue != None:
-        evalue = float(args.evalue)
-    else:
-        evalue = float(0.05)
-    
-    # Open queryfile:
-    t0 = time.time()
-    if args.inputfilename != None:
-        if args.inputfilename == "--":
-            inputfile = sys.stdin
-        else:
-            inputfile = open(args.inputfilename, "r")
-    
-    # open templatefile:
-    if args.templatefilename != None:
-        templatefile = open(args.templatefilename + ".p", "rb")
-        templatefile_lengths = open(args.templatefilename + ".len.p", "rb")
-        try:
-            templatefile_ulengths = open(
-                args.templatefilename + ".ulen.p", "rb")
-        except:
-            # do nothing
-            two = 2
-        templatefile_descriptions = open(
-            args.templatefilename + ".desc.p", "rb")
-    else:
-        sys.exit("No template file specified")
-    
-    # open outputfile:
-    if args.outputfilename != None:
-        outputfile = open(args.outputfilename, "w")
-    else:  # If no output filename choose the same as the input filename
-        outputfilename = os.path.splitext(args.inputfilename)[0]
-        outputfile = open(outputfilename, "w")
-    
-    # get kmer size:
-    if args.kmersize != None:
-        kmersize = int(args.kmersize)
-    else:
-        kmersize = 16
-    ##########################################################################
-    # READ DATABASE OF TEMPLATES
-    ##########################################################################
-    templates = {}
-    Ntemplates = 0
-    
-    # Read Template file:
+#-------------------------------------------------
+# Statistics of all templates at once:
+#-------------------------------------------------
+def z_from_two_samples_array(r1, n1, r2, n2, etta):
+    ''' z_from_two_samples for arrays r1 and n1 '''
+    r1 = numpy.asarray(r1, dtype=numpy.float64)
+    n1 = numpy.asarray(n1, dtype=numpy.float64)
+    p1 = r1 / (n1 + etta)
+    p2 = float(r2) / (float(n2) + etta)
+    p = (r1 + r2) / (n1 + n2 + etta)
+    q = 1 - p
+    return (p1 - p2) / numpy.sqrt(p * q * (1 / (n1 + etta) + 1 / (n2 + etta))
+                                  + etta)
+
+def fastp_array(z):
+    ''' fastp for an array of z-scores '''
+    return numpy.asarray(_PVALUES)[numpy.searchsorted(_ZLIMITS, z)]
+
+#-------------------------------------------------
+# Read database of templates:
+#-------------------------------------------------
+def read_templates(templatefilename, kmersize=None, prescreen=False,
+                   lca=False):
+    ''' Open the template database and check the k-mer size, with the
+    prescreen index of each segment if prescreen and the LCA index if lca
+    '''
     sys.stdout.write("# Reading database of templates\n")
-    templates = pickle.load(templatefile)
-    templates_lengths = pickle.load(templatefile_lengths)
-    try:
-        templates_ulengths = pickle.load(templatefile_ulengths)
-    except:
-        sys.stderr.write('No ulen.p file found for database')
-        SystemExit()
-    templates_descriptions = pickle.load(templatefile_descriptions)
-    
-    # Count number of k-mers, and sum of unique k-mers over all templates:
+    templates = open_database(templatefilename)
+    if lca:
+        for segment in templates.segments:
+            if segment.filename is not None:
+                segment.lca = open_lca(segment.filename, segment)
+            if segment.filename is None or segment.lca is None:
+                sys.exit("Database %s has no LCA index, build it with "
+                         "maketemplatedb --taxonomy" % (templatefilename))
+    if prescreen and not open_prescreens(templates):
+        sys.exit("Database %s has no prescreen index, build it with "
+                 "maketemplatedb --sketch" % (templatefilename))
+    if kmersize is None:
+        kmersize = templates.kmersize
+    if kmersize > MAXKMERSIZE:
+        sys.exit("K-mer size can not be larger than %s" % (MAXKMERSIZE))
+    if kmersize != templates.kmersize:
+        sys.exit("Database %s has k-mer size %s" % (templatefilename,
+                                                    templates.kmersize))
+    return templates
+
+def open_prescreens(templates):
+    ''' Open the prescreen index of each segment of the database, unless
+    open already. False if a segment has none.
+    '''
+    for segment in templates.segments:
+        if getattr(segment, "prescreen", None) is not None:
+            continue
+        if segment.filename is None:
+            return False
+        segment.prescreen = open_prescreen(segment.filename, segment)
+        if segment.prescreen is None:
+            return False
+    return True
+
+def template_totals(templates):
+    ''' Number of templates and the sum of their total and unique k-mers '''
     template_tot_len = 0
     template_tot_ulen = 0
     Ntemplates = 0
     # length added
-    for name in templates_lengths:
-        template_tot_len += templates_lengths[name]
-        template_tot_ulen += templates_ulengths[name]
+    for name in templates.lengths:
+        template_tot_len += templates.lengths[name]
+        template_tot_ulen += templates.ulengths[name]
         Ntemplates += 1
-    
-    if template_tot_ulen == 0:
-        print(args.inputfilename)
-        print(args.outputfilename)
-        print(args.templatefilename)
-        print(templates_lengths)
-    
-    ##########################################################################
-    # READ INPUTFILE
-    ##########################################################################
-    queryseq = ""
-    queryseqsegments = []
-    Nquerys = 0
-    queryindex = {}
-    qtotlen = 0
-    querymers = 0
-    uquerymers = 0
-    i = 0
-    
-    if args.inputfilename != None:
-        sys.stdout.write("# Reading inputfile\n")
-        for line in inputfile:
-            fields = line.split()
-            if len(fields) >= 1:
-                # FASTA file:
-                if fields[0][0] == ">":
-                    if (i > 0):
-                        queryseq = ''.join(queryseqsegments)
-                        # Update dictionary of kmers
-                        save_kmers(queryseq)
-                    del queryseqsegments
-                    queryseqsegments = []
-                    i = 0
-                # Fastq file:
-                elif fields[0][0] == "@":
-                    # Fastq file
-                    if (i > 0):
-                        queryseq = ''.join(queryseqsegments)
-                        # Update dictionary of kmers:
-                        save_kmers(queryseq)
-                    del queryseqsegments
-                    queryseqsegments = []
-                    i = 0
-                    queryseq = ""
-                    try:
-                        line = next(inputfile)
-                        fields = line.split()
-                        queryseqsegments.append("")
-                        queryseqsegments[i] = fields[0]
-                        i += 1
-                        line = next(inputfile)
-                        line = next(inputfile)
-                    except:
-                        break
-                else:
-                    queryseqsegments.append("")
-                    queryseqsegments[i] = fields[0].upper()
-                    i += 1
-        
-        queryseq = ''.join(queryseqsegments)
+    return (template_tot_len, template_tot_ulen, Ntemplates)
+
+#-------------------------------------------------
+# Count k-mers of query:
+#-------------------------------------------------
+def read_query(templates, templatefilename, inputfilenames, prefix='',
+               threads=1, cachedir=None, minquality=None, ambiguous=False):
+    ''' Count the k-mers of all sequences in inputfilenames, or take them
+    from the spectrum cache in cachedir if given. FASTQ bases of quality
+    below minquality are skipped like N, or counted as k-mers in no template
+    with ambiguous.
+    '''
+    if cachedir is not None:
+        spectra = read_spectra(inputfilenames, [templates.kmersize], prefix,
+                               threads, cachedir, minquality, ambiguous)
+        return select_templates(spectra[templates.kmersize], templates)
+
+    sys.stdout.write("# Reading inputfile\n")
+    queryseqs = (queryseq for inputfilename in inputfilenames
+                 for name, description, queryseq
+                 in read_sequence_file(inputfilename, minquality))
+    if threads > 1:
+        return count_parallel(queryseqs, templates, templatefilename,
+                              templates.kmersize, prefix, threads, ambiguous)
+    query = QueryIndex(templates, templates.kmersize, prefix, ambiguous)
+    for queryseq in queryseqs:
         # Update dictionary of K-mers:
-        save_kmers(queryseq)
-    del queryseqsegments
-    
+        query.save_kmers(queryseq)
+    query.flush()
+    return query
+
+def read_spectra(inputfilenames, kmersizes, prefix='', threads=1,
+                 cachedir=None, minquality=None, ambiguous=False):
+    ''' Spectrum (QueryIndex without templates) of all sequences in
+    inputfilenames for each k-mer size, taken from the cache in cachedir if
+    given. The input is read once for all k-mer sizes, or once per k-mer
+    size with threads.
+    '''
+    spectra = {}
+    keys = {}
+    digest = None
+    if cachedir is not None:
+        digest = input_digest(inputfilenames)
+    for kmersize in sorted(set(kmersizes)):
+        keys[kmersize] = None
+        if digest is not None:
+            keys[kmersize] = spectrum_key(digest, kmersize, prefix,
+                                          minquality, ambiguous)
+            spectrum = read_spectrum(cachedir, keys[kmersize])
+            if spectrum is not None:
+                sys.stdout.write("# Reading k-mer spectrum %s from cache\n" %
+                                 (keys[kmersize]))
+                spectra[kmersize] = spectrum
+                del keys[kmersize]
+    if not keys:
+        return spectra
+
+    def queryseqs():
+        return (queryseq for inputfilename in inputfilenames
+                for name, description, queryseq
+                in read_sequence_file(inputfilename, minquality))
+
+    sys.stdout.write("# Reading inputfile\n")
+    if threads > 1:
+        for kmersize in keys:
+            spectra[kmersize] = count_parallel(queryseqs(), None, None,
+                                               kmersize, prefix, threads,
+                                               ambiguous)
+    else:
+        counting = [QueryIndex(None, kmersize, prefix, ambiguous)
+                    for kmersize in keys]
+        for queryseq in queryseqs():
+            for query in counting:
+                query.save_kmers(queryseq)
+        for query in counting:
+            query.flush()
+            spectra[query.kmersize] = query
+    for (kmersize, key) in keys.items():
+        if key is not None:
+            if not os.path.isdir(cachedir):
+                os.makedirs(cachedir)
+            write_spectrum(cachedir, key, spectra[kmersize])
+            sys.stdout.write("# K-mer spectrum %s written to cache\n" % (key))
+    return spectra
+
+#-------------------------------------------------
+# Score templates and write results:
+#-------------------------------------------------
+def write_matches(templates, query, outputfile, wta=False, evalue=0.05,
+                  Ncandidates=None, matches=None):
+    ''' Search for the query k-mers in the templates and write the
+    significant matches to outputfile. With Ncandidates, only the templates
+    ranked highest by the prescreen index are scored. matches are the
+    arrays of match_arrays when they are already known. Returns the
+    (template, score, p_corr) of each match written.
+    '''
+    queryindex = query.queryindex
+    uquerymers = query.uquerymers
+    templates_lengths = templates.lengths
+    templates_ulengths = templates.ulengths
+    templates_descriptions = templates.descriptions
+    (template_tot_len, template_tot_ulen, Ntemplates) = template_totals(
+        templates)
+
     ##########################################################################
     # SEARCH FOR MATCHES
     ##########################################################################
     sys.stdout.write("# Searching for matches of input in template\n")
     mincoverage = 1
-    templateentries = {}
-    templateentries_tot = {}
-    Nhits = 0
-    
-    (templateentries, templateentries_tot, Nhits) = find_matches()
-    
+
+    candidates = None
+    if matches is not None:
+        (hit, scores, totals, Nhits) = matches
+    elif Ncandidates is not None:
+        kmers = numpy.fromiter(queryindex, dtype=numpy.uint64,
+                               count=len(queryindex))
+        counts = numpy.fromiter(queryindex.values(), dtype=numpy.int64,
+                                count=len(queryindex))
+        candidates = candidate_templates(templates,
+                                         kmers[counts >= mincoverage],
+                                         Ncandidates)
+        sys.stdout.write("# %s candidate templates\n" % (candidates.size))
+        (hit, scores, totals, Nhits) = match_candidates(
+            templates, queryindex, mincoverage, candidates)
+    else:
+        (hit, scores, totals, Nhits) = match_arrays(templates, queryindex,
+                                                    mincoverage)
+
     ##########################################################################
     #	DO STATISTICS
     ##########################################################################
     minscore = 0
     etta = 1.0e-8  # etta is a small number to avoid division by zero
-    
+
     # report search statistics:
     sys.stdout.write("# Search statistics\n")
     sys.stdout.write("# Total number of hits: %s\n"%Nhits)
@@ -364,13 +391,14 @@ def findTemplate():
     sys.stdout.write(("# Maximum multiple testing corrected E-value to report"
                       " match : %s\n")%(evalue))
     sys.stdout.write("# Printing best matches\n")
+    reported = []
     
     # print heading of outputfile:
-    if args.wta != True:
+    if wta != True:
         outputfile.write("#Template\tScore\tExpected\tz\tp_value\tquery "
                          "coverage [%]\ttemplate coverage [%]\tdepth\tKmers "
                          "in Template\tDescription\n")
-    elif args.wta == True:
+    elif wta == True:
         outputfile.write("#Template\tScore\tExpected\tz\tp_value\tquery "
                          "coverage [%]\ttemplate coverage [%]\tdepth\ttotal "
                          "query coverage [%]\ttotal template coverage [%]\t"
@@ -379,18 +407,80 @@ def findTemplate():
     ##########################################################################
     #	STANDARD SCORING SCHEME
     ##########################################################################
-    if not args.wta == True:
-        sortedlist = sorted(
-            templateentries.items(), key=itemgetter(1), reverse=True)
-        for template, score in sortedlist:
+    if not wta == True:
+        # templates by decreasing score, ties in the order they are hit:
+        hit = hit[numpy.argsort(-scores[hit], kind="stable")]
+        hit = hit[scores[hit] > minscore]
+        score = scores[hit].astype(numpy.float64)
+        ulengths = numpy.array([templates_ulengths[templates.names[i]]
+                                for i in hit.tolist()], dtype=numpy.float64)
+        lengths = numpy.array([templates_lengths[templates.names[i]]
+                               for i in hit.tolist()], dtype=numpy.float64)
+        expected = float(Nhits) * ulengths / float(template_tot_ulen)
+        #z = (score - expected)/sqrt(score + expected+etta)
+        #p  = fastp(z)
+        #
+        # If expected < 1 the above poisson approximation is a poor model
+        # Use instead: probabilyty of seing X hits is p**X if probability
+        # of seing one hit is p (like tossing a dice X times)
+        #
+        # if expected <1:
+        #  p = expected**score
+        #
+        # Comparison of two fractions, Statistical methods in medical
+        # research, Armitage et al. p. 125:
+        z = z_from_two_samples_array(
+            score, ulengths, Nhits, template_tot_ulen, etta)
+        p = fastp_array(z)
+        # Correction for multiple testing:
+        p_corr = p * Ntemplates
+        frac_q = (score / (float(uquerymers) + etta)) * 100
+        frac_d = (score / (ulengths + etta)) * 100
+        coverage = totals[hit] / lengths
+        # only format the significant matches:
+        passed = numpy.flatnonzero(p_corr <= evalue)
+        rows = zip(hit[passed].tolist(), expected[passed].tolist(),
+                   z[passed].tolist(), p_corr[passed].tolist(),
+                   frac_q[passed].tolist(), frac_d[passed].tolist(),
+                   coverage[passed].tolist())
+        for (i, expected, z, p_corr, frac_q, frac_d, coverage) in rows:
+            template = templates.names[i]
+            score = int(scores[i])
+            reported.append((template, score, p_corr))
+            outputfile.write(("%-12s\t%8d\t%8d\t%8.2f\t%4.1e\t%8.2f\t"
+                              "%8.2f\t%8.2f\t%8d\t%s\n")%(
+                template, score, int(round(expected)), round(z, 1),
+                p_corr, frac_q, frac_d, coverage,
+                templates_ulengths[template],
+                templates_descriptions[template].strip()
+                ))
+    
+    ##########################################################################
+    #	WINNER TAKES IT ALL
+    ##########################################################################
+    
+    if wta == True:
+        w_templateentries = WinnerTakesAll(templates, queryindex, mincoverage,
+                                           candidates)
+        maxhits = 100
+        hitcounter = 1
+        stop = False
+        while not stop:
+            hitcounter += 1
+            if hitcounter > maxhits:
+                stop = True
+            best = w_templateentries.best()
+            if best is None:
+                break
+            template = templates.names[best]
+            score = int(w_templateentries.scores[best])
+            w_Nhits = w_templateentries.Nhits
             if score > minscore:
-                expected = float(Nhits) * float(templates_ulengths[template]) / float(template_tot_ulen)
+                expected = float(w_Nhits) * float(templates_ulengths[template]) / float(template_tot_ulen)
                 #z = (score - expected)/sqrt(score + expected+etta)
                 #p  = fastp(z)
                 #
                 # If expected < 1 the above poisson approximation is a poor model
-                # Use instead: probabilyty of seing X hits is p**X if probability
-                # of seing one hit is p (like tossing a dice X times)
                 #
                 # if expected <1:
                 #  p = expected**score
@@ -398,97 +488,192 @@ def findTemplate():
                 # Comparison of two fractions, Statistical methods in medical
                 # research, Armitage et al. p. 125:
                 z = z_from_two_samples(
-                    score, templates_ulengths[template], Nhits, template_tot_ulen, etta)
+                    score, templates_ulengths[template], w_Nhits, template_tot_ulen, etta)
                 p = fastp(z)
-                # Correction for multiple testing:
+                # correction for multiple testing:
                 p_corr = p * Ntemplates
+                # print score,float(uquerymers),etta
                 frac_q = (score / (float(uquerymers) + etta)) * 100
                 frac_d = (score / (templates_ulengths[template] + etta)) * 100
-                coverage = templateentries_tot[template] / float(templates_lengths[template])
-                # print str(p) + " " + str(p_corr) + " " + str(evalue)
-                # p_corr=0
+                coverage = int(w_templateentries.totals[best]) / float(templates_lengths[template])
+                # calculate total values:
+                tot_frac_q = (int(scores[best]) / (float(uquerymers) + etta)) * 100
+                tot_frac_d = (int(scores[best]) / (templates_ulengths[template] + etta)) * 100
+                tot_coverage = int(totals[best]) / float(templates_lengths[template])
+                # print results to outputfile:
                 if p_corr <= evalue:
-                    outputfile.write(("%-12s\t%8d\t%8d\t%8.2f\t%4.1e\t%8.2f\t"
-                                      "%8.2f\t%8.2f\t%8d\t%s\n")%(
+                    outputfile.write(("%-12s\t%8d\t%8d\t%8.1f\t%4.2e\t%8.2f"
+                                      "\t%8.2f\t%4.2f\t%8.2f\t%8.2f\t%4.2f"
+                                      "\t%8d\t%s\n")%(
                         template, score, int(round(expected)), round(z, 1),
-                        p_corr, frac_q, frac_d, coverage,
+                        p_corr, frac_q, frac_d, coverage, tot_frac_q,
+                        tot_frac_d, tot_coverage,
                         templates_ulengths[template],
                         templates_descriptions[template].strip()
                         ))
+                    reported.append((template, score, p_corr))
+                    # remove all kmers in best hit from the other templates:
+                    w_templateentries.remove(best)
+                else:
+                    stop = True
+    return reported
     
+##########################################################################
+#	DEFINE GLOBAL VARIABLES
+##########################################################################
+def findTemplate():
     ##########################################################################
-    #	WINNER TAKES IT ALL
+    # PARSE COMMAND LINE OPTIONS
     ##########################################################################
+    parser = ArgumentParser()
+    parser.add_argument("-i", "--inputfile", dest="inputfilename",help="read from INFILE", metavar="INFILE")
+    parser.add_argument("-t", "--templatefile", dest="templatefilenames", action="append", help="read from TEMFILE, can be repeated to search several databases", metavar="TEMFILE")
+    parser.add_argument("-o", "--outputfile", dest="outputfilenames", action="append", help="write to OUTFILE, once per TEMFILE or with the database name appended", metavar="OUTFILE")
+    parser.add_argument("-k", "--kmersize", dest="kmersize",help="Size of k-mer, default 16", metavar="KMERSIZE")
+    parser.add_argument("-x", "--prefix", dest="prefix",help="prefix, e.g. ATGAC, default none", metavar="_id")
+    parser.add_argument("-a", "--printall", dest="printall", action="store_true",help="Print matches to all templates in templatefile unsorted")
+    parser.add_argument("-w", "--winnertakesitall", dest="wta", action="store_true",help="kmer hits are only assigned to most similar template")
+    parser.add_argument("-e", "--evalue", dest="evalue", help="Maximum E-value", metavar="EVALUE")
+    parser.add_argument("--threads", dest="threads", type=int, default=1, help="Count k-mers in THREADS processes, default 1", metavar="THREADS")
+    parser.add_argument("-q", "--minquality", dest="minquality", type=int, help="skip the k-mers covering FASTQ bases of Phred quality below MINQUALITY, default none", metavar="MINQUALITY")
+    parser.add_argument("--ambiguous", dest="ambiguous", action="store_true", help="count the k-mers covering N or masked bases as query k-mers in no template, as before packed k-mers, instead of skipping them; this lowers the coverage of reads with N")
+    parser.add_argument("--prescreen", dest="candidates", type=int, help="only score the CANDIDATES templates ranked highest by the prescreen index of the database", metavar="CANDIDATES")
+    parser.add_argument("--abundance", dest="abundance", choices=sorted(RANKS), help="write the abundance of each species or genus in the query k-mers, from the LCA index of the database, instead of the matches")
+    parser.add_argument("--cache", dest="cachedir", help="keep the k-mer spectrum of the input in CACHEDIR and reuse it in later runs", metavar="CACHEDIR")
+    parser.add_argument("--server", dest="socketname", help="send the search to the findTemplateServer listening on SOCKET", metavar="SOCKET")
+    args = parser.parse_args()
     
-    if args.wta == True:
-        w_templateentries = templateentries.copy()
-        w_templateentries_tot = templateentries_tot.copy()
-        w_Nhits = Nhits
-        maxhits = 100
-        hitcounter = 1
-        stop = False
-        while not stop:
-            hitcounter += 1
-            if hitcounter > maxhits:
-                stop = True
-            sortedlist = sorted(w_templateentries.items(),
-                                key=itemgetter(1),
-                                reverse=True)
-            for template, score in sortedlist:
-                if score > minscore:
-                    expected = float(w_Nhits) * float(templates_ulengths[template]) / float(template_tot_ulen)
-                    #z = (score - expected)/sqrt(score + expected+etta)
-                    #p  = fastp(z)
-                    #
-                    # If expected < 1 the above poisson approximation is a poor model
-                    #
-                    # if expected <1:
-                    #  p = expected**score
-                    #
-                    # Comparison of two fractions, Statistical methods in medical
-                    # research, Armitage et al. p. 125:
-                    z = z_from_two_samples(
-                        score, templates_ulengths[template], w_Nhits, template_tot_ulen, etta)
-                    p = fastp(z)
-                    # correction for multiple testing:
-                    p_corr = p * Ntemplates
-                    # print score,float(uquerymers),etta
-                    frac_q = (score / (float(uquerymers) + etta)) * 100
-                    frac_d = (score / (templates_ulengths[template] + etta)) * 100
-                    coverage = w_templateentries_tot[
-                        template] / float(templates_lengths[template])
-                    # calculate total values:
-                    tot_frac_q = (templateentries[template] / (float(uquerymers) + etta)) * 100
-                    tot_frac_d = (templateentries[template] / (templates_ulengths[template] + etta)) * 100
-                    tot_coverage = templateentries_tot[template] / float(templates_lengths[template])
-                    # print results to outputfile:
-                    if p_corr <= evalue:
-                        outputfile.write(("%-12s\t%8d\t%8d\t%8.1f\t%4.2e\t%8.2f"
-                                          "\t%8.2f\t%4.2f\t%8.2f\t%8.2f\t%4.2f"
-                                          "\t%8d\t%s\n")%(
-                            template, score, int(round(expected)), round(z, 1),
-                            p_corr, frac_q, frac_d, coverage, tot_frac_q,
-                            tot_frac_d, tot_coverage,
-                            templates_ulengths[template],
-                            templates_descriptions[template].strip()
-                            ))
-                        # remove all kmers in best hit from queryindex
-                        for submer in queryindex:
-                            matches = templates[submer].split(",")
-                            if template in matches:
-                                queryindex[submer] = 0
-                        
-                        # find best hit like before:
-                        del w_templateentries
-                        del w_templateentries_tot
-                        w_templateentries = {}
-                        w_templateentries_tot = {}
-                        w_Nhits = 0
-                        (w_templateentries, w_templateentries_tot,
-                         w_Nhits) = find_matches()
-                    else:
-                        stop = True
-                break
+    # set up prefix filtering:
+    if args.prefix != None:
+        prefix = args.prefix
+    else:
+        prefix = ''
+    
+    # get e-value:
+    if args.evalue != None:
+        evalue = float(args.evalue)
+    else:
+        evalue = float(0.05)
+    
+    t0 = time.time()
+    
+    templatefilenames = args.templatefilenames or []
+    outputfilenames = args.outputfilenames or []
+
+    # send the search to a running server:
+    if args.socketname != None:
+        from kmerFinder.template.server import submit_job
+        if args.inputfilename in (None, "--", "-"):
+            sys.exit("The server needs an input file")
+        if len(templatefilenames) > 1 or len(outputfilenames) > 1:
+            sys.exit("A server job searches one database")
+        if args.abundance != None:
+            sys.exit("The server does not write abundances (--abundance)")
+        if args.threads > 1:
+            sys.exit("The server counts k-mers in its workers (--threads)")
+        if outputfilenames:
+            outputfilename = outputfilenames[0]
+        else:
+            outputfilename = os.path.splitext(args.inputfilename)[0]
+        job = {"inputfilenames": [os.path.abspath(args.inputfilename)],
+               "outputfilename": os.path.abspath(outputfilename),
+               "prefix": prefix, "wta": bool(args.wta), "evalue": evalue}
+        if args.minquality != None:
+            job["minquality"] = args.minquality
+        if args.ambiguous:
+            job["ambiguous"] = True
+        if args.kmersize != None:
+            job["kmersize"] = int(args.kmersize)
+        if args.candidates != None:
+            job["candidates"] = args.candidates
+        if templatefilenames:
+            job["templatefilename"] = os.path.abspath(templatefilenames[0])
+        if args.cachedir != None:
+            job["cachedir"] = os.path.abspath(args.cachedir)
+        reply = submit_job(args.socketname, job)
+        if reply["status"] != "ok":
+            sys.exit("Server error: %s" % (reply["message"]))
+        sys.stdout.write("# %s kmers. Total time used: %s sec\n" % (
+            "{:,}".format(reply["querymers"]), int(time.time() - t0)))
+        return
+
+    # check templatefile:
+    if not templatefilenames:
+        sys.exit("No template file specified")
+    
+    # output file of each database:
+    if len(outputfilenames) == len(templatefilenames):
+        pass
+    elif len(outputfilenames) > 1:
+        sys.exit("Give one output file, or one per template file")
+    else:
+        if outputfilenames:
+            outputfilename = outputfilenames[0]
+        else:  # If no output filename choose the same as the input filename
+            outputfilename = os.path.splitext(args.inputfilename)[0]
+        if len(templatefilenames) == 1:
+            outputfilenames = [outputfilename]
+        else:
+            outputfilenames = ["%s.%s" % (outputfilename,
+                                          os.path.basename(templatefilename))
+                               for templatefilename in templatefilenames]
+    
+    ##########################################################################
+    # READ DATABASES OF TEMPLATES
+    ##########################################################################
+    if args.kmersize != None:
+        kmersize = int(args.kmersize)
+    else:
+        kmersize = None
+    databases = []
+    for (templatefilename, outputfilename) in zip(templatefilenames,
+                                                  outputfilenames):
+        templates = read_templates(templatefilename, kmersize,
+                                   args.candidates is not None,
+                                   args.abundance is not None)
+
+        (template_tot_len, template_tot_ulen, Ntemplates) = template_totals(
+            templates)
+        if template_tot_ulen == 0:
+            sys.exit("Database %s has no template k-mers" % (
+                templatefilename))
+        databases.append((templatefilename, templates, outputfilename))
+    
+    ##########################################################################
+    # READ INPUTFILE
+    ##########################################################################
+    if args.inputfilename != None:
+        inputfilenames = [args.inputfilename]
+    else:
+        inputfilenames = []
+    if len(databases) == 1:
+        (templatefilename, templates, outputfilename) = databases[0]
+        queries = [read_query(templates, templatefilename, inputfilenames,
+                              prefix, args.threads, args.cachedir,
+                              args.minquality, args.ambiguous)]
+    else:
+        # count once per k-mer size for all databases:
+        spectra = read_spectra(inputfilenames,
+                               [db[1].kmersize for db in databases], prefix,
+                               args.threads, args.cachedir, args.minquality,
+                               args.ambiguous)
+        queries = [select_templates(spectra[templates.kmersize], templates)
+                   for (templatefilename, templates, outputfilename)
+                   in databases]
+    
+    ##########################################################################
+    # SEARCH FOR MATCHES AND PRINT RESULTS
+    ##########################################################################
+    for ((templatefilename, templates, outputfilename), query) in zip(
+            databases, queries):
+        if len(databases) > 1:
+            sys.stdout.write("# Database %s\n" % (templatefilename))
+        with open(outputfilename, "w") as outputfile:
+            if args.abundance != None:
+                write_abundance(templates, query, outputfile, args.abundance)
+            else:
+                write_matches(templates, query, outputfile, args.wta, evalue,
+                              args.candidates)
     
     ##########################################################################
     # CLOSE FILES
@@ -496,6 +681,7 @@ def findTemplate():
     
     t1 = time.time()
     
+    querymers = query.querymers
     sys.stdout.write("\r# %s kmers (%s kmers / s). Total time used: %s sec"%(
         "{:,}".format(querymers),
         "{:,}".format(querymers / (t1 - t0)),
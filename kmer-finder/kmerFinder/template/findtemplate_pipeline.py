@@ -25,10 +25,12 @@ from argparse import ArgumentParser
 from operator import itemgetter
 import re
 
-if sys.version_info < (3, 0):
-    import cPickle as pickle
-else:
-    import pickle
+import numpy
+
+from kmerFinder.template.reader import read_sequence_file
+from kmerFinder.template.database import open_database
+from kmerFinder.template.encoding import encode_kmers
+from kmerFinder.template.query import FLUSHSIZE
 #
 # Functions
 
@@ -103,6 +105,27 @@ def reversecomplement(seq):
         elif s == 'G': comp = comp + 'C'
         else: comp = comp + s
     return comp[::-1]
+#
+# Look up pending query k-mers in the database
+#
+def lookup_kmers(pending, db, kmersize, queryindex):
+  '''Add the counts of the pending k-mers found in the database to
+  queryindex, by packed k-mer, and return the number of occurrences of the
+  other k-mers'''
+  (codes, valid) = encode_kmers(list(pending), kmersize)
+  found = numpy.zeros(len(codes), dtype=bool)
+  if kmersize == db.kmersize:
+    found[valid] = db.found(codes[valid])
+  others = 0
+  for (code, count, hit) in zip(codes.tolist(), list(pending.values()), found.tolist()):
+    if hit:
+      if code in queryindex:
+        queryindex[code] += count
+      else:
+        queryindex[code] = count
+    else:
+      others += count
+  return others
 
 #
 # Parse command line options
@@ -144,22 +167,8 @@ else:
 # Open files
 #
 t0 = time.time()
-if args.inputfilename != None:
-  if args.inputfilename == "--":
-    inputfile = sys.stdin
-  else:
-    inputfile = open(args.inputfilename,"r")
-#
-if args.templatefilename != None:
-  templatefile = open(args.templatefilename+".p", "rb" )
-  templatefile_lengths = open(args.templatefilename+".len.p", "rb" )
-  try:
-    templatefile_ulengths = open(args.templatefilename+".ulen.p", "rb" )
-  except:
-    # do nothing
-    two=2
-  templatefile_descriptions = open(args.templatefilename+".desc.p", "rb" )
-else:
+#
+if args.templatefilename == None:
   sys.exit("No template file specified")
 #
 if args.outputfilename != None:
@@ -168,12 +177,20 @@ else: # If no output filename choose the same as the input filename
   outputfilename = os.path.splitext(args.inputfilename)[0]
   outputfile = open(outputfilename,"w")
 #
+# Read Template file
+#
+sys.stderr.write("%s\n" % ("# Reading database of templates"))
+db = open_database(args.templatefilename, merge=True)
+templates_lengths = db.lengths
+templates_ulengths = db.ulengths
+templates_descriptions = db.descriptions
+#
 # Size of K-mer
 #
 if args.kmersize != None:
   kmersize = int(args.kmersize)
 else:
-  kmersize = 16
+  kmersize = db.kmersize
 #
 # Make database of nmers
 #
@@ -185,18 +202,6 @@ templatebackgroundtot = 0
 Ntemplates =0
 oligolen=kmersize
 #
-# Read Template file
-#
-sys.stderr.write("%s\n" % ("# Reading database of templates"))
-templates = pickle.load(templatefile)
-templates_lengths = pickle.load(templatefile_lengths)
-try:
-  templates_ulengths = pickle.load(templatefile_ulengths)
-except:
-   sys.stderr.write('No ulen.p file found for database')
-   SystemExit()
-templates_descriptions = pickle.load(templatefile_descriptions)
-#
 # Count number of k-mers, and number of unique k-mers
 #
 template_tot_len = 0
@@ -212,158 +217,84 @@ for name in templates_lengths:
 #
 # Read inputfile
 #
-#queryseq = []
-queryseq = ""
-queryseqsegments = []
-#consensusseq = []
-#queryname = []
-#querydesc = []
-#queryname = ""
-#querydesc = ""
 Nquerys=0
 queryindex = {}
 qtotlen=0
 querymers=0
 uquerymers=0
-i=0
+# the k-mers are looked up in the database a batch at a time, only those
+# in the templates are kept, the others count once per occurrence:
+pending = {}
 if args.inputfilename != None:
   sys.stderr.write("%s\n" % ("# Reading inputfile"))
-  for line in inputfile:
-    fields=line.split()
-    if len(fields)>=1:
-      if fields[0][0] == ">":
-        if (i>0):
-          #queryseq[-1] = ''.join(queryseqsegments)
-          queryseq = ''.join(queryseqsegments)
-
-          # Update dictionary of kmers
-          #
-          seqlen = len(queryseq)
-          qtotlen += seqlen;
-          #for qseq in [queryseq[i],reversecomplement(queryseq[i])]:
-          for qseq in [queryseq]:
-            for j in range(0, seqlen-oligolen+1):
-              submer = qseq[j:j+oligolen]
-              if prefix == qseq[j:j+prefixlen]:
-                if submer in queryindex:
-                  if submer in templates:
-                    queryindex[submer] += 1
-                  querymers += 1
-                else:
-                  if submer in templates:
-                    queryindex[submer] = 1
-                  querymers += 1
-                  uquerymers += 1
-        del queryseqsegments
-        queryseqsegments = []
-        i=0
-        #queryseq.append("")
-        #consensusseq.append("")
-        #queryname.append(fields[0][1:])
-        #querydesc.append(re.sub(r"^[^\s]+\s","",line.strip()))
-      elif fields[0][0] == "@":
-        # Fastq file
-        if (i>0):
-          #queryseq[-1] = ''.join(queryseqsegments)
-          queryseq = ''.join(queryseqsegments)
-          #
-          # Update dictionary of kmers
-          #
-          seqlen = len(queryseq)
-          qtotlen += seqlen;
-          #for qseq in [queryseq[i],reversecomplement(queryseq[i])]:
-          for qseq in [queryseq]:
-            for j in range(0, seqlen-oligolen+1):
-              submer = qseq[j:j+oligolen]
-              if prefix == qseq[j:j+prefixlen]:
-                if submer in queryindex:
-                  if submer in templates:
-                    queryindex[submer] += 1
-                  querymers += 1
-                else:
-                  if submer in templates:
-                    queryindex[submer] = 1
-                  querymers += 1
-                  uquerymers += 1
-        del queryseqsegments
-        queryseqsegments = []
-        i=0
-        #queryseq.append("")
-        queryseq = ""
-        #consensusseq.append("")
-        #queryname.append(fields[0][1:])
-        #querydesc.append(re.sub(r"^[^\s]+\s","",line.strip()))
-        try:
-          line = next(inputfile)
-          fields=line.split()
-          queryseqsegments.append("")
-          queryseqsegments[i] = fields[0]
-          i+=1
-          line = next(inputfile)
-          line = next(inputfile)
-        except:
-          break
-      else:
-        queryseqsegments.append("")
-        queryseqsegments[i] = fields[0].upper()
-        i+=1
-  #queryseq[-1] = ''.join(queryseqsegments)
-  queryseq = ''.join(queryseqsegments)
-  #
-  # Update dictionary of K-mers
-  #
-  seqlen = len(queryseq)
-  qtotlen += seqlen;
-  #for qseq in [queryseq[i],reversecomplement(queryseq[i])]:
-  for qseq in [queryseq]:
-    for j in range(0, seqlen-oligolen+1):
-      submer = qseq[j:j+oligolen]
-      if prefix == qseq[j:j+prefixlen]:
-        if submer in queryindex:
-          if submer in templates:
-            queryindex[submer] += 1
-          querymers += 1
-        else:
-          if submer in templates:
-            queryindex[submer] = 1
+  for (queryname, querydesc, queryseq) in read_sequence_file(args.inputfilename):
+    #
+    # Update dictionary of K-mers
+    #
+    seqlen = len(queryseq)
+    qtotlen += seqlen;
+    #for qseq in [queryseq[i],reversecomplement(queryseq[i])]:
+    for qseq in [queryseq]:
+      for j in range(0, seqlen-oligolen+1):
+        submer = qseq[j:j+oligolen]
+        if prefix == qseq[j:j+prefixlen]:
+          if submer in pending:
+            pending[submer] += 1
+          else:
+            pending[submer] = 1
           querymers += 1
-          uquerymers += 1
-del queryseqsegments
+    if len(pending) >= FLUSHSIZE:
+      uquerymers += lookup_kmers(pending, db, kmersize, queryindex)
+      pending = {}
+uquerymers += lookup_kmers(pending, db, kmersize, queryindex)
+del pending
+uquerymers += len(queryindex)
+#
+# Template IDs of each query k-mer in the templates, a row per k-mer
+#
+querycounts = list(queryindex.values())
+(postings, sizes) = db.postings_of_kmers(
+  numpy.fromiter(queryindex, dtype=numpy.uint64, count=len(queryindex)))
+del queryindex
+postings = postings.tolist()
+starts = [0] + numpy.cumsum(sizes).tolist()
+def kmer_matches(row):
+  '''Names of the templates of the query k-mer of row'''
+  return [db.names[i] for i in postings[starts[row]:starts[row+1]]]
 #
 # Search for matches
 #
 sys.stderr.write("%s\n" % ("# Searching for matches of input in template"))
 mincoverage = 1
 Nhits=0
-for submer in queryindex:
-  if submer in templates:
-    if queryindex[submer] >= mincoverage:
-      matches = templates[submer].split(",")
-      matches = list(set(matches))
-      for match in matches:
-        #
-        # Update counts for the templates containing the k-mer
-        #
-        Nhits += 1
-        if match in templateentries:
-          templateentries[match] += 1
-        else:
-          templateentries[match] = 1
+for row in range(len(querycounts)):
+  if querycounts[row] >= mincoverage:
+    matches = kmer_matches(row)
+    matches = list(set(matches))
+    for match in matches:
       #
-      # Make list of unique matches (by converting to a dict and then back to a vector)
-      # A match may occur more than once if the k-mer is found in more than one position
-      # in that template
+      # Update counts for the templates containing the k-mer
       #
-      umatches = list(set(matches))
-      for match in umatches:
-        #
-        # Add the number of times the k-mer is found in the input sequence to the
-        # templateentries_tot dictionary
-        #
-        if match in templateentries_tot:
-          templateentries_tot[match] += queryindex[submer]
-        else:
-          templateentries_tot[match] = queryindex[submer]
+      Nhits += 1
+      if match in templateentries:
+        templateentries[match] += 1
+      else:
+        templateentries[match] = 1
+    #
+    # Make list of unique matches (by converting to a dict and then back to a vector)
+    # A match may occur more than once if the k-mer is found in more than one position
+    # in that template
+    #
+    umatches = list(set(matches))
+    for match in umatches:
+      #
+      # Add the number of times the k-mer is found in the input sequence to the
+      # templateentries_tot dictionary
+      #
+      if match in templateentries_tot:
+        templateentries_tot[match] += querycounts[row]
+      else:
+        templateentries_tot[match] = querycounts[row]
 #
 # Print best scoring entries sorted
 #
@@ -481,16 +412,14 @@ else:
           #
           # remove all kmers in best hit from queryindex
           #
-          for submer in queryindex:
-            if submer in templates:
-              matches = templates[submer].split(",")
-              #matches = list(set(templates[submer].split(",")))
-              if template in matches:
-                #querymers -= queryindex[submer]
-                #uquerymers -= 1
-                #if (uquerymers<0):
-                #  uquerymers = 0
-                queryindex[submer] = 0
+          templateid = db.ids[template]
+          for row in range(len(querycounts)):
+            if templateid in postings[starts[row]:starts[row+1]]:
+              #querymers -= querycounts[row]
+              #uquerymers -= 1
+              #if (uquerymers<0):
+              #  uquerymers = 0
+              querycounts[row] = 0
           #
           # find best hit like before
           #
@@ -499,35 +428,34 @@ else:
           del w_templateentries_tot
           w_templateentries = {}
           w_templateentries_tot = {}
-          for submer in queryindex:
-            if submer in templates:
-              if queryindex[submer] >= mincoverage:
-                matches = templates[submer].split(",")
-                matches = list(set(matches))
-                for match in matches:
-                  #
-                  # Update counts for the templates containing the k-mer
-                  #
-                  w_Nhits += 1
-                  if match in w_templateentries:
-                    w_templateentries[match] += 1
-                  else:
-                    w_templateentries[match] = 1
+          for row in range(len(querycounts)):
+            if querycounts[row] >= mincoverage:
+              matches = kmer_matches(row)
+              matches = list(set(matches))
+              for match in matches:
+                #
+                # Update counts for the templates containing the k-mer
                 #
-                # Make list of unique matches (by converting to a dict and then back to a vector)
-                # A match may occur more than once if the k-mer is found in more than one position
-                # in that template
+                w_Nhits += 1
+                if match in w_templateentries:
+                  w_templateentries[match] += 1
+                else:
+                  w_templateentries[match] = 1
+              #
+              # Make list of unique matches (by converting to a dict and then back to a vector)
+              # A match may occur more than once if the k-mer is found in more than one position
+              # in that template
+              #
+              umatches = list(set(matches))
+              for match in umatches:
                 #
-                umatches = list(set(matches))
-                for match in umatches:
-                  #
-                  # Add the number of times the k-mer is found in the input sequence to the
-                  # templateentries_tot dictionary
-                  #
-                  if match in w_templateentries_tot:
-                    w_templateentries_tot[match] += queryindex[submer]
-                  else:
-                    w_templateentries_tot[match] = queryindex[submer]
+                # Add the number of times the k-mer is found in the input sequence to the
+                # templateentries_tot dictionary
+                #
+                if match in w_templateentries_tot:
+                  w_templateentries_tot[match] += querycounts[row]
+                else:
+                  w_templateentries_tot[match] = querycounts[row]
 
         else:
           stop = True
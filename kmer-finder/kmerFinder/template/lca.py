@@ -0,0 +1,343 @@
+#!/usr/bin/env python3
+''' Taxonomic lowest common ancestors of the k-mers of template databases
+
+Copyright (c) 2014, Ole Lund, Technical University of Denmark
+All rights reserved.
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+
+The taxonomy file is the one of getTax, a tab separated line per template:
+accession, organism, tax ID, lineage ("Bacteria; ...; Escherichia coli")
+and for bacteria the species tax ID and species. The species is the
+lineage entry named by the species column (or the last entry), the genus
+the one before it. Templates are found by name, without a "gi|" prefix, or
+by organism.
+
+The lineages of the templates of a database (or of a delta segment)
+TEMFILE make a tree of named nodes, the root being 0, and every
+equivalence class gets the lowest node common to all its templates:
+
+    TEMFILE.lca.classes   node of each class (int32)
+    TEMFILE.lca.meta.p    the lineage of each template, from which the
+                          tree is numbered again, and the size of the
+                          segment
+
+Templates without a lineage are at the root. Since all k-mers of a class
+have its node, the species or genus of a query k-mer is looked up through
+its class, without its templates: an abundance profile is one pass over
+the query k-mers. A k-mer in several segments has a species (genus) only
+if it is the same in all of them.
+'''
+import os
+import pickle
+
+import numpy
+
+from kmerFinder.template.database import _map_array, _write_array
+
+NODE_DTYPE = numpy.int32
+
+# ranks of the nodes:
+GENUS = 1
+SPECIES = 2
+RANKS = {"genus": GENUS, "species": SPECIES}
+
+_SUFFIXES = [".classes", ".meta.p"]
+
+##########################################################################
+# TAXONOMY FILE
+##########################################################################
+
+def taxonomy_key(name):
+    ''' Template name as in the taxonomy file '''
+    name = name.strip(">")
+    if name[0:3] == "gi|":
+        name = name.split("|")[1]
+    return name
+
+def read_taxonomy(taxfilename):
+    ''' Lineages of the taxonomy file by accession and by organism: the
+    names from the root down and the position of the species in them
+    '''
+    lineages = {}
+    organisms = {}
+    with open(taxfilename, "r") as taxfile:
+        for l in taxfile:
+            l = l.strip()
+            if l == '' or l[0] == '#':
+                continue
+            l = l.split("\t")
+            if len(l) < 4:
+                continue
+            path = [name.strip() for name in l[3].split(";")]
+            path = [name for name in path
+                    if name != '' and name.lower() != "unknown"]
+            if not path:
+                continue
+            species = l[5].strip() if len(l) > 5 else ''
+            if species in path:
+                position = path.index(species)
+            elif species != '' and species.lower() != "unknown":
+                path.append(species)
+                position = len(path) - 1
+            else:
+                position = len(path) - 1
+            lineages[l[0]] = (tuple(path), position)
+            organisms.setdefault(l[1], (tuple(path), position))
+    for (organism, lineage) in organisms.items():
+        lineages.setdefault(organism, lineage)
+    return lineages
+
+def template_lineages(lineages, names):
+    ''' Lineage of each template name, None if it has none '''
+    found = []
+    for name in names:
+        if name in lineages:
+            found.append(lineages[name])
+        else:
+            found.append(lineages.get(taxonomy_key(name)))
+    return found
+
+##########################################################################
+# TAXONOMY TREE
+##########################################################################
+
+class TaxonomyTree(object):
+    ''' Tree of the lineages of templates, with the species and genus at
+    or above each node, -1 if none
+    '''
+
+    def __init__(self, lineages):
+        self.names = ["root"]
+        self.parents = [-1]
+        ranks = [0]
+        nodes = {}
+        # node of each template:
+        self.templates = numpy.zeros(len(lineages), dtype=NODE_DTYPE)
+        for (i, lineage) in enumerate(lineages):
+            if lineage is None:
+                continue
+            (path, position) = lineage
+            node = 0
+            for (depth, name) in enumerate(path):
+                key = (node, name)
+                if key not in nodes:
+                    nodes[key] = len(self.names)
+                    self.names.append(name)
+                    self.parents.append(node)
+                    ranks.append(0)
+                node = nodes[key]
+                if depth == position:
+                    ranks[node] = SPECIES
+                elif depth == position - 1 and ranks[node] == 0:
+                    ranks[node] = GENUS
+            self.templates[i] = node
+        self.ranks = numpy.array(ranks, dtype=numpy.int8)
+        # parents are numbered before their children:
+        species = numpy.full(len(self.names), -1, dtype=NODE_DTYPE)
+        genus = numpy.full(len(self.names), -1, dtype=NODE_DTYPE)
+        depths = numpy.zeros(len(self.names), dtype=numpy.int64)
+        for (node, parent) in enumerate(self.parents[1:], 1):
+            species[node] = node if ranks[node] == SPECIES else \
+                species[parent]
+            genus[node] = node if ranks[node] == GENUS else genus[parent]
+            depths[node] = depths[parent] + 1
+        self.species = species
+        self.genus = genus
+        self.depths = depths
+
+    def rank_nodes(self, rank):
+        ''' Node of rank at or above each node, -1 if none '''
+        return self.species if rank == SPECIES else self.genus
+
+    def ancestors(self, nodes, depth):
+        ''' Ancestor of each node at depth, -1 if the node is above it '''
+        nodes = numpy.array(nodes, dtype=NODE_DTYPE)
+        parents = numpy.asarray(self.parents, dtype=NODE_DTYPE)
+        climb = self.depths[nodes] - depth
+        for _ in range(int(climb.max()) if climb.size > 0 else 0):
+            up = climb > 0
+            nodes[up] = parents[nodes[up]]
+            climb[up] -= 1
+        nodes[climb < 0] = -1
+        return nodes
+
+def class_lca(segment, tree):
+    ''' Lowest node common to the templates of each class of a database
+    segment
+    '''
+    sizes = numpy.diff(segment.offsets)
+    lca = numpy.zeros(sizes.size, dtype=NODE_DTYPE)
+    if sizes.size == 0:
+        return lca
+    starts = numpy.asarray(segment.offsets[:-1], dtype=numpy.int64)
+    rows = numpy.asarray(segment.postings, dtype=numpy.int64) \
+        - segment.firstid
+    maxdepth = int(tree.depths[tree.templates].max()) \
+        if tree.templates.size > 0 else 0
+    # the common nodes of a class are those of a path from the root:
+    for depth in range(1, maxdepth + 1):
+        ancestors = tree.ancestors(tree.templates, depth)[rows]
+        low = numpy.minimum.reduceat(ancestors, starts)
+        common = (low >= 0) & (low == numpy.maximum.reduceat(ancestors,
+                                                              starts))
+        if not common.any():
+            break
+        lca[common] = low[common]
+    return lca
+
+##########################################################################
+# LCA INDEX
+##########################################################################
+
+class LCAIndex(object):
+    ''' LCA index of one database segment '''
+
+    def __init__(self, classes, lineages):
+        self.classes = classes
+        self.lineages = lineages
+        self.tree = TaxonomyTree(lineages)
+
+    def kmer_nodes(self, segment, kmers, rank):
+        ''' Node of rank of each packed k-mer, -1 if the LCA of the k-mer is
+        above the rank and -2 if the k-mer is not in the segment
+        '''
+        rows = segment.lookup(kmers)
+        found = rows >= 0
+        nodes = numpy.full(rows.size, -2, dtype=NODE_DTYPE)
+        nodes[found] = self.tree.rank_nodes(rank)[
+            self.classes[segment.classes[rows[found]]]]
+        return nodes
+
+def lca_filenames(templatefilename):
+    return [templatefilename + ".lca" + suffix for suffix in _SUFFIXES]
+
+def write_lca(templatefilename, segment, lineages):
+    ''' Write the LCA index of the database segment stored as
+    templatefilename from the lineage of each of its templates, the meta
+    file last
+    '''
+    filename = templatefilename + ".lca"
+    tree = TaxonomyTree(lineages)
+    _write_array(filename + ".classes", class_lca(segment, tree), NODE_DTYPE)
+    meta = {
+        "lineages": list(lineages),
+        "Nkmers": len(segment.kmers),
+        "Nclasses": segment.Nclasses,
+        "Ntemplates": len(segment.names),
+    }
+    with open(filename + ".meta.p.tmp", "wb") as metafile:
+        pickle.dump(meta, metafile, 2)
+    os.rename(filename + ".meta.p.tmp", filename + ".meta.p")
+
+def remove_lca(templatefilename):
+    ''' Remove the LCA index of a database segment, if any '''
+    for filename in lca_filenames(templatefilename):
+        if os.path.exists(filename):
+            os.remove(filename)
+
+def stored_lineages(templates):
+    ''' Lineages of the templates of a database by name, from the LCA
+    indexes of its segments
+    '''
+    lineages = {}
+    for segment in templates.segments:
+        if segment.filename is None:
+            continue
+        filename = segment.filename + ".lca.meta.p"
+        if not os.path.exists(filename):
+            continue
+        with open(filename, "rb") as metafile:
+            meta = pickle.load(metafile)
+        if meta["Ntemplates"] != len(segment.names):
+            continue
+        for (name, lineage) in zip(segment.names, meta["lineages"]):
+            if lineage is not None:
+                lineages[name] = lineage
+    return lineages
+
+def open_lca(templatefilename, segment):
+    ''' Open the LCA index of a database segment, None if it has none or it
+    was built for another version of the segment
+    '''
+    filename = templatefilename + ".lca"
+    if not os.path.exists(filename + ".meta.p"):
+        return None
+    with open(filename + ".meta.p", "rb") as metafile:
+        meta = pickle.load(metafile)
+    if (meta["Nkmers"], meta["Nclasses"], meta["Ntemplates"]) != (
+            len(segment.kmers), segment.Nclasses, len(segment.names)):
+        return None
+    return LCAIndex(_map_array(filename + ".classes", NODE_DTYPE),
+                    meta["lineages"])
+
+##########################################################################
+# ABUNDANCE
+##########################################################################
+
+def rank_abundance(templates, queryindex, rank, mincoverage=1):
+    ''' Number of query k-mers (counted with their multiplicity) of each
+    taxon of rank, as (taxon, count) by decreasing count, and the number
+    found in the database above the rank
+    '''
+    kmers = numpy.fromiter(queryindex, dtype=numpy.uint64,
+                           count=len(queryindex))
+    counts = numpy.fromiter(queryindex.values(), dtype=numpy.int64,
+                            count=len(queryindex))
+    keep = counts >= mincoverage
+    (kmers, counts) = (kmers[keep], counts[keep])
+    # taxa by name over all segments, -1 above the rank, -2 not found:
+    taxa = []
+    numbers = {}
+    labels = numpy.full(kmers.size, -2, dtype=numpy.int64)
+    for segment in templates.segments:
+        tree = segment.lca.tree
+        nodes = segment.lca.kmer_nodes(segment, kmers, rank)
+        ranked = numpy.flatnonzero(tree.ranks == rank)
+        numbering = numpy.full(len(tree.names), -1, dtype=numpy.int64)
+        for node in ranked.tolist():
+            name = tree.names[node]
+            if name not in numbers:
+                numbers[name] = len(taxa)
+                taxa.append(name)
+            numbering[node] = numbers[name]
+        found = nodes != -2
+        segmentlabels = numpy.full(kmers.size, -2, dtype=numpy.int64)
+        segmentlabels[found] = numpy.where(nodes[found] >= 0,
+                                           numbering[nodes[found]], -1)
+        # a k-mer of several segments keeps a taxon they agree on:
+        labels = numpy.where(labels == -2, segmentlabels,
+                             numpy.where((segmentlabels == -2)
+                                         | (segmentlabels == labels),
+                                         labels, -1))
+    totals = numpy.bincount(labels[labels >= 0], weights=counts[labels >= 0],
+                            minlength=len(taxa)).astype(numpy.int64)
+    order = numpy.argsort(-totals, kind="stable")
+    abundance = [(taxa[i], int(totals[i])) for i in order.tolist()
+                 if totals[i] > 0]
+    return (abundance, int(counts[labels == -1].sum()))
+
+def write_abundance(templates, query, outputfile, rank, mincoverage=1):
+    ''' Write the abundance of each taxon of rank (species or genus) in the
+    query k-mers to outputfile
+    '''
+    (abundance, unclassified) = rank_abundance(templates, query.queryindex,
+                                               RANKS[rank], mincoverage)
+    total = float(max(1, sum(count for (taxon, count) in abundance)
+                      + unclassified))
+    outputfile.write("#%s\tKmers\tAbundance [%%]\n" % (rank.capitalize()))
+    for (taxon, count) in abundance:
+        outputfile.write("%s\t%s\t%.2f\n" % (taxon, count,
+                                              count / total * 100))
+    outputfile.write("unclassified\t%s\t%.2f\n" % (
+        unclassified, unclassified / total * 100))
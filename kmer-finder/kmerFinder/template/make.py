@@ -24,12 +24,32 @@ import os
 from argparse import ArgumentParser
 from operator import itemgetter
 import re
-from string import maketrans
+from array import array
 
 if sys.version_info < (3, 0):
-    import cPickle as pickle
+    from string import maketrans
 else:
-    import pickle
+    maketrans = str.maketrans
+
+import numpy
+
+from kmerFinder.template.database import (from_template_ids, open_database,
+                                          open_segment, is_database,
+                                          base_filename, new_delta_filename,
+                                          lock_database, move_segment,
+                                          write_database,
+                                          write_pickled_database)
+from kmerFinder.template.reader import read_sequence_file
+from kmerFinder.template.encoding import decode_kmer, kmer_array
+from kmerFinder.template.build import (build_database,
+                                       build_database_external, entry_kmers)
+from kmerFinder.template.sketch import SKETCHSIZE, SketchIndex, template_sketches
+from kmerFinder.template.prescreen import write_prescreen, prescreen_scale
+from kmerFinder.template.lca import (read_taxonomy, template_lineages,
+                                     stored_lineages, write_lca)
+from kmerFinder.template.filterset import (FPRATE, build_filterset,
+                                           is_filterset, open_filterset,
+                                           write_filterset)
 
 #################################################################
 # FUNCTIONS:
@@ -66,7 +86,7 @@ def reversecomplement(seq):
 # ---------------------------------------------------------
 
 def check_homology(inputseqsegments, inputs):
-    global etta
+    global etta, names
 
     # Make list of unique k-mers in entry
     queryindex = {}
@@ -91,11 +111,12 @@ def check_homology(inputseqsegments, inputs):
     for submer in queryindex:
         if submer in inputs:
             if queryindex[submer] >= mincoverage:
-                matches = inputs[submer].split(",")
-                # get unique list:
-                umatches = list(set(matches))
-                for match in umatches:
+                matches = inputs[submer]
+                if not isinstance(matches, array):
+                    matches = [matches]
+                for match in matches:
                     # count matches:
+                    match = names[match]
                     if match in templateentries:
                         templateentries[match] += 1
                     else:
@@ -118,6 +139,18 @@ def check_homology(inputseqsegments, inputs):
 
     return (hitname, frac_q, score)
 
+def check_homology_sketch(inputseqsegments):
+    ''' Estimate of check_homology from the sketch of the entry, which is
+    returned too
+    '''
+    sketch = sketches.sketch(entry_kmers(inputseqsegments, kmersize, prefix))
+    (templateid, frac_q, shared) = sketches.best(sketch)
+    if templateid is None:
+        return ("", 0.0, 0, sketch)
+    # the score is estimated too:
+    score = int(round(frac_q * sketches.setsize(sketch)))
+    return (names[templateid], frac_q, score, sketch)
+
 # -----------------------------------------------------------
 # update database:
 # -----------------------------------------------------------
@@ -126,31 +159,56 @@ def check_homology(inputseqsegments, inputs):
 def update_database(inputseqsegments, inputname, filters):
 
     # define global variables:
-    global inputs, lengths, ulengths, descriptions, desc
+    global inputs, names, templateids, lengths, ulengths, descriptions, desc
     global Nstored, Nstored_old, Nustored, Nustored_old
     global kmer_count, kmersize, prefixlen, stepsize, t0, t1, printfreq
     global filterfilename, homthres
 
-    # Start of database update
+    # get template ID, a name that comes back keeps its ID:
+    returning = inputname in templateids
+    if not returning:
+        templateids[inputname] = len(names)
+        names.append(inputname)
+    templateid = templateids[inputname]
+
+    # Start of database update, counted in locals:
+    get = inputs.get
+    stored = 0
+    ustored = 0
+    count = 0
     for s in inputseqsegments:
         for seq in[s, reversecomplement(s)]:
-            start = 0
-            while start < len(seq) - kmersize + 1:
+            # k-mers in the filter set, by start position:
+            if filters is not None:
+                (kmers, valid) = kmer_array(seq, kmersize)
+                filtered = (filters.contains(kmers) & valid).tolist()
+            positions = range(0, len(seq) - kmersize + 1, stepsize)
+            count += len(positions)
+            for start in positions:
+                if prefix and prefix != seq[start:start + prefixlen]:
+                    continue
+                if filters is not None and filtered[start]:
+                    continue
                 submer = seq[start:start + kmersize]
-
-                if prefix == seq[start:start + prefixlen]:
-                    if (filterfilename is not None and submer not in filters
-                       or filterfilename is None):
-                        Nstored += 1
-                        if submer in inputs:
-                            if (inputs[submer].find(inputname) == -1):
-                                Nustored += 1
-                            inputs[submer] = inputs[submer] + "," + inputname
-                        else:
-                            inputs[submer] = inputname
-                            Nustored += 1
-                kmer_count += 1
-                start += stepsize
+                stored += 1
+                # a k-mer has a template ID, or an array of them when
+                # shared. A new ID is the largest, so it can only be the
+                # last one; the ID of a returning name is searched for:
+                matches = get(submer)
+                if matches is None:
+                    inputs[submer] = templateid
+                    ustored += 1
+                elif matches.__class__ is array:
+                    if matches[-1] != templateid and (
+                            not returning or templateid not in matches):
+                        matches.append(templateid)
+                        ustored += 1
+                elif matches != templateid:
+                    inputs[submer] = array("I", (matches, templateid))
+                    ustored += 1
+    Nstored += stored
+    Nustored += ustored
+    kmer_count += count
     # update nr of kmers:
     lengths[inputname] = Nstored - Nstored_old
     # update nr of unique kmers:
@@ -168,7 +226,7 @@ def update_database(inputseqsegments, inputname, filters):
 # ------------------------------------------------------------
 def process_entry(old_inputname):
 
-    global inputseqsegments, inputs, homthres, filters
+    global inputseqsegments, inputs, homthres, filters, sketches, homverify
 
     sys.stdout.write("%s %s\n" % ("# Entry read", old_inputname))
 
@@ -176,7 +234,18 @@ def process_entry(old_inputname):
     if homthres is not None:
         sys.stdout.write("%s\n" % ("# Checking for homology"))
 
-        (hitname, frac_q, score) = check_homology(inputseqsegments, inputs)
+        if sketches is None:
+            (hitname, frac_q, score) = check_homology(inputseqsegments,
+                                                      inputs)
+        else:
+            (hitname, frac_q, score, sketch) = check_homology_sketch(
+                inputseqsegments)
+            # count exactly close to the threshold:
+            if homverify is not None and abs(frac_q - homthres) <= homverify:
+                sys.stdout.write("# Estimated frac_q %s, verifying\n" % (
+                    frac_q))
+                (hitname, frac_q, score) = check_homology(inputseqsegments,
+                                                          inputs)
         sys.stdout.write(
             "# Max frac_q similarity of %s to %s frac_q: %s Score: %s\n" %
             (old_inputname, hitname, frac_q, score))
@@ -192,6 +261,72 @@ def process_entry(old_inputname):
         # include entry -> update database:
         sys.stdout.write("%s %s\n" % ("# Including entry: ", old_inputname))
         update_database(inputseqsegments, old_inputname, filters)
+        if homthres is not None and sketches is not None:
+            sketches.add(templateids[old_inputname], sketch)
+
+# ------------------------------------------------------------
+# read entries
+# ------------------------------------------------------------
+def read_entries(inputfilelist, organism=None):
+    ''' Iterate (name, description, sequences) of the entries in the files
+    of inputfilelist. Consecutive sequences with the same name, or the same
+    organism if organism maps names to organisms, form one entry.
+    '''
+    inputseqsegments = []
+    desc = ''
+    old_inputname = ''
+    original_inputname = ''
+
+    for l in inputfilelist:
+        l = l.strip()
+        for (inputname, description, sequence) in read_sequence_file(l):
+
+            # get input name and translate if necessary:
+            if organism is not None:
+                original_inputname = inputname
+                inputname = organism[inputname]
+
+            # new entry:
+            if inputname != old_inputname:
+                if old_inputname != '':
+                    yield (old_inputname, desc, inputseqsegments)
+
+                    # prepare sequence variable:
+                    inputseqsegments = []
+
+                # update old_inputname:
+                old_inputname = inputname
+
+                # store description:
+                if organism is not None:
+                    desc = original_inputname
+                else:
+                    desc = description
+
+            elif inputname == old_inputname:
+                # append description:
+                if organism is not None:
+                    desc = desc + ", " + original_inputname
+                else:
+                    desc = desc + ", " + description
+
+            # read sequence:
+            inputseqsegments.append(sequence)
+
+    # last entry:
+    if old_inputname != '':
+        yield (old_inputname, desc, inputseqsegments)
+
+# ---------------------------------------------------------
+# check that entries are new
+# ---------------------------------------------------------
+def new_entries(entries, templateids):
+    ''' Pass on entries, exiting if one is already a template '''
+    for (name, desc, segments) in entries:
+        if name in templateids:
+            sys.exit("\n%s is already in the database, it can not be added "
+                     "as a delta" % (name))
+        yield (name, desc, segments)
 
 def makeTemplateDB():
     # #########################################################################
@@ -205,7 +340,8 @@ def makeTemplateDB():
                       help="read a list of fatsa file locations",
                       metavar="INFILELIST")
     parser.add_argument("-f", "--filterfile", dest="filterfilename",
-                      help="filter (ignore) K-mers present in FILTERFILE",
+                      help="filter (ignore) K-mers present in FILTERFILE, a "
+                      "sequence file or a filter set saved with --savefilter",
                       metavar="FILTERFILE")
     parser.add_argument("-o", "--outputfile", dest="outputfilename",
                       help="write to OUTFILE", metavar="OUTFILE")
@@ -222,24 +358,62 @@ def makeTemplateDB():
     parser.add_argument("-c", "--organismlist", dest="organismlistname",
                       help="provide organism list to replace IDs ORGLIST",
                       metavar="ORGLIST")
+    parser.add_argument("-p", "--pickleoutput", dest="pickleoutput",
+                      action="store_true",
+                      help="write the database in the old pickle format")
+    parser.add_argument("-j", "--jobs", dest="jobs", type=int, default=1,
+                      help="build the database in JOBS processes, default 1",
+                      metavar="JOBS")
+    parser.add_argument("-m", "--memory", dest="memory", type=int,
+                      help="build with about MEMORY MB of k-mers in memory, "
+                      "sorted runs are kept in TMPDIR", metavar="MEMORY")
+    parser.add_argument("--delta", dest="delta", action="store_true",
+                      help="add the new templates to TEMFILE (-a) as a delta "
+                      "segment instead of writing OUTFILE")
+    parser.add_argument("--filtertype", dest="filtertype",
+                      choices=["sorted", "bloom"], default="sorted",
+                      help="keep the filter k-mers as a sorted array (exact) "
+                      "or a Bloom filter, default sorted")
+    parser.add_argument("--filterfpr", dest="filterfpr", type=float,
+                      default=FPRATE,
+                      help="false positive rate of the Bloom filter, default "
+                      "%s" % (FPRATE), metavar="FPR")
+    parser.add_argument("--savefilter", dest="savefilter",
+                      help="save the filter set of FILTERFILE as FILTERDB for "
+                      "later builds", metavar="FILTERDB")
+    parser.add_argument("--sketch", dest="sketchscale", type=int,
+                      help="also write a prescreen index of about one k-mer "
+                      "in SCALE for findTemplate --prescreen",
+                      metavar="SCALE")
+    parser.add_argument("--taxonomy", dest="taxfilename",
+                      help="also write the lowest common ancestor of the "
+                      "templates of each k-mer in the taxonomy TAXFILE, for "
+                      "findTemplate --abundance", metavar="TAXFILE")
+    parser.add_argument("--sketchsize", dest="sketchsize", type=int,
+                      default=SKETCHSIZE,
+                      help="estimate homology (-t) from MinHash sketches of "
+                      "SKETCHSIZE k-mers, 0 to count all k-mers, default %s"
+                      % (SKETCHSIZE), metavar="SKETCHSIZE")
+    parser.add_argument("--homverify", dest="homverify", type=float,
+                      help="count all k-mers when the estimated homology is "
+                      "within MARGIN of the threshold", metavar="MARGIN")
     args = parser.parse_args()
 
     ##########################################################################
     # DEFINE GLOBAL VARIABLES:
     ##########################################################################
 
-    global inputs, lengths, ulengths, descriptions, desc, inputseqsegments
+    global inputs, names, templateids, lengths, ulengths, descriptions, desc
+    global inputseqsegments
     global Nstored, Nstored_old, Nustored, Nustored_old
     global kmer_count, kmersize, prefix, prefixlen, stepsize, t0, t1, printfreq
     global filterfilename, homthres, filters, organismlist, etta
+    global sketches, homverify
 
-    # Open file for input sequence with kmers to save in database:
+    # Input sequence with kmers to save in database ("--" is stdin):
+    inputfile = ""
     if args.inputfilename is not None:
-        if args.inputfilename == "--":
-            inputfile = sys.stdin
-        else:
-            # inputfile = open(args.inputfilename,"r")
-            inputfile = args.inputfilename
+        inputfile = args.inputfilename
 
     # Open list of FASTA file locations:
     if args.inputfilelist is not None:
@@ -250,38 +424,36 @@ def makeTemplateDB():
             inputfilelist = open(args.inputfilelist, "r")
     elif inputfile != "":
         inputfilelist = [inputfile]
+    elif args.savefilter is None:
+        sys.exit("No input file specified")
+    else:
+        # only save the filter set:
+        inputfilelist = None
 
-    # Open file to filter on (kmers not to save in database):
+    # File to filter on (kmers not to save in database):
     if args.filterfilename is not None:
-        filterfile = open(args.filterfilename, "r")
-        filterfilename = optins.filterfilename
+        filterfilename = args.filterfilename
     else:
         filterfilename = None
-
-    # Open templatefile to add to already existing databse:
-    if args.templatefilename is not None:
-        templatefile = open(args.templatefilename + ".p", "rb")
-        templatefile_lengths = open(args.templatefilename + ".len.p", "rb")
-        try:
-            templatefile_ulengths = open(
-                args.templatefilename + ".ulen.p", "rb")
-        except:
-            # do nothing
-            two = 2
-            templatefile_ulengths = None
-            templatefile_descriptions = open(
-                args.templatefilename + ".desc.p", "rb")
-
-
-    # Harcode this to be true so I do not need to use the -p option:
-
-    if args.outputfilename is not None:
-        outputfile = open(args.outputfilename + ".p", "wb")
-        outputfile_lengths = open(args.outputfilename + ".len.p", "wb")
-        outputfile_ulengths = open(args.outputfilename + ".ulen.p", "wb")
-        outputfile_descriptions = open(args.outputfilename + ".desc.p", "wb")
-    else:
-        outputfile = sys.stdout
+    if args.savefilter is not None and filterfilename is None:
+        sys.exit("No filter file (-f) to save")
+
+    # Check output database:
+    if args.delta:
+        if args.templatefilename is None or not is_database(
+                args.templatefilename):
+            sys.exit("--delta needs a database (-a) not in the pickle format")
+        if args.pickleoutput:
+            sys.exit("A delta segment can not be written in the pickle "
+                     "format (-p)")
+        # compaction waits until the segment is written, with its indexes:
+        lockfile = lock_database(args.templatefilename)
+        deltafilename = new_delta_filename(args.templatefilename)
+        # searches see the segment when it is moved in place with its
+        # indexes:
+        args.outputfilename = deltafilename + ".tmp"
+    if args.outputfilename is None and inputfilelist is not None:
+        sys.exit("No output file specified")
 
     # get kmer-size:
     if args.kmersize is not None:
@@ -302,6 +474,41 @@ def makeTemplateDB():
     else:
         homthres = None
 
+    # entries are compared to the ones before them in homology reduction:
+    if (args.jobs > 1 or args.memory is not None) and homthres is not None:
+        sys.exit("Homology reduction (-t) can not be run with --jobs or "
+                 "--memory")
+    if args.delta and homthres is not None:
+        sys.exit("Homology reduction (-t) can not be run with --delta")
+
+    # sketches of the included templates for homology reduction:
+    homverify = args.homverify
+    if homthres is not None and args.sketchsize > 0:
+        sketches = SketchIndex(args.sketchsize)
+    else:
+        sketches = None
+    if args.sketchscale is not None and args.pickleoutput:
+        sys.exit("The prescreen index (--sketch) needs a database not in "
+                 "the pickle format (-p)")
+    # an updated database keeps the prescreen index it had:
+    if (args.sketchscale is None and args.templatefilename is not None
+            and not args.pickleoutput):
+        args.sketchscale = prescreen_scale(base_filename(
+            args.templatefilename))
+    if args.taxfilename is not None and args.pickleoutput:
+        sys.exit("The LCA index (--taxonomy) needs a database not in the "
+                 "pickle format (-p)")
+    # an updated database keeps the lineages of its templates:
+    lineages = {}
+    if (args.templatefilename is not None and not args.pickleoutput
+            and is_database(args.templatefilename)):
+        lineages = stored_lineages(open_database(args.templatefilename))
+    if args.taxfilename is not None:
+        lineages.update(read_taxonomy(args.taxfilename))
+    if args.memory is not None and args.pickleoutput:
+        sys.exit("The pickle format (-p) is built in memory, it can not be "
+                 "built with --memory")
+
     # Prefix to use fro filtering sequences:
     if args.prefix is not None:
         prefix = args.prefix
@@ -329,8 +536,6 @@ def makeTemplateDB():
     t0 = time.time()
     # Print progress
     printfreq = 100000
-    # frequenct to save sorted list to db
-    dbsavefreq = 30000000
 
     etta = 0.0001
 
@@ -338,78 +543,31 @@ def makeTemplateDB():
     # READ SEQUENCES FROM FILTERFILE AND SAVE KMERS
     ###################################################################
 
-    filterseqsegments = []
-    filters = {}
-    Nfilters = 0
-    i = 0
+    filters = None
     t1 = time.time()
-    if args.filterfilename is not None:
+    if filterfilename is not None and is_filterset(filterfilename):
+        sys.stdout.write("%s\n" % ("# Reading filter set"))
+        filters = open_filterset(filterfilename)
+        if (filters.kmersize, filters.prefix) != (kmersize, prefix):
+            sys.exit("Filter set %s has k-mer size %s and prefix '%s'" % (
+                filterfilename, filters.kmersize, filters.prefix))
+    elif filterfilename is not None:
         sys.stdout.write("%s\n" % ("# Reading filterfile"))
-        for line in filterfile:
-            line = line.rstrip('\n')
-            fields = line.split()
-            if len(line) >= 1:
-                if fields[0][0] == ">":
-                    if (i > 0):
-                        #
-                        # Fasta entry read
-                        #
-                        filterseq = ''.join(filterseqsegments)
-                        for seq in [filterseq, reversecomplement(filterseq)]:
-                            start = 0
-                            while start < len(seq) - kmersize:
-                                submer = seq[start:start + kmersize]
-                                if prefix == seq[start:start + prefixlen]:
-                                    if submer not in filters:
-                                        filters[submer] = filtername
-                                kmer_count += 1
-                                if kmer_count % printfreq == 0:
-                                    t1 = time.time()
-                                    sys.stdout.write(
-                                        "\r%s kmers (%s kmers / s)" %
-                                        ("{:,}".format(kmer_count),
-                                         "{:,}".format(kmer_count / (t1 - t0)))
-                                    )
-                                    sys.stdout.flush()
-                                start += stepsize
-                    del filterseqsegments
-                    filterseqsegments = []
-                    i = 0
-                    filterseq = ""
-                    filtername = fields[0][1:]
-                else:
-                    filterseqsegments.append("")
-                    filterseqsegments[i] = fields[0]
-                    i += 1
-        filterseq = ''.join(filterseqsegments)
-        for seq in [filterseq, reversecomplement(filterseq)]:
-            start = 0
-            while start < len(seq) - kmersize:
-                submer = seq[start:start + kmersize]
-                if prefix == seq[start:start + prefixlen]:
-                    if submer not in filters:
-                        filters[submer] = filtername
-                kmer_count += 1
-                if kmer_count % printfreq == 0:
-                    t1 = time.time()
-                    sys.stdout.write(
-                        "\r%s kmers (%s kmers / s)" %
-                        ("{:,}".format(kmer_count),
-                            "{:,}".format(kmer_count / (t1 - t0)))
-                    )
-                    sys.stdout.flush()
-                start += stepsize
-        #
-        # Print final statistics for filterfile
-        #
+
+        def report(name, Nkmers):
+            sys.stdout.write("# Filter %s: %s kmers\n" % (name, Nkmers))
+
+        filters = build_filterset(filterfilename, kmersize, prefix,
+                                  args.filtertype, args.filterfpr, report)
         t1 = time.time()
-        sys.stdout.write(
-            "\r%s kmers (%s kmers / s)" %
-            ("{:,}".format(kmer_count), "{:,}".format(kmer_count / (t1 - t0)))
-        )
-        sys.stdout.flush()
-        # sys.stdout.write("\n")
-    del filterseqsegments
+        sys.stdout.write("# %s filter kmers (%s) in %.2f s\n" % (
+            "{:,}".format(len(filters)), filters.kind, t1 - t0))
+        if args.savefilter is not None:
+            write_filterset(args.savefilter, filters)
+            sys.stdout.write("# Filter set written to %s\n" % (
+                args.savefilter))
+    if inputfilelist is None:
+        return
 
 
     ##########################################################################
@@ -417,6 +575,8 @@ def makeTemplateDB():
     ##########################################################################
 
     inputs = {}
+    names = []
+    templateids = {}
     lengths = {}
     ulengths = {}
     descriptions = {}
@@ -427,16 +587,40 @@ def makeTemplateDB():
     Nustored = 0
     Nustored_old = Nustored
 
+    templates = None
+    firstid = 0
     if args.templatefilename is not None:
         sys.stdout.write("%s\n" % ("# Reading database of templates"))
-        inputs = pickle.load(templatefile)
-        lengths = pickle.load(templatefile_lengths)
-        try:
-            ulengths = pickle.load(templatefile_ulengths)
-        except:
-            sys.stderr.write('No ulen.p file found for database')
-            SystemExit()
-        descriptions = pickle.load(templatefile_descriptions)
+        templates = open_database(args.templatefilename,
+                                  merge=not args.delta)
+    if args.delta:
+        if (kmersize, prefix) != (templates.kmersize, templates.prefix):
+            sys.exit("Database %s has k-mer size %s and prefix '%s'" % (
+                args.templatefilename, templates.kmersize, templates.prefix))
+        # new templates are numbered after the existing ones:
+        names = list(templates.names)
+        templateids = dict(templates.ids)
+        firstid = len(names)
+        templates = None
+    if templates is not None and args.jobs == 1 and args.memory is None:
+        names = list(templates.names)
+        templateids = dict(templates.ids)
+        for row in range(len(templates)):
+            matches = templates.matches(row)
+            if len(matches) == 1:
+                matches = int(matches[0])
+            else:
+                matches = array("I", matches.tolist())
+            inputs[decode_kmer(int(templates.kmers[row]),
+                               templates.kmersize)] = matches
+        lengths = dict(templates.lengths)
+        ulengths = dict(templates.ulengths)
+        descriptions = dict(templates.descriptions)
+        if sketches is not None:
+            for (templateid, sketch) in template_sketches(
+                    *templates.pairs(), sketchsize=args.sketchsize):
+                sketches.add(templateid, sketch)
+        del templates
 
         # Count number of k-mers and number of unique k-mers:
         for name in lengths:
@@ -452,6 +636,7 @@ def makeTemplateDB():
     ##########################################################################
 
 
+    organism = None
     if args.organismlistname is not None:
         sys.stdout.write("%s\n" % ("# Reading organism list"))
 
@@ -471,84 +656,75 @@ def makeTemplateDB():
     sys.stdout.write("%s\n" % ("# Reading inputfile(s)"))
 
     kmer_count = 0
-    inputseqsegments = []
-    inputseqsegments.append("")
-    i = 0
-    desc = ''
-    old_inputname = ''
-    original_inputname = ''
-
-
-    for l in inputfilelist:
-        l = l.strip()
-        fastafile = open(l, "r")
-        for line in fastafile:
-            line = line.rstrip('\n')
-            fields = line.split()
-            if len(line) >= 1:
-                if fields[0][0] == ">":
-
-                    # get input name and translate if necessary:
-                    inputname = fields[0][1:]
-                    if organismlist is not None:
-                        original_inputname = inputname
-                        inputname = organism[inputname]
-
-                    # new entry:
-                    if inputname != old_inputname:
-                        if old_inputname != '':
-
-                            # process entry (homology check and include in
-                            # database):
-                            process_entry(old_inputname)
-
-                            # prepare sequence variable:
-                            del inputseqsegments
-                            inputseqsegments = []
-                            i = 0
-                            inputseqsegments.append("")
-
-                        # update old_inputname:
-                        old_inputname = inputname
-
-                        # store description:
-                        if organismlist is not None:
-                            desc = original_inputname
-                        else:
-                            desc = ' '.join(fields[1:len(fields)])
-                        kmer_count_old = kmer_count
-
-                    elif inputname == old_inputname:
-                        # append description:
-                        if organismlist is not None:
-                            desc = desc + ", " + original_inputname
-                        else:
-                            desc = desc + ", " + ' '.join(fields[1:len(fields)])
-
-                        # prepare sequnece variable:
-                        inputseqsegments.append("")
-                        i = i + 1
-
-                else:
-                    # read sequnece:
-                    inputseqsegments[i] = inputseqsegments[i] + fields[0].upper()
-
-        fastafile.close()
-
-    # process last entry:
-    process_entry(inputname)
-
-    del inputseqsegments
+    entries = read_entries(inputfilelist, organism)
+    if args.delta:
+        entries = new_entries(entries, templateids)
+
+    db = None
+    if args.jobs > 1 or args.memory is not None:
+        # build in parallel, k-mers with ambiguous bases are not counted:
+        def report(name, Nkmers, Nukmers):
+            sys.stdout.write("# Including entry:  %s %s kmers, %s unique\n" %
+                             (name, Nkmers, Nukmers))
+
+        if args.memory is not None:
+            # the database is written while the k-mers are merged:
+            kmer_count = build_database_external(
+                args.outputfilename, entries, kmersize, prefix, stepsize,
+                filters, args.jobs, templates, report, args.memory,
+                firstid)
+        else:
+            (db, kmer_count) = build_database(entries, kmersize, prefix,
+                                              stepsize, filters,
+                                              args.jobs, templates, report,
+                                              firstid)
+    else:
+        for (inputname, desc, inputseqsegments) in entries:
+            # process entry (homology check and include in database):
+            process_entry(inputname)
 
     ############################################################
     # PRINT DATABASE OF KMERS
     ############################################################
 
 
-    pickle.dump(inputs, outputfile, 2)
-    pickle.dump(lengths, outputfile_lengths, 2)
-    pickle.dump(ulengths, outputfile_ulengths, 2)
-    pickle.dump(descriptions, outputfile_descriptions, 2)
+    if db is not None:
+        if args.pickleoutput:
+            inputs = dict((submer, ",".join(matches))
+                          for submer, matches in db.items())
+            write_pickled_database(args.outputfilename, inputs, db.lengths,
+                                   db.ulengths, db.descriptions)
+        else:
+            write_database(args.outputfilename, db)
+    elif args.memory is not None:
+        pass
+    elif args.pickleoutput:
+        for submer in inputs:
+            matches = inputs[submer]
+            if isinstance(matches, array):
+                inputs[submer] = ",".join([names[i] for i in matches])
+            else:
+                inputs[submer] = names[matches]
+        write_pickled_database(args.outputfilename, inputs, lengths, ulengths,
+                               descriptions)
+    else:
+        write_database(args.outputfilename,
+                       from_template_ids(inputs, names[firstid:], lengths,
+                                         ulengths, descriptions, kmersize,
+                                         prefix, firstid))
+
+    if args.sketchscale is not None:
+        sys.stdout.write("# Writing prescreen index\n")
+        segment = open_segment(args.outputfilename)
+        write_prescreen(segment.filename, segment, args.sketchscale)
+    if lineages:
+        sys.stdout.write("# Writing LCA index\n")
+        segment = open_segment(args.outputfilename)
+        write_lca(segment.filename, segment,
+                  template_lineages(lineages, segment.names))
+    if args.delta:
+        move_segment(args.outputfilename, deltafilename)
+        lockfile.close()
 
     ###########################################################
     # PRINT FINAL STATISTICS
@@ -24,10 +24,11 @@ from argparse import ArgumentParser
 from operator import itemgetter
 import re
 
-if sys.version_info < (3, 0):
-    import cPickle as pickle
-else:
-    import pickle
+import numpy
+
+from kmerFinder.template.database import (TemplateDB, open_database,
+                                          postings_from_pairs, write_database,
+                                          write_pickled_database)
 
 def makeorganismDB():
     ############################################################
@@ -37,7 +38,7 @@ def makeorganismDB():
     parser.add_argument("-i", "--inputfile", dest="inputfilename", help="read from INFILE", metavar="INFILE")
     parser.add_argument("-o", "--outputfile", dest="outputfilename", help="write to OUTFILE", metavar="OUTFILE")
     parser.add_argument("-t", "--templatefile", dest="templatefilename", help="add to database TEMFILE", metavar="TEMFILE")
-    #parser.add_argument("-p", "--pickleoutput", dest="pickleoutput",action="store_true", help="use pickle output")
+    parser.add_argument("-p", "--pickleoutput", dest="pickleoutput",action="store_true", help="write the database in the old pickle format")
     args = parser.parse_args()
     #
     # Open file for input sequence with kmers to save in database
@@ -52,30 +53,14 @@ def makeorganismDB():
     #
     # open templatefile (already existing databse)
     #
-    if args.templatefilename != None:
-      templatefile = open(args.templatefilename+".p", "rb" )
-      templatefile_lengths = open(args.templatefilename+".len.p", "rb" )
-      try:
-        templatefile_ulengths = open(args.templatefilename+".ulen.p", "rb" )
-      except:
-        # do nothing
-        two=2
-      templatefile_descriptions = open(args.templatefilename+".desc.p", "rb" )
+    if args.templatefilename == None:
+      sys.exit("No template file specified")
 
     #
-    # Harcode this to be true so I do not need to use the -p option
+    # Check output database
     #
-    args.pickleoutput = True
-    if args.outputfilename != None:
-      if args.pickleoutput == True:
-        outputfile = open(args.outputfilename+".p", "wb")
-        outputfile_lengths = open(args.outputfilename+".len.p", "wb")
-        outputfile_ulengths = open(args.outputfilename+".ulen.p", "wb")
-        outputfile_descriptions = open(args.outputfilename+".desc.p", "wb")
-      else:
-        outputfile = open(args.outputfilename,"w")
-    else:
-      outputfile = sys.stdout
+    if args.outputfilename == None:
+      sys.exit("No output file specified")
 
 
 
@@ -103,10 +88,7 @@ def makeorganismDB():
     #################################################################################
 
     sys.stdout.write("%s\n" % ("# Reading database of templates"))
-    inputs = pickle.load(templatefile)
-    lengths = pickle.load(templatefile_lengths)
-    ulengths = pickle.load(templatefile_ulengths)
-    descriptions = pickle.load(templatefile_descriptions)
+    templates = open_database(args.templatefilename, merge=True)
 
 
     #################################################################################
@@ -115,60 +97,47 @@ def makeorganismDB():
 
     sys.stdout.write("%s\n" % ("# Updating DB"))
 
-    new_inputs={}
-    new_lengths={}
-    new_ulengths={}
-    
-    if sys.version_info < (3, 0):
-        iter_inputs = inputs.iteritems()
-    else:
-        iter_inputs = inputs.items()
-    for key, value in iter_inputs:
-      # replace acc with organism name:
-      value=value.split(",")
-      #for i in range(0,len(value)):
-      #  value[i]=org[value[i]]
-      #
-      #  # update counts:
-      #  if value[i] in new_lengths:
-      #    new_lengths[value[i]] = new_lengths[value[i]] + 1
-      #  else:
-      #    new_lengths[value[i]] = 1
-      count = 0
-
-      for i in value:
-
-        value[count]=org[i]
-        count = count +1
-
-        # update counts:
-        if org[i] in new_lengths:
-          new_lengths[org[i]] = new_lengths[org[i]] + 1
-        else:
-          new_lengths[org[i]] = 1
-
-      # update unique counts:
-      uvalue= list(set(value))
-      for i in uvalue:
-        if i in new_ulengths:
-          new_ulengths[i] = new_ulengths[i] + 1
-        else:
-          new_ulengths[i] = 1
-
-      # update the kmer-dictionnary
-      nvalue = ','.join(value)
-      new_inputs[key]=nvalue
+    organisms = list(new_descriptions)
+    organism_ids = dict((name, i) for i, name in enumerate(organisms))
+    new_lengths = dict((name, 0) for name in organisms)
+    try:
+      # organism ID of every template ID:
+      mapping = numpy.array([organism_ids[org[name]] for name in templates.names],
+                            dtype=numpy.uint32)
+    except KeyError as e:
+      sys.exit("No organism given for template %s" % (e))
+
+    # the k-mers of a template are counted for its organism:
+    for name in templates.names:
+      new_lengths[org[name]] += templates.lengths[name]
+
+    # replace template IDs with organism IDs, an organism is stored once per k-mer:
+    (kmers, ids) = templates.pairs()
+    (kmers, classes, offsets, postings) = postings_from_pairs(kmers, mapping[ids])
+    new_templates = TemplateDB(kmers, classes, offsets, postings, organisms,
+                               [new_lengths[name] for name in organisms],
+                               [0] * len(organisms),
+                               [new_descriptions[name] for name in organisms],
+                               templates.kmersize, templates.prefix)
+
+    # update unique counts:
+    counts = new_templates.kmer_counts()
+    new_ulengths = dict((name, int(counts[i])) for i, name in enumerate(organisms))
+    new_templates.ulengths = new_ulengths
 
 
     ################################################################################
     #	Print new database
     ################################################################################
 
-
-    pickle.dump(new_inputs, outputfile,2)
-    pickle.dump(new_lengths, outputfile_lengths,2)
-    pickle.dump(new_ulengths, outputfile_ulengths,2)
-    pickle.dump(new_descriptions, outputfile_descriptions,2)
+    if args.pickleoutput == True:
+      new_inputs={}
+      for key, value in new_templates.items():
+        new_inputs[key] = ','.join(value)
+      write_pickled_database(args.outputfilename, new_inputs, new_lengths,
+                             new_ulengths, new_descriptions)
+    else:
+      write_database(args.outputfilename, new_templates)
 
 if __name__ == '__main__':
     makeorganismDB()
@@ -0,0 +1,215 @@
+#!/usr/bin/env python3
+''' Sketch prescreen of template databases
+
+Copyright (c) 2014, Ole Lund, Technical University of Denmark
+All rights reserved.
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+
+The prescreen index of a database (or of a delta segment) TEMFILE keeps
+the k-mers whose hash is below 2^64 / SCALE (a FracMinHash sketch, about
+one k-mer in SCALE) with their equivalence classes, and the classes of
+each template:
+
+    TEMFILE.prescreen.kmers      sketch k-mers (uint64)
+    TEMFILE.prescreen.classes    class of each sketch k-mer (uint32)
+    TEMFILE.prescreen.toffsets   start of the classes of each template
+    TEMFILE.prescreen.tclasses   classes of each template (uint32)
+    TEMFILE.prescreen.meta.p     scale and the size of the database
+
+A search first counts the query k-mers in the sketch of each template and
+keeps the templates with the most, then counts all query k-mers of these
+candidates only, through their classes. The number of hits over all
+templates (Nhits) is still counted for the whole database.
+'''
+import os
+import pickle
+
+import numpy
+
+from kmerFinder.template.sketch import hash_kmers
+from kmerFinder.template.database import (KMER_DTYPE, CLASS_DTYPE,
+                                          OFFSET_DTYPE, _map_array,
+                                          _write_array)
+
+# default fraction 1 / SCALE of the k-mers in the sketch:
+SCALE = 1000
+
+# default number of candidate templates:
+CANDIDATES = 100
+
+# number of k-mers hashed at a time:
+BLOCKSIZE = 1 << 24
+
+_SUFFIXES = [".kmers", ".classes", ".toffsets", ".tclasses", ".meta.p"]
+
+##########################################################################
+# PRESCREEN INDEX
+##########################################################################
+
+def _threshold(scale):
+    return numpy.uint64(int(2 ** 64 / scale) - 1)
+
+class Prescreen(object):
+    ''' Prescreen index of one database segment '''
+
+    def __init__(self, kmers, classes, toffsets, tclasses, scale):
+        self.kmers = kmers
+        self.classes = classes
+        self.toffsets = toffsets
+        self.tclasses = tclasses
+        self.scale = scale
+        self.threshold = _threshold(scale)
+
+    def screen(self, segment, kmers):
+        ''' Template IDs sharing sketch k-mers with the packed query k-mers
+        and the number shared
+        '''
+        kmers = kmers[hash_kmers(kmers) <= self.threshold]
+        rows = numpy.searchsorted(self.kmers, kmers)
+        rows[rows == self.kmers.size] = 0
+        if self.kmers.size > 0:
+            rows = rows[self.kmers[rows] == kmers]
+        else:
+            rows = rows[:0]
+        (ids, sizes) = segment.class_postings(self.classes[rows])
+        (ids, shared) = numpy.unique(ids, return_counts=True)
+        return (ids, shared)
+
+    def template_classes(self, templateid):
+        ''' Classes of a template by its row in the segment '''
+        return self.tclasses[self.toffsets[templateid]:
+                             self.toffsets[templateid + 1]]
+
+def prescreen_filenames(templatefilename):
+    return [templatefilename + ".prescreen" + suffix for suffix in _SUFFIXES]
+
+def write_prescreen(templatefilename, segment, scale=SCALE):
+    ''' Write the prescreen index of the database segment stored as
+    templatefilename, the meta file last
+    '''
+    filename = templatefilename + ".prescreen"
+    threshold = _threshold(scale)
+    rows = []
+    for start in range(0, len(segment.kmers), BLOCKSIZE):
+        hashes = hash_kmers(segment.kmers[start:start + BLOCKSIZE])
+        rows.append(start + numpy.flatnonzero(hashes <= threshold))
+    rows = numpy.concatenate(rows) if rows else numpy.zeros(0, dtype=int)
+    _write_array(filename + ".kmers", segment.kmers[rows], KMER_DTYPE)
+    _write_array(filename + ".classes", segment.classes[rows], CLASS_DTYPE)
+    # the class postings transposed, by template row:
+    sizes = numpy.diff(segment.offsets)
+    owners = numpy.repeat(numpy.arange(sizes.size, dtype=CLASS_DTYPE), sizes)
+    templaterows = numpy.asarray(segment.postings, dtype=numpy.int64) \
+        - segment.firstid
+    order = numpy.argsort(templaterows, kind="stable")
+    toffsets = numpy.zeros(len(segment.names) + 1, dtype=OFFSET_DTYPE)
+    numpy.cumsum(numpy.bincount(templaterows, minlength=len(segment.names)),
+                 out=toffsets[1:])
+    _write_array(filename + ".toffsets", toffsets, OFFSET_DTYPE)
+    _write_array(filename + ".tclasses", owners[order], CLASS_DTYPE)
+    meta = {
+        "scale": scale,
+        "Nkmers": len(segment.kmers),
+        "Nclasses": segment.Nclasses,
+        "Ntemplates": len(segment.names),
+    }
+    with open(filename + ".meta.p.tmp", "wb") as metafile:
+        pickle.dump(meta, metafile, 2)
+    os.rename(filename + ".meta.p.tmp", filename + ".meta.p")
+
+def remove_prescreen(templatefilename):
+    ''' Remove the prescreen index of a database segment, if any '''
+    for filename in prescreen_filenames(templatefilename):
+        if os.path.exists(filename):
+            os.remove(filename)
+
+def prescreen_scale(templatefilename):
+    ''' Scale of the prescreen index of a segment, None if it has none '''
+    filename = templatefilename + ".prescreen.meta.p"
+    if not os.path.exists(filename):
+        return None
+    with open(filename, "rb") as metafile:
+        return pickle.load(metafile)["scale"]
+
+def open_prescreen(templatefilename, segment):
+    ''' Memory-map the prescreen index of a database segment, None if it has
+    none or it was built for another version of the segment
+    '''
+    filename = templatefilename + ".prescreen"
+    if not os.path.exists(filename + ".meta.p"):
+        return None
+    with open(filename + ".meta.p", "rb") as metafile:
+        meta = pickle.load(metafile)
+    if (meta["Nkmers"], meta["Nclasses"], meta["Ntemplates"]) != (
+            len(segment.kmers), segment.Nclasses, len(segment.names)):
+        return None
+    return Prescreen(_map_array(filename + ".kmers", KMER_DTYPE),
+                     _map_array(filename + ".classes", CLASS_DTYPE),
+                     _map_array(filename + ".toffsets", OFFSET_DTYPE),
+                     _map_array(filename + ".tclasses", CLASS_DTYPE),
+                     meta["scale"])
+
+##########################################################################
+# SEARCH
+##########################################################################
+
+def candidate_templates(templates, kmers, Ncandidates=CANDIDATES):
+    ''' IDs of the Ncandidates templates sharing the most sketch k-mers
+    with the packed query k-mers, in increasing order
+    '''
+    ids = []
+    shared = []
+    for segment in templates.segments:
+        (segmentids, segmentshared) = segment.prescreen.screen(segment, kmers)
+        ids.append(segmentids)
+        shared.append(segmentshared)
+    ids = numpy.concatenate(ids)
+    shared = numpy.concatenate(shared)
+    best = numpy.argsort(-shared, kind="stable")[:Ncandidates]
+    return numpy.sort(ids[best])
+
+def candidate_postings(templates, kmers, candidates):
+    ''' The candidate template IDs of each packed k-mer, concatenated, and
+    the number of them per k-mer, like postings_of_kmers
+    '''
+    owners = []
+    ids = []
+    for segment in templates.segments:
+        first = segment.firstid
+        mine = candidates[(candidates >= first) &
+                          (candidates < first + len(segment.names))]
+        if mine.size == 0:
+            continue
+        rows = segment.lookup(kmers)
+        found = numpy.flatnonzero(rows >= 0)
+        # query k-mers by class:
+        classes = segment.classes[rows[found]]
+        order = numpy.argsort(classes, kind="stable")
+        (classes, found) = (classes[order], found[order])
+        for templateid in mine.tolist():
+            tclasses = segment.prescreen.template_classes(templateid - first)
+            starts = numpy.searchsorted(classes, tclasses, side="left")
+            sizes = numpy.searchsorted(classes, tclasses, side="right") - starts
+            index = numpy.repeat(starts - (numpy.cumsum(sizes) - sizes), sizes)
+            index += numpy.arange(index.size, dtype=index.dtype)
+            owners.append(found[index])
+            ids.append(numpy.full(index.size, templateid, dtype=numpy.int64))
+    if not ids:
+        return (numpy.zeros(0, dtype=numpy.int64),
+                numpy.zeros(len(kmers), dtype=numpy.int64))
+    owners = numpy.concatenate(owners)
+    ids = numpy.concatenate(ids)
+    order = numpy.lexsort((ids, owners))
+    sizes = numpy.bincount(owners, minlength=len(kmers)).astype(numpy.int64)
+    return (ids[order], sizes)
@@ -0,0 +1,330 @@
+#!/usr/bin/env python3
+''' Query k-mer counting
+
+Copyright (c) 2014, Ole Lund, Technical University of Denmark
+All rights reserved.
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+
+The k-mer spectrum of a query, all its distinct k-mers with their counts
+in the order they first occur, can be saved in a cache directory under a
+hash of the input files, the k-mer size, the prefix, the minimum base
+quality and whether ambiguous k-mers are counted:
+
+    CACHEDIR/KEY.kmers    packed k-mers (uint64)
+    CACHEDIR/KEY.counts   count of each k-mer (uint64)
+    CACHEDIR/KEY.meta.p   k-mer size, prefix, qtotlen, querymers and the
+                          number of ambiguous k-mers (nontemplatemers)
+
+A later search of the same input, with any database of the same k-mer size,
+is scored from the cache without reading the input again.
+'''
+import os
+import pickle
+import hashlib
+import multiprocessing
+from collections import Counter, deque
+
+import numpy
+
+from kmerFinder.template.encoding import packed_kmers, ambiguous_kmers
+from kmerFinder.template.database import open_database, _write_array
+
+# number of distinct pending query k-mers before they are looked up:
+FLUSHSIZE = 1000000
+
+# number of query bases sent to a worker process at a time:
+CHUNKSIZE = 4000000
+
+# version of the spectrum cache files:
+SPECTRUM_VERSION = 2
+
+##########################################################################
+# QUERY INDEX
+##########################################################################
+
+class QueryIndex(object):
+    ''' Counts of the query k-mers found in the templates (queryindex), the
+    query length (qtotlen) and the number of query k-mers (querymers).
+
+    Every occurrence of a k-mer not in the templates counts as a unique
+    query k-mer, so uquerymers is the number of distinct k-mers in
+    queryindex plus the occurrences of all other k-mers (nontemplatemers).
+
+    Without templates every k-mer is kept, as the arrays kmers and counts
+    (the spectrum), instead of queryindex.
+
+    K-mers covering N or bases masked for low quality are skipped, unless
+    ambiguous is set: then each of them counts in querymers and
+    nontemplatemers as it can not be in any template, as KmerFinder counted
+    them before k-mers were packed.
+    '''
+
+    def __init__(self, templates, kmersize, prefix='', ambiguous=False):
+        self.templates = templates
+        self.kmersize = kmersize
+        self.prefix = prefix
+        self.ambiguous = ambiguous
+        self.queryindex = {}
+        self.querycounts = Counter()
+        self.qtotlen = 0
+        self.querymers = 0
+        self.nontemplatemers = 0
+        self.kmers = numpy.zeros(0, dtype=numpy.uint64)
+        self.counts = numpy.zeros(0, dtype=numpy.int64)
+        self.parts = []
+
+    @property
+    def uquerymers(self):
+        return len(self.queryindex) + self.nontemplatemers
+
+    def save_kmers(self, queryseq):
+        ''' Count the packed k-mers of queryseq on both strands '''
+        self.qtotlen += len(queryseq)
+        # store kmers in original and reverse complement sequence:
+        for kmers in packed_kmers(queryseq, self.kmersize, self.prefix):
+            self.querycounts.update(kmers)
+            self.querymers += len(kmers)
+        if self.ambiguous:
+            count = ambiguous_kmers(queryseq, self.kmersize, self.prefix)
+            self.querymers += count
+            self.nontemplatemers += count
+        if len(self.querycounts) >= FLUSHSIZE:
+            self.flush()
+
+    def flush(self):
+        ''' Move the pending k-mer counts to queryindex '''
+        kmers = list(self.querycounts)
+        counts = list(self.querycounts.values())
+        if self.templates is None:
+            self.parts.append((numpy.array(kmers, dtype=numpy.uint64),
+                               numpy.array(counts, dtype=numpy.int64)))
+            self.querycounts = Counter()
+            # merge before the parts take more memory than the spectrum:
+            if sum(part[0].size for part in self.parts) > max(
+                    FLUSHSIZE, self.kmers.size):
+                self.merge()
+            return
+        found = self.templates.found(kmers).tolist()
+        queryindex = self.queryindex
+        for submer, count, hit in zip(kmers, counts, found):
+            if hit:
+                if submer in queryindex:
+                    queryindex[submer] += count
+                else:
+                    queryindex[submer] = count
+            else:
+                self.nontemplatemers += count
+        self.querycounts = Counter()
+
+    def merge(self):
+        ''' Add the flushed parts to the spectrum '''
+        (self.kmers, self.counts) = merge_counts(
+            numpy.concatenate([self.kmers] + [part[0] for part in self.parts]),
+            numpy.concatenate([self.counts] + [part[1] for part in self.parts]))
+        self.parts = []
+
+    def arrays(self):
+        ''' queryindex, or the spectrum, as arrays of k-mers and counts '''
+        self.flush()
+        if self.templates is None:
+            self.merge()
+            return (self.kmers, self.counts)
+        return (numpy.fromiter(self.queryindex, dtype=numpy.uint64,
+                               count=len(self.queryindex)),
+                numpy.fromiter(self.queryindex.values(), dtype=numpy.int64,
+                               count=len(self.queryindex)))
+
+#-------------------------------------
+# merge partial counts:
+#-------------------------------------
+def merge_counts(kmers, counts):
+    ''' Sum the counts of repeated k-mers, keeping the k-mers in the order
+    they first occur
+    '''
+    (ukmers, first, inverse) = numpy.unique(
+        kmers, return_index=True, return_inverse=True)
+    sums = numpy.bincount(inverse.ravel(), weights=counts,
+                          minlength=ukmers.size)
+    order = numpy.argsort(first, kind="stable")
+    return (ukmers[order], sums[order].astype(numpy.int64))
+
+##########################################################################
+# PARALLEL COUNTING
+##########################################################################
+
+_templates = None
+
+def _init_worker(templatefilename):
+    ''' Open the database once per worker, unless inherited by fork '''
+    global _templates
+    if _templates is None and templatefilename is not None:
+        _templates = open_database(templatefilename)
+
+def _count_chunk(args):
+    ''' Count the k-mers of a chunk of query sequences in a worker '''
+    (queryseqs, kmersize, prefix, ambiguous) = args
+    query = QueryIndex(_templates, kmersize, prefix, ambiguous)
+    for queryseq in queryseqs:
+        query.save_kmers(queryseq)
+    (kmers, counts) = query.arrays()
+    return (kmers, counts, query.qtotlen, query.querymers,
+            query.nontemplatemers)
+
+def _chunks(queryseqs):
+    ''' Group query sequences in chunks of about CHUNKSIZE bases '''
+    chunk = []
+    size = 0
+    for queryseq in queryseqs:
+        chunk.append(queryseq)
+        size += len(queryseq)
+        if size >= CHUNKSIZE:
+            yield chunk
+            chunk = []
+            size = 0
+    if chunk:
+        yield chunk
+
+def count_parallel(queryseqs, templates, templatefilename, kmersize,
+                   prefix='', threads=1, ambiguous=False):
+    ''' Count the k-mers of queryseqs in worker processes and merge them in
+    input order, so the result is the same as counting them in sequence.
+    Without templates the spectrum is counted.
+    '''
+    global _templates
+    # forked workers share the already opened database:
+    _templates = templates
+    pool = multiprocessing.Pool(threads, _init_worker, (templatefilename,))
+    query = QueryIndex(templates, kmersize, prefix, ambiguous)
+    parts = []
+    kmers = numpy.zeros(0, dtype=numpy.uint64)
+    counts = numpy.zeros(0, dtype=numpy.int64)
+    pending = deque()
+    try:
+        for chunk in _chunks(queryseqs):
+            pending.append(pool.apply_async(_count_chunk,
+                                            ((chunk, kmersize, prefix,
+                                              ambiguous),)))
+            # keep a bounded number of chunks in flight:
+            while len(pending) > 2 * threads or (pending and
+                                                 pending[0].ready()):
+                parts.append(pending.popleft().get())
+            if sum(len(part[0]) for part in parts) > FLUSHSIZE:
+                (kmers, counts) = _merge_parts(kmers, counts, parts, query)
+                parts = []
+        while pending:
+            parts.append(pending.popleft().get())
+        (kmers, counts) = _merge_parts(kmers, counts, parts, query)
+    finally:
+        pool.terminate()
+        _templates = None
+    if templates is None:
+        (query.kmers, query.counts) = (kmers, counts)
+    else:
+        query.queryindex = dict(zip(kmers.tolist(), counts.tolist()))
+    return query
+
+def _merge_parts(kmers, counts, parts, query):
+    ''' Add partial results to the merged k-mer counts and the totals '''
+    for (partkmers, partcounts, qtotlen, querymers, nontemplatemers) in parts:
+        query.qtotlen += qtotlen
+        query.querymers += querymers
+        query.nontemplatemers += nontemplatemers
+    return merge_counts(
+        numpy.concatenate([kmers] + [part[0] for part in parts]),
+        numpy.concatenate([counts] + [part[1] for part in parts]))
+
+##########################################################################
+# SPECTRUM CACHE
+##########################################################################
+
+def input_digest(inputfilenames):
+    ''' SHA-1 of the contents of inputfilenames, None for stdin '''
+    digest = hashlib.sha1()
+    for inputfilename in inputfilenames:
+        if inputfilename in ("--", "-"):
+            return None
+        with open(inputfilename, "rb") as inputfile:
+            while True:
+                block = inputfile.read(1 << 20)
+                if not block:
+                    break
+                digest.update(block)
+        digest.update(b"\0")
+    return digest
+
+def spectrum_key(digest, kmersize, prefix='', minquality=None,
+                 ambiguous=False):
+    ''' Cache key of the spectrum of the input with digest '''
+    digest = digest.copy()
+    digest.update(("%s %s %s" % (SPECTRUM_VERSION, kmersize, prefix)).encode(
+        "utf-8"))
+    if minquality is not None:
+        digest.update((" %s" % (minquality)).encode("utf-8"))
+    if ambiguous:
+        digest.update(b" ambiguous")
+    return digest.hexdigest()
+
+def write_spectrum(cachedir, key, query):
+    ''' Save the spectrum of a QueryIndex without templates '''
+    filename = os.path.join(cachedir, key)
+    (kmers, counts) = query.arrays()
+    _write_array(filename + ".kmers", kmers, numpy.uint64)
+    _write_array(filename + ".counts", counts, numpy.uint64)
+    meta = {
+        "version": SPECTRUM_VERSION,
+        "kmersize": query.kmersize,
+        "prefix": query.prefix,
+        "qtotlen": query.qtotlen,
+        "querymers": query.querymers,
+        "ambiguous": query.ambiguous,
+        "nontemplatemers": query.nontemplatemers,
+    }
+    with open(filename + ".meta.p.tmp", "wb") as metafile:
+        pickle.dump(meta, metafile, 2)
+    os.rename(filename + ".meta.p.tmp", filename + ".meta.p")
+
+def read_spectrum(cachedir, key):
+    ''' QueryIndex without templates of a cached spectrum, None if it is
+    not in the cache
+    '''
+    filename = os.path.join(cachedir, key)
+    if not os.path.exists(filename + ".meta.p"):
+        return None
+    with open(filename + ".meta.p", "rb") as metafile:
+        meta = pickle.load(metafile)
+    query = QueryIndex(None, meta["kmersize"], meta["prefix"],
+                       meta.get("ambiguous", False))
+    query.kmers = numpy.fromfile(filename + ".kmers", dtype=numpy.uint64)
+    query.counts = numpy.fromfile(filename + ".counts",
+                                  dtype=numpy.uint64).astype(numpy.int64)
+    query.qtotlen = meta["qtotlen"]
+    query.querymers = meta["querymers"]
+    query.nontemplatemers = meta.get("nontemplatemers", 0)
+    return query
+
+def select_templates(spectrum, templates):
+    ''' QueryIndex of the templates from a spectrum, as counted with
+    them. The nontemplatemers of a spectrum are its ambiguous k-mers.
+    '''
+    (kmers, counts) = spectrum.arrays()
+    query = QueryIndex(templates, spectrum.kmersize, spectrum.prefix,
+                       spectrum.ambiguous)
+    found = templates.found(kmers)
+    query.queryindex = dict(zip(kmers[found].tolist(),
+                                counts[found].tolist()))
+    query.nontemplatemers = int(counts[~found].sum()) + \
+        spectrum.nontemplatemers
+    query.qtotlen = spectrum.qtotlen
+    query.querymers = spectrum.querymers
+    return query
@@ -0,0 +1,160 @@
+#!/usr/bin/env python3
+''' FASTA / FASTQ reader
+
+Copyright (c) 2014, Ole Lund, Technical University of Denmark
+All rights reserved.
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+
+Files are read in large binary blocks and may be gzip, bzip2 or xz
+compressed; the compression is recognised from the first bytes, so it also
+works on stdin. Records start with ">" (FASTA, sequence on any number of
+lines) or "@" (FASTQ, four lines per record) and may be mixed.
+
+With a minimum base quality, FASTQ bases of lower Phred quality are read as
+N, so no k-mer covering them is counted.
+'''
+import sys
+import gzip
+import bz2
+import lzma
+
+import numpy
+
+# size of the blocks read from the input:
+BLOCKSIZE = 1 << 20
+
+# Phred quality of the quality character "!":
+PHRED_OFFSET = 33
+
+_MAGIC = [
+    (b"\x1f\x8b", gzip.open),
+    (b"BZh", bz2.open),
+    (b"\xfd7zXZ\x00", lzma.open),
+]
+
+##########################################################################
+# FUNCTIONS
+##########################################################################
+
+#--------------------------------------
+# open a sequence file:
+#--------------------------------------
+def open_sequence_file(filename):
+    ''' Open a plain or compressed sequence file for binary reading, "--"
+    or "-" is stdin
+    '''
+    if filename in ("--", "-"):
+        handle = sys.stdin.buffer
+    else:
+        handle = open(filename, "rb")
+    magic = handle.peek(6)[:6]
+    for start, decompress in _MAGIC:
+        if magic.startswith(start):
+            if handle is sys.stdin.buffer:
+                return decompress(handle, "rb")
+            handle.close()
+            return decompress(filename, "rb")
+    return handle
+
+#--------------------------------------
+# read lines in blocks:
+#--------------------------------------
+def read_lines(handle):
+    ''' Iterate the lines of a binary file without line endings '''
+    # blocks of the unfinished line, joined once it ends:
+    tail = []
+    while True:
+        block = handle.read(BLOCKSIZE)
+        if not block:
+            break
+        if b"\n" not in block:
+            tail.append(block)
+            continue
+        lines = block.split(b"\n")
+        if tail:
+            tail.append(lines[0])
+            lines[0] = b"".join(tail)
+        tail = [lines.pop()]
+        for line in lines:
+            yield line
+    tail = b"".join(tail)
+    if tail:
+        yield tail
+
+#--------------------------------------
+# read sequence records:
+#--------------------------------------
+def _header(line):
+    ''' Name and description of a header line '''
+    fields = line[1:].decode("latin-1").split()
+    if not fields:
+        return ('', '')
+    return (fields[0], ' '.join(fields[1:]))
+
+def mask_quality(seq, quality, minquality):
+    ''' Sequence line with the bases of quality below minquality as N '''
+    bases = numpy.frombuffer(seq, dtype=numpy.uint8)
+    quality = numpy.frombuffer(quality, dtype=numpy.uint8)
+    if quality.size != bases.size:
+        return seq
+    low = quality < minquality + PHRED_OFFSET
+    if not low.any():
+        return seq
+    bases = bases.copy()
+    bases[low] = ord("N")
+    return bases.tobytes()
+
+def read_records(handle, minquality=None):
+    ''' Iterate (name, description, sequence) of the records in a FASTA or
+    FASTQ file, sequences in upper case and FASTQ bases of quality below
+    minquality as N
+    '''
+    lines = read_lines(handle)
+    record = None
+    segments = []
+    for line in lines:
+        line = line.strip()
+        if not line:
+            continue
+        first = line[:1]
+        if first == b">" or first == b"@":
+            if record is not None or segments:
+                (name, description) = record or ('', '')
+                yield (name, description,
+                       b"".join(segments).upper().decode("latin-1"))
+            record = _header(line)
+            segments = []
+            if first == b"@":
+                # sequence, "+" and quality line:
+                seq = next(lines, b"").strip()
+                next(lines, None)
+                quality = next(lines, b"").strip()
+                if minquality is not None:
+                    seq = mask_quality(seq, quality, minquality)
+                segments.append(seq)
+        else:
+            segments.append(line)
+    if record is not None or segments:
+        (name, description) = record or ('', '')
+        yield (name, description, b"".join(segments).upper().decode("latin-1"))
+
+def read_sequence_file(filename, minquality=None):
+    ''' Iterate the records of a sequence file, see read_records '''
+    handle = open_sequence_file(filename)
+    try:
+        for record in read_records(handle, minquality):
+            yield record
+    finally:
+        if handle is not sys.stdin.buffer:
+            handle.close()
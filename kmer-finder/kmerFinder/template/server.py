@@ -0,0 +1,172 @@
+#!/usr/bin/env python3
+''' Find Template server
+
+Copyright (c) 2014, Ole Lund, Technical University of Denmark
+All rights reserved.
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+
+The server keeps one or more template databases open and takes jobs on a
+Unix domain socket, so a search does not pay for reading the database.
+A job is one line of JSON:
+
+    {"templatefilename": TEMFILE, "inputfilenames": [INFILE, ...],
+     "outputfilename": OUTFILE, "prefix": "", "wta": false, "evalue": 0.05,
+     "cachedir": CACHEDIR, "minquality": MINQUALITY, "ambiguous": false,
+     "kmersize": KMERSIZE, "candidates": CANDIDATES}
+
+and is answered by one line of JSON with "status" "ok" or "error". Paths
+are read by the server, so clients send absolute paths. TEMFILE may be left
+out when the server has a single database, CACHEDIR if no spectrum cache
+is used, MINQUALITY to count bases of any quality, "ambiguous" to skip the
+k-mers covering N (as findTemplate --ambiguous otherwise), KMERSIZE to take
+the k-mer size of the database and CANDIDATES to score all templates (as
+findTemplate --prescreen otherwise). Jobs run in a pool of WORKERS
+processes forked after the databases are opened, so the memory-mapped
+databases are shared by all of them.
+'''
+import sys
+import os
+import time
+import json
+import socket
+import signal
+import multiprocessing
+from argparse import ArgumentParser
+
+if sys.version_info < (3, 0):
+    import SocketServer as socketserver
+else:
+    import socketserver
+
+from kmerFinder.template.find import (read_templates, read_query,
+                                      write_matches, open_prescreens)
+
+##########################################################################
+# JOBS
+##########################################################################
+
+_databases = {}
+
+def _init_worker(templatefilenames):
+    ''' Open the databases once per worker, unless inherited by fork '''
+    for templatefilename in templatefilenames:
+        if templatefilename not in _databases:
+            _databases[templatefilename] = read_templates(templatefilename)
+            # the indexes are opened now, a compaction of the database
+            # removes those of the generation opened:
+            open_prescreens(_databases[templatefilename])
+
+def _run_job(job):
+    ''' Search one job in a worker and return the number of query k-mers '''
+    templatefilename = job.get("templatefilename")
+    if templatefilename is None and len(_databases) == 1:
+        templatefilename = list(_databases)[0]
+    if templatefilename not in _databases:
+        raise ValueError("Database %s is not loaded" % (templatefilename))
+    templates = _databases[templatefilename]
+    kmersize = job.get("kmersize")
+    if kmersize is not None and kmersize != templates.kmersize:
+        raise ValueError("Database %s has k-mer size %s" % (
+            templatefilename, templates.kmersize))
+    Ncandidates = job.get("candidates")
+    if Ncandidates is not None and not open_prescreens(templates):
+        raise ValueError("Database %s has no prescreen index, build it with "
+                         "maketemplatedb --sketch" % (templatefilename))
+    query = read_query(templates, templatefilename, job["inputfilenames"],
+                       job.get("prefix", ''), 1, job.get("cachedir"),
+                       job.get("minquality"), job.get("ambiguous", False))
+    with open(job["outputfilename"], "w") as outputfile:
+        write_matches(templates, query, outputfile, job.get("wta", False),
+                      job.get("evalue", 0.05), Ncandidates)
+    return query.querymers
+
+class JobHandler(socketserver.StreamRequestHandler):
+    ''' Read a job, run it in the pool and write the result '''
+
+    def handle(self):
+        t0 = time.time()
+        try:
+            job = json.loads(self.rfile.readline().decode("utf-8"))
+            querymers = self.server.pool.apply(_run_job, (job,))
+            reply = {"status": "ok", "querymers": querymers,
+                     "time": time.time() - t0}
+        except Exception as e:
+            reply = {"status": "error", "message": str(e)}
+        self.wfile.write((json.dumps(reply) + "\n").encode("utf-8"))
+
+class JobServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+#--------------------------------------
+# client:
+#--------------------------------------
+def submit_job(socketname, job):
+    ''' Send a job to a running server and return its reply '''
+    client = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        client.connect(socketname)
+        client.sendall((json.dumps(job) + "\n").encode("utf-8"))
+        reply = client.makefile("rb").readline()
+    finally:
+        client.close()
+    if not reply:
+        return {"status": "error", "message": "No reply from server"}
+    return json.loads(reply.decode("utf-8"))
+
+##########################################################################
+#	DEFINE GLOBAL VARIABLES
+##########################################################################
+def findTemplateServer():
+    ##########################################################################
+    # PARSE COMMAND LINE OPTIONS
+    ##########################################################################
+    parser = ArgumentParser()
+    parser.add_argument("-s", "--socket", dest="socketname", help="listen on Unix socket SOCKET", metavar="SOCKET")
+    parser.add_argument("-t", "--templatefile", dest="templatefilenames", action="append", help="keep TEMFILE open, can be repeated", metavar="TEMFILE")
+    parser.add_argument("--workers", dest="workers", type=int, default=1, help="Run at most WORKERS jobs at a time, default 1", metavar="WORKERS")
+    args = parser.parse_args()
+
+    if args.socketname is None:
+        sys.exit("No socket specified")
+    if not args.templatefilenames:
+        sys.exit("No template file specified")
+    templatefilenames = [os.path.abspath(templatefilename)
+                         for templatefilename in args.templatefilenames]
+
+    ##########################################################################
+    # READ DATABASES AND START WORKERS
+    ##########################################################################
+    _init_worker(templatefilenames)
+    pool = multiprocessing.Pool(args.workers, _init_worker,
+                                (templatefilenames,))
+    if os.path.exists(args.socketname):
+        os.remove(args.socketname)
+    server = JobServer(args.socketname, JobHandler)
+    server.pool = pool
+    # clean up on kill as on ctrl-c:
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    sys.stdout.write("# Listening on %s with %s workers\n" % (
+        args.socketname, args.workers))
+    sys.stdout.flush()
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        pool.terminate()
+        os.remove(args.socketname)
+
+if __name__ == "__main__":
+    findTemplateServer()
@@ -0,0 +1,132 @@
+#!/usr/bin/env python3
+''' MinHash sketches for homology reduction
+
+Copyright (c) 2014, Ole Lund, Technical University of Denmark
+All rights reserved.
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+
+A bottom-k sketch of a set of packed k-mers is the sorted array of the
+SKETCHSIZE smallest hashes of them. Below the largest hash of a sketch
+every k-mer of the set is in the sketch, so below the smaller of the two
+largest hashes two sketches are complete samples of their sets, and the
+fraction of the query hashes there that are also template hashes estimates
+the fraction of the query k-mers in the template (frac_q).
+'''
+import numpy
+
+# default number of hashes per sketch:
+SKETCHSIZE = 1000
+
+_M1 = numpy.uint64(0xBF58476D1CE4E5B9)
+_M2 = numpy.uint64(0x94D049BB133111EB)
+
+##########################################################################
+# FUNCTIONS
+##########################################################################
+
+def hash_kmers(kmers):
+    ''' 64 bit hash of each packed k-mer (the splitmix64 finalizer) '''
+    hashes = numpy.asarray(kmers, dtype=numpy.uint64)
+    with numpy.errstate(over="ignore"):
+        hashes = (hashes ^ (hashes >> numpy.uint64(30))) * _M1
+        hashes = (hashes ^ (hashes >> numpy.uint64(27))) * _M2
+    return hashes ^ (hashes >> numpy.uint64(31))
+
+def bottom_sketch(kmers, sketchsize=SKETCHSIZE):
+    ''' Sorted smallest sketchsize hashes of the distinct packed k-mers '''
+    hashes = hash_kmers(kmers)
+    size = 2 * sketchsize
+    while size < hashes.size:
+        # the size + 1 smallest hashes hold every distinct hash up to the
+        # largest of them:
+        smallest = numpy.unique(numpy.partition(hashes, size)[:size + 1])
+        if smallest.size >= sketchsize:
+            return smallest[:sketchsize]
+        size *= 4
+    return numpy.unique(hashes)[:sketchsize]
+
+def sketch_setsize(sketch, sketchsize=SKETCHSIZE):
+    ''' Estimated number of distinct k-mers of a sketch '''
+    if sketch.size < sketchsize:
+        return sketch.size
+    return int(round((sketchsize - 1) / (float(sketch[-1]) / 2.0 ** 64)))
+
+def template_sketches(kmers, ids, sketchsize=SKETCHSIZE):
+    ''' Template IDs and sketches of (k-mer, template ID) pairs '''
+    hashes = hash_kmers(kmers)
+    ids = numpy.asarray(ids)
+    order = numpy.lexsort((hashes, ids))
+    (hashes, ids) = (hashes[order], ids[order])
+    (uids, starts) = numpy.unique(ids, return_index=True)
+    ends = numpy.append(starts[1:], ids.size)
+    return [(int(uid), numpy.unique(hashes[start:end])[:sketchsize])
+            for (uid, start, end) in zip(uids.tolist(), starts.tolist(),
+                                         ends.tolist())]
+
+##########################################################################
+# SKETCH INDEX
+##########################################################################
+
+class SketchIndex(object):
+    ''' Sketches of the included templates, indexed by hash '''
+
+    def __init__(self, sketchsize=SKETCHSIZE):
+        self.sketchsize = sketchsize
+        self.index = {}
+        self.sketches = {}
+
+    def sketch(self, kmers):
+        return bottom_sketch(kmers, self.sketchsize)
+
+    def setsize(self, sketch):
+        return sketch_setsize(sketch, self.sketchsize)
+
+    def add(self, templateid, sketch):
+        ''' Add the sketch of a template, merging it with the sketch the
+        template already has
+        '''
+        if templateid in self.sketches:
+            old = self.sketches[templateid]
+            for h in old.tolist():
+                self.index[h].remove(templateid)
+            sketch = numpy.union1d(old, sketch)[:self.sketchsize]
+        if sketch.size == 0:
+            return
+        for h in sketch.tolist():
+            if h in self.index:
+                self.index[h].append(templateid)
+            else:
+                self.index[h] = [templateid]
+        self.sketches[templateid] = sketch
+
+    def best(self, sketch):
+        ''' Template ID with the highest estimated frac_q of the query
+        sketch, the estimate and the number of shared hashes; None, 0.0 and
+        0 if no template shares a hash
+        '''
+        ids = []
+        index = self.index
+        for h in sketch.tolist():
+            if h in index:
+                ids.extend(index[h])
+        if not ids:
+            return (None, 0.0, 0)
+        (uids, shared) = numpy.unique(ids, return_counts=True)
+        # query hashes below the largest hash of each template:
+        maxhash = numpy.array([self.sketches[i][-1] for i in uids.tolist()],
+                              dtype=numpy.uint64)
+        sampled = numpy.searchsorted(sketch, maxhash, side="right")
+        fractions = shared / numpy.maximum(sampled, 1).astype(float)
+        best = int(numpy.argmax(fractions))
+        return (int(uids[best]), float(fractions[best]), int(shared[best]))
@@ -0,0 +1,302 @@
+#!/usr/bin/env python3
+''' Find Template on a growing directory of reads
+
+Copyright (c) 2014, Ole Lund, Technical University of Denmark
+All rights reserved.
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+
+The watched directory is polled every INTERVAL seconds while a sequencer
+writes FASTQ (or FASTA) chunks to it. Plain files are read from where the
+last poll stopped, up to their last complete record; compressed files are
+read whole once their size has not changed between two polls.
+
+The k-mers of the new reads are added to the running query index and only
+they are looked up, so a refresh costs as much as its new reads. The
+output file is then rewritten in the format of findTemplate (with -w the
+winner takes it all scoring is redone for all reads). The run stops on
+ctrl-c, after IDLE seconds without new reads, or once the same template
+has been the top hit for STABLE refreshes in a row, with its score at
+least MARGIN (a fraction) above the second hit and its corrected p-value
+(the E-value) at most FACTOR times the maximum E-value on each of them.
+'''
+import sys
+import os
+import io
+import time
+from argparse import ArgumentParser
+
+import numpy
+
+from kmerFinder.template.query import QueryIndex
+from kmerFinder.template.reader import read_records, read_sequence_file
+from kmerFinder.template.find import (read_templates, match_arrays,
+                                      write_matches)
+
+# names of the sequence files read from the directory:
+SEQUENCE_SUFFIXES = (".fastq", ".fq", ".fasta", ".fa", ".fna", ".fas")
+COMPRESSED_SUFFIXES = (".gz", ".bz2", ".xz")
+
+##########################################################################
+# DIRECTORY TAIL
+##########################################################################
+
+def complete_length(data, stable=False):
+    ''' Number of bytes of the complete records at the start of data, all
+    of them if the file has stopped growing (stable)
+    '''
+    if data[:1] == b"@":
+        # four lines per FASTQ record:
+        Nlines = data.count(b"\n")
+        if stable and not data.endswith(b"\n") and (Nlines + 1) % 4 == 0:
+            return len(data)
+        Nlines -= Nlines % 4
+        if Nlines == 0:
+            return 0
+        return len(data) - len(data.split(b"\n", Nlines)[-1])
+    if stable:
+        return len(data)
+    # a FASTA record is complete when the next one starts:
+    return data.rfind(b"\n>") + 1
+
+class DirectoryTail(object):
+    ''' New sequences of the sequence files in a directory '''
+
+    def __init__(self, directory, minquality=None):
+        self.directory = directory
+        self.minquality = minquality
+        self.offsets = {}
+        self.sizes = {}
+        self.done = set()
+
+    def filenames(self):
+        names = []
+        for name in sorted(os.listdir(self.directory)):
+            base = name
+            for suffix in COMPRESSED_SUFFIXES:
+                if base.endswith(suffix):
+                    base = base[:-len(suffix)]
+            if name.startswith(".") or not base.endswith(SEQUENCE_SUFFIXES):
+                continue
+            filename = os.path.join(self.directory, name)
+            if os.path.isfile(filename):
+                names.append(filename)
+        return names
+
+    def poll(self):
+        ''' Sequences added to the directory since the last poll '''
+        queryseqs = []
+        for filename in self.filenames():
+            if filename in self.done:
+                continue
+            size = os.path.getsize(filename)
+            stable = self.sizes.get(filename) == size
+            self.sizes[filename] = size
+            if filename.endswith(COMPRESSED_SUFFIXES):
+                if stable and size > 0:
+                    queryseqs.extend(queryseq for name, description, queryseq
+                                     in read_sequence_file(filename,
+                                                           self.minquality))
+                    self.done.add(filename)
+                continue
+            offset = self.offsets.get(filename, 0)
+            if size <= offset:
+                continue
+            with open(filename, "rb") as handle:
+                handle.seek(offset)
+                data = handle.read(size - offset)
+            length = complete_length(data, stable)
+            if length > 0:
+                queryseqs.extend(queryseq for name, description, queryseq
+                                 in read_records(io.BytesIO(data[:length]),
+                                                 self.minquality))
+                self.offsets[filename] = offset + length
+        return queryseqs
+
+##########################################################################
+# RUNNING MATCHES
+##########################################################################
+
+class RunningMatches(object):
+    ''' The arrays of match_arrays for a query index that only grows '''
+
+    def __init__(self, templates):
+        self.templates = templates
+        self.hit = []
+        self.seen = numpy.zeros(len(templates.names), dtype=bool)
+        self.scores = numpy.zeros(len(templates.names), dtype=numpy.int64)
+        self.totals = numpy.zeros(len(templates.names), dtype=numpy.int64)
+        self.Nhits = 0
+
+    def add(self, query, batch):
+        ''' Add the k-mers counted in the QueryIndex batch to query '''
+        queryindex = query.queryindex
+        novel = dict((submer, count)
+                     for (submer, count) in batch.queryindex.items()
+                     if submer not in queryindex)
+        # only k-mers new to the query add to the unique scores:
+        (hit, scores, totals, Nhits) = match_arrays(self.templates, novel, 1)
+        self.scores += scores
+        self.Nhits += Nhits
+        hit = hit[~self.seen[hit]]
+        self.seen[hit] = True
+        self.hit.extend(hit.tolist())
+        (_, _, totals, _) = match_arrays(self.templates, batch.queryindex, 1)
+        self.totals += totals
+        for (submer, count) in batch.queryindex.items():
+            if submer in queryindex:
+                queryindex[submer] += count
+            else:
+                queryindex[submer] = count
+        query.qtotlen += batch.qtotlen
+        query.querymers += batch.querymers
+        query.nontemplatemers += batch.nontemplatemers
+
+    def arrays(self):
+        return (numpy.array(self.hit, dtype=numpy.int64), self.scores,
+                self.totals, self.Nhits)
+
+def top_margin(reported):
+    ''' Top template written, the fraction its score is above the second
+    and its corrected p-value, None, 0.0 and 1.0 if nothing was written
+    '''
+    if not reported:
+        return (None, 0.0, 1.0)
+    (template, score, p_corr) = reported[0]
+    second = reported[1][1] if len(reported) > 1 else 0
+    return (template, (score - second) / float(max(score, 1)), p_corr)
+
+def write_output(templates, query, outputfilename, wta, evalue, matches):
+    ''' Rewrite the output file, replacing it only when it is complete '''
+    with open(outputfilename + ".tmp", "w") as outputfile:
+        reported = write_matches(templates, query, outputfile, wta, evalue,
+                                 matches=matches)
+    os.rename(outputfilename + ".tmp", outputfilename)
+    return reported
+
+##########################################################################
+#	DEFINE GLOBAL VARIABLES
+##########################################################################
+def findTemplateWatch():
+    ##########################################################################
+    # PARSE COMMAND LINE OPTIONS
+    ##########################################################################
+    parser = ArgumentParser()
+    parser.add_argument("-d", "--directory", dest="directory", help="watch the read files in DIR", metavar="DIR")
+    parser.add_argument("-t", "--templatefile", dest="templatefilename", help="read from TEMFILE", metavar="TEMFILE")
+    parser.add_argument("-o", "--outputfile", dest="outputfilename", help="write to OUTFILE", metavar="OUTFILE")
+    parser.add_argument("-k", "--kmersize", dest="kmersize", help="Size of k-mer, default 16", metavar="KMERSIZE")
+    parser.add_argument("-x", "--prefix", dest="prefix", help="prefix, e.g. ATGAC, default none", metavar="_id")
+    parser.add_argument("-w", "--winnertakesitall", dest="wta", action="store_true", help="kmer hits are only assigned to most similar template")
+    parser.add_argument("-e", "--evalue", dest="evalue", help="Maximum E-value", metavar="EVALUE")
+    parser.add_argument("-q", "--minquality", dest="minquality", type=int, help="skip the k-mers covering FASTQ bases of Phred quality below MINQUALITY, default none", metavar="MINQUALITY")
+    parser.add_argument("--ambiguous", dest="ambiguous", action="store_true", help="count the k-mers covering N or masked bases as query k-mers in no template, as before packed k-mers, instead of skipping them; this lowers the coverage of reads with N")
+    parser.add_argument("--interval", dest="interval", type=float, default=60.0, help="look for new reads every SECONDS, default 60", metavar="SECONDS")
+    parser.add_argument("--idle", dest="idle", type=float, help="stop after SECONDS without new reads", metavar="SECONDS")
+    parser.add_argument("--stable", dest="stable", type=int, help="stop once the top hit has been the same for STABLE refreshes, each with a margin of MARGIN and a corrected p-value of at most FACTOR times EVALUE", metavar="STABLE")
+    parser.add_argument("--margin", dest="margin", type=float, default=0.2, help="with --stable, the top score must be at least MARGIN above the second, as a fraction of it, default 0.2", metavar="MARGIN")
+    parser.add_argument("--factor", dest="factor", type=float, default=0.01, help="with --stable, the corrected p-value of the top hit must be at most FACTOR times EVALUE on each of the STABLE refreshes, default 0.01", metavar="FACTOR")
+    args = parser.parse_args()
+
+    if args.directory is None or not os.path.isdir(args.directory):
+        sys.exit("No directory to watch specified")
+    if args.templatefilename is None:
+        sys.exit("No template file specified")
+    if args.outputfilename is None:
+        sys.exit("No output file specified")
+
+    # set up prefix filtering:
+    if args.prefix != None:
+        prefix = args.prefix
+    else:
+        prefix = ''
+
+    # get e-value:
+    if args.evalue != None:
+        evalue = float(args.evalue)
+    else:
+        evalue = float(0.05)
+
+    if args.kmersize != None:
+        kmersize = int(args.kmersize)
+    else:
+        kmersize = None
+
+    t0 = time.time()
+
+    ##########################################################################
+    # READ DATABASE OF TEMPLATES
+    ##########################################################################
+    templates = read_templates(args.templatefilename, kmersize)
+    query = QueryIndex(templates, templates.kmersize, prefix,
+                       args.ambiguous)
+    matches = RunningMatches(templates)
+    tail = DirectoryTail(args.directory, args.minquality)
+
+    ##########################################################################
+    # FOLD IN NEW READS
+    ##########################################################################
+    top = None
+    stable = 0
+    lastread = time.time()
+    refreshes = 0
+    try:
+        while True:
+            queryseqs = tail.poll()
+            if queryseqs:
+                lastread = time.time()
+                batch = QueryIndex(templates, templates.kmersize, prefix,
+                                   args.ambiguous)
+                for queryseq in queryseqs:
+                    batch.save_kmers(queryseq)
+                batch.flush()
+                matches.add(query, batch)
+                reported = write_output(templates, query,
+                                        args.outputfilename, args.wta,
+                                        evalue, matches.arrays())
+                refreshes += 1
+                (newtop, margin, p_corr) = top_margin(reported)
+                if (newtop is not None and margin >= args.margin
+                        and p_corr <= evalue * args.factor):
+                    stable = stable + 1 if newtop == top else 1
+                else:
+                    stable = 0
+                top = newtop
+                sys.stdout.write("# Refresh %s: %s reads, %s kmers, top hit "
+                                 "%s\n" % (refreshes, len(queryseqs),
+                                           "{:,}".format(query.querymers),
+                                           top))
+                sys.stdout.flush()
+                if args.stable is not None and stable >= args.stable:
+                    sys.stdout.write("# Top hit stable for %s refreshes\n" %
+                                     (stable))
+                    break
+            elif (args.idle is not None
+                  and time.time() - lastread >= args.idle):
+                sys.stdout.write("# No new reads for %s sec\n" % (args.idle))
+                break
+            time.sleep(args.interval)
+    except KeyboardInterrupt:
+        pass
+
+    ##########################################################################
+    # CLOSE FILES
+    ##########################################################################
+    t1 = time.time()
+    sys.stdout.write("# %s kmers in %s refreshes. Total time used: %s sec\n"
+                     % ("{:,}".format(query.querymers), refreshes,
+                        int(t1 - t0)))
+    sys.stdout.write("# Closing files\n")
+
+if __name__ == "__main__":
+    findTemplateWatch()
@@ -0,0 +1,119 @@
+#!/usr/bin/env python3
+''' Winner takes it all scoring
+
+Copyright (c) 2014, Ole Lund, Technical University of Denmark
+All rights reserved.
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+
+When a template is accepted, all query k-mers it contains are taken away
+from every other template. Instead of recounting all templates after each
+hit, the scores are kept per template and only the templates sharing a
+k-mer with the winner are updated, using a template -> query k-mer index.
+'''
+import heapq
+
+import numpy
+
+from kmerFinder.template.prescreen import candidate_postings
+
+##########################################################################
+# WINNER TAKES IT ALL
+##########################################################################
+
+class WinnerTakesAll(object):
+    ''' Unique (scores) and total (totals) k-mer hits per template ID of one
+    query, and the sum of scores over all templates (Nhits), as they are
+    after removing the k-mers of each previous winner.
+
+    Ties are broken like in the recount: the template whose first remaining
+    k-mer comes first in queryindex wins. With candidates only those template
+    IDs are scored, but Nhits is still over all templates.
+    '''
+
+    def __init__(self, templates, queryindex, mincoverage, candidates=None):
+        kmers = numpy.fromiter(queryindex, dtype=numpy.uint64,
+                               count=len(queryindex))
+        counts = numpy.fromiter(queryindex.values(), dtype=numpy.int64,
+                                count=len(queryindex))
+        keep = counts >= mincoverage
+        self.counts = counts[keep]
+        # templates of each query k-mer, CSR style, and their number in
+        # the whole database:
+        if candidates is None:
+            (self.ids, sizes) = templates.postings_of_kmers(kmers[keep])
+            self.fullsizes = sizes
+        else:
+            (self.ids, sizes) = candidate_postings(templates, kmers[keep],
+                                                   candidates)
+            self.fullsizes = templates.kmer_sizes(kmers[keep])
+        self.starts = numpy.zeros(sizes.size + 1, dtype=numpy.int64)
+        numpy.cumsum(sizes, out=self.starts[1:])
+        self.owners = numpy.repeat(numpy.arange(sizes.size), sizes)
+        self.alive = numpy.ones(sizes.size, dtype=bool)
+
+        Ntemplates = len(templates.names)
+        self.Nhits = int(self.fullsizes.sum())
+        self.scores = numpy.bincount(self.ids, minlength=Ntemplates)
+        self.totals = numpy.bincount(
+            self.ids, weights=numpy.repeat(self.counts, sizes),
+            minlength=Ntemplates).astype(numpy.int64)
+
+        # query k-mers of each template, as positions in self.ids:
+        self.hits = numpy.argsort(self.ids, kind="stable")
+        self.first = numpy.zeros(Ntemplates + 1, dtype=numpy.int64)
+        numpy.cumsum(self.scores, out=self.first[1:])
+        self.last = self.first[1:].copy()
+
+        self.heap = [(-int(self.scores[i]), int(self.hits[self.first[i]]), i)
+                     for i in numpy.flatnonzero(self.scores).tolist()]
+        heapq.heapify(self.heap)
+
+    def _first_hit(self, template):
+        ''' Position in self.ids of the first remaining k-mer of template '''
+        first = self.first[template]
+        while not self.alive[self.owners[self.hits[first]]]:
+            first += 1
+        self.first[template] = first
+        return int(self.hits[first])
+
+    def best(self):
+        ''' Template ID with the highest score, None if no k-mers are left '''
+        while self.heap:
+            (score, first, template) = self.heap[0]
+            if (-score == self.scores[template] and
+                    first == self._first_hit(template)):
+                return template
+            heapq.heappop(self.heap)
+        return None
+
+    def remove(self, template):
+        ''' Remove the k-mers of template from all templates '''
+        hits = self.hits[self.first[template]:self.last[template]]
+        kmers = self.owners[hits]
+        kmers = kmers[self.alive[kmers]]
+        self.alive[kmers] = False
+        # templates sharing the removed k-mers:
+        sizes = self.starts[kmers + 1] - self.starts[kmers]
+        index = numpy.repeat(self.starts[kmers] - (numpy.cumsum(sizes) - sizes),
+                             sizes)
+        index += numpy.arange(index.size, dtype=index.dtype)
+        ids = self.ids[index]
+        numpy.subtract.at(self.scores, ids, 1)
+        numpy.subtract.at(self.totals, ids, numpy.repeat(self.counts[kmers],
+                                                         sizes))
+        self.Nhits -= int(self.fullsizes[kmers].sum())
+        for i in numpy.unique(ids).tolist():
+            if self.scores[i] > 0:
+                heapq.heappush(self.heap, (-int(self.scores[i]),
+                                           self._first_hit(i), i))
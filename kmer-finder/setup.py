@@ -21,6 +21,10 @@ setup(
     entry_points={
         'console_scripts': [
             'findTemplate = kmerFinder.template.find:findTemplate',
+            'findTemplateBatch = kmerFinder.template.batch:findTemplateBatch',
+            'findTemplateServer = kmerFinder.template.server:findTemplateServer',
+            'findTemplateWatch = kmerFinder.template.watch:findTemplateWatch',
+            'compactTemplateDB = kmerFinder.template.compact:compactTemplateDB',
             'maketemplatedb = kmerFinder.template.make:makeTemplateDB',
             'getTax = kmerFinder.output.taxonomy:getTaxonomy',
             'createTable = kmerFinder.output.table:createTSV',
@@ -29,6 +33,7 @@ setup(
             'makeorganismDB = kmerFinder.template.organism:makeorganismDB',
         ]
     },
+    install_requires=['numpy'],
     packages=find_packages(),
     include_package_data=True,
     # test_suite = "kmerFinder.tests.make"